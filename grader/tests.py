@@ -1,7 +1,6 @@
 import numpy as np
 import torch
 import torchvision as tv
-from PIL import Image
 from transformers import AutoProcessor
 
 from .grader import Case, Grader
@@ -119,8 +118,10 @@ class CLIPGrader(Grader):
         correct_count = 0
         total_count = 0
 
+        image_io = self.module.image_io
+
         for pair in dataset:
-            image = Image.open(pair["image_path"]).convert("RGB")
+            image = image_io.to_pil(image_io.load_image(pair["image_path"]))
             pixel_values = image_processor(image).unsqueeze(0).to(self.device).bfloat16()
             text_inputs = processor(
                 text=[s + processor.tokenizer.eos_token for s in pair["candidates"]],
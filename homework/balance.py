@@ -0,0 +1,102 @@
+"""
+Streaming answer-distribution balancing of QA records.
+
+Records are grouped into strata by (question template, answer), where the template is the
+question with the kart name replaced by a placeholder. Each stratum keeps a seeded reservoir
+sample of at most its quota, so memory is bounded by the number of strata times the quota
+no matter how many records stream through. Kept records are emitted in input order.
+"""
+
+import hashlib
+import random
+import re
+from collections.abc import Iterable, Iterator
+
+KART_PLACEHOLDER = "{kart}"
+
+# Question families with a kart name in them, mapped to their template
+TEMPLATE_PATTERNS = [
+    (re.compile(r"^Is (.+) to the left or right of the ego car\?$"), "Is {kart} to the left or right of the ego car?"),
+    (re.compile(r"^Is (.+) in front of or behind the ego car\?$"), "Is {kart} in front of or behind the ego car?"),
+    (re.compile(r"^Where is (.+) relative to the ego car\?$"), "Where is {kart} relative to the ego car?"),
+]
+
+
+def question_template(question: str) -> str:
+    for pattern, template in TEMPLATE_PATTERNS:
+        if pattern.match(question):
+            return template
+    return question
+
+
+def stratum_key(template: str, answer: str) -> int:
+    """
+    Stable 64-bit hash of a (template, answer) pair, identical across processes and runs.
+    """
+    digest = hashlib.blake2b(f"{template}\0{answer}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class AnswerBalancer:
+    """
+    Caps the number of records per (question template, answer) with reservoir sampling.
+
+    Args:
+        quota: Maximum number of records kept per answer of a template, None for no cap
+        template_quotas: Optional per-template overrides of quota (None disables the cap)
+        seed: Seed of the reservoir sampling
+    """
+
+    def __init__(self, quota: int | None, template_quotas: dict[str, int | None] | None = None, seed: int = 0):
+        self.quota = quota
+        self.template_quotas = dict(template_quotas or {})
+        self.rng = random.Random(seed)
+        self.reservoirs: dict[int, list[tuple[int, dict]]] = {}
+        self.seen: dict[int, int] = {}
+        self.labels: dict[int, tuple[str, str]] = {}
+        self.count = 0
+
+    def add(self, record: dict[str, str]):
+        template = question_template(record["question"])
+        key = stratum_key(template, record["answer"])
+
+        if key not in self.labels:
+            self.labels[key] = (template, record["answer"])
+            self.reservoirs[key] = []
+            self.seen[key] = 0
+
+        index = self.count
+        self.count += 1
+        self.seen[key] += 1
+
+        quota = self.template_quotas.get(template, self.quota)
+        reservoir = self.reservoirs[key]
+        if quota is None or len(reservoir) < quota:
+            reservoir.append((index, record))
+        else:
+            # Algorithm R: the n-th record replaces a random slot with probability quota / n
+            slot = self.rng.randrange(self.seen[key])
+            if slot < quota:
+                reservoir[slot] = (index, record)
+
+    def add_all(self, records: Iterable[dict[str, str]]):
+        for record in records:
+            self.add(record)
+
+    def records(self) -> Iterator[dict[str, str]]:
+        """
+        The kept records, in the order they were added.
+        """
+        kept = [item for reservoir in self.reservoirs.values() for item in reservoir]
+        kept.sort(key=lambda item: item[0])
+        for _, record in kept:
+            yield record
+
+    def summary(self) -> dict[str, dict[str, dict[str, int]]]:
+        """
+        Seen and kept record counts per template and answer.
+        """
+        summary: dict[str, dict[str, dict[str, int]]] = {}
+        for key, (template, answer) in sorted(self.labels.items(), key=lambda item: item[1]):
+            summary.setdefault(template, {})[answer] = {"seen": self.seen[key], "kept": len(self.reservoirs[key])}
+        return summary
@@ -2,19 +2,82 @@ from pathlib import Path
 
 import torch
 from transformers import AutoModelForVision2Seq, AutoProcessor
-from transformers.image_utils import load_image
 
 from .data import VQADataset, benchmark
+from .image_io import load_images
+from .pixel_store import expand_image_tokens
 
 DEVICE = "cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu"
 
 
-class BaseVLM:
-    def __init__(self, checkpoint="HuggingFaceTB/SmolVLM-256M-Instruct"):
-        self.processor = AutoProcessor.from_pretrained(checkpoint)
+def encode_images(
+    model, pixel_values: torch.Tensor, image_map: torch.Tensor, pixel_attention_mask: torch.Tensor | None = None
+) -> torch.Tensor:
+    """
+    Image-token embeddings for a batch whose sequences share images.
+
+    Runs the vision tower once per distinct image and gathers the embeddings of image
+    image_map[i] for sequence i, in the flat (tokens, hidden_size) layout the model takes as
+    image_hidden_states.
+
+    Args:
+        model: Idefics3 / SmolVLM model, optionally wrapped by PEFT
+        pixel_values: Distinct images, (num_images, 1, channels, height, width)
+        image_map: Row of pixel_values of every sequence's image
+        pixel_attention_mask: Optional pixel mask matching pixel_values
+    """
+    base_model = model.get_base_model() if hasattr(model, "get_base_model") else model
+    features = base_model.model.get_image_features(pixel_values, pixel_attention_mask)
+    features = features.view(len(pixel_values), -1, features.shape[-1])
+    return features[image_map].reshape(-1, features.shape[-1])
+
+
+def with_image_hidden_states(model, inputs: dict) -> dict:
+    """
+    Model inputs with distinct pixel_values plus an image_map (see finetune.custom_data_collator)
+    turned into image_hidden_states, so each distinct image is encoded once. Other inputs are
+    returned unchanged.
+    """
+    if "image_map" not in inputs:
+        return inputs
+
+    inputs = dict(inputs)
+    inputs["image_hidden_states"] = encode_images(
+        model, inputs.pop("pixel_values"), inputs.pop("image_map"), inputs.pop("pixel_attention_mask", None)
+    )
+    return inputs
+
+
+def with_expanded_images(inputs: dict) -> dict:
+    """
+    Model inputs with distinct pixel_values plus an image_map turned back into one image per
+    sequence, for models that must run the vision tower in their own forward (e.g. wrapped by
+    DataParallel or DistributedDataParallel). Other inputs are returned unchanged.
+    """
+    if "image_map" not in inputs:
+        return inputs
+
+    inputs = dict(inputs)
+    image_map = inputs.pop("image_map")
+    inputs["pixel_values"] = inputs["pixel_values"][image_map]
+    if "pixel_attention_mask" in inputs:
+        inputs["pixel_attention_mask"] = inputs["pixel_attention_mask"][image_map]
+    return inputs
+
+
+def load_processor(checkpoint="HuggingFaceTB/SmolVLM-256M-Instruct"):
+    processor = AutoProcessor.from_pretrained(checkpoint)
+
+    # important to set this to False, otherwise too many image tokens
+    processor.image_processor.do_image_splitting = False
+    return processor
+
 
-        # important to set this to False, otherwise too many image tokens
-        self.processor.image_processor.do_image_splitting = False
+class BaseVLM:
+    def __init__(self, checkpoint="HuggingFaceTB/SmolVLM-256M-Instruct", image_backend: str = "pil"):
+        self.image_backend = image_backend  # image_io backend that decodes the images
+        self.pixel_store = None  # optional PixelStore ("smolvlm" profile) to read the pixels from
+        self.processor = load_processor(checkpoint)
 
         self.model = AutoModelForVision2Seq.from_pretrained(
             checkpoint,
@@ -61,9 +124,6 @@ class BaseVLM:
         Returns:
             List of generated text responses
         """
-        # Load images
-        images = [load_image(img_path) for img_path in image_paths]
-
         # Create input messages with proper image tokens
         messages = []
         for q in questions:
@@ -79,11 +139,40 @@ class BaseVLM:
 
         # Prepare inputs
         prompts = [self.processor.apply_chat_template(message, add_generation_prompt=True) for message in messages]
-        inputs = self.processor(
-            text=prompts, images=images, return_tensors="pt", padding=True, truncation=True, padding_side="left"
-        )
+        distinct_paths = list(dict.fromkeys(image_paths))
+        if self.pixel_store is not None:
+            # Pixels come straight from the store, only the text is tokenized
+            inputs = dict(
+                self.processor.tokenizer(
+                    expand_image_tokens(self.processor, prompts),
+                    return_tensors="pt",
+                    padding=True,
+                    truncation=True,
+                    padding_side="left",
+                )
+            )
+            rows = self.pixel_store.rows(image_paths)
+            inputs["pixel_values"] = torch.stack([self.pixel_store.pixel_values(row) for row in rows.tolist()])
+        else:
+            # Load every distinct image once
+            distinct_images = dict(zip(distinct_paths, load_images(distinct_paths, self.image_backend)))
+            images = [distinct_images[path].numpy() for path in image_paths]
+            inputs = self.processor(
+                text=prompts, images=images, return_tensors="pt", padding=True, truncation=True, padding_side="left"
+            )
         inputs = {k: v.to(self.device) for k, v in inputs.items()}
 
+        if len(distinct_paths) < len(image_paths) and num_return_sequences is None:
+            # Questions share images, run the vision tower once per distinct image
+            rows = {path: row for row, path in enumerate(distinct_paths)}
+            first_index = [image_paths.index(path) for path in distinct_paths]
+            inputs["pixel_values"] = inputs["pixel_values"][first_index]
+            if "pixel_attention_mask" in inputs:
+                inputs["pixel_attention_mask"] = inputs["pixel_attention_mask"][first_index]
+            inputs["image_map"] = torch.tensor([rows[path] for path in image_paths], device=self.device)
+            with torch.no_grad():
+                inputs = with_image_hidden_states(self.model, inputs)
+
         # Set generation parameters
         generate_params = {
             "max_new_tokens": 32,
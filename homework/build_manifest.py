@@ -0,0 +1,214 @@
+"""
+Incremental, resumable dataset builds.
+
+An incremental build writes a JSONL output together with a manifest
+(``<output>.manifest.json``) that records, for every info file, its size, mtime, content hash,
+the camera views that have images, and the byte range of its records in the output.
+Sequences whose info file is gone and that only the split's sequence index holds are described
+by the index instead: the mtime the index stored for them, no size, and a hash of their index row.
+A rebuild only regenerates sequences that were added or changed (or all of them when the
+generator version changes) and copies the byte ranges of everything else from the previous
+output.
+
+While a build runs, records are appended to ``<output>.partial`` and a partial manifest is
+checkpointed next to it. An interrupted build picks up from the last checkpoint.
+"""
+
+import hashlib
+import json
+import os
+from collections.abc import Callable
+from pathlib import Path
+
+from build_utils import map_sequences, sequence_views
+from records import split_record_suffix
+from sequence_index import SequenceIndex, load_index
+
+MANIFEST_VERSION = 1
+
+
+def manifest_path(output_path: Path) -> Path:
+    return output_path.with_name(output_path.name + ".manifest.json")
+
+
+def indexed_sequence(info_path: Path) -> tuple[SequenceIndex, int]:
+    """
+    Sequence index and row holding a sequence whose info file is gone.
+    """
+    index = load_index(info_path.parent)
+    row = index.find(info_path.name) if index is not None else -1
+    if row < 0:
+        raise FileNotFoundError(f"{info_path} does not exist and is not in the sequence index of its split")
+    return index, row
+
+
+def file_hash(path: Path) -> str:
+    if not path.exists():
+        index, row = indexed_sequence(path)
+        return index.row_hash(row)
+    with path.open("rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def fingerprint(info_path: Path) -> dict:
+    """
+    Cheap description of an info file and its images; the content hash is added separately.
+    """
+    try:
+        stat = info_path.stat()
+        size, mtime_ns = stat.st_size, stat.st_mtime_ns
+    except FileNotFoundError:
+        index, row = indexed_sequence(info_path)
+        size, mtime_ns = None, int(index.mtime_ns[row])
+    return {
+        "name": info_path.name,
+        "size": size,
+        "mtime_ns": mtime_ns,
+        "views": sequence_views(info_path),
+    }
+
+
+def is_up_to_date(entry: dict | None, info_path: Path, current: dict) -> bool:
+    """
+    Whether a manifest entry still describes info_path. Size and mtime are trusted when they
+    match; otherwise the content hash decides, so touched-but-unchanged files are reused.
+    """
+    if entry is None or entry["name"] != current["name"] or entry["views"] != current["views"]:
+        return False
+    if entry["size"] == current["size"] and entry["mtime_ns"] == current["mtime_ns"]:
+        return True
+    return entry["size"] == current["size"] and entry["sha256"] == file_hash(info_path)
+
+
+def load_manifest(path: Path, generator: str) -> dict | None:
+    """
+    Load a manifest, or None if it is missing or was written by a different generator version.
+    """
+    if not path.exists():
+        return None
+
+    with path.open() as f:
+        manifest = json.load(f)
+
+    if manifest.get("manifest_version") != MANIFEST_VERSION or manifest.get("generator") != generator:
+        return None
+    return manifest
+
+
+def output_stat(output_path: Path) -> dict:
+    stat = output_path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def write_manifest(path: Path, generator: str, output_path: Path, sequences: list[dict]):
+    manifest = {
+        "manifest_version": MANIFEST_VERSION,
+        "generator": generator,
+        "output": output_path.name,
+        "output_stat": output_stat(output_path),
+        "num_records": sum(entry["num_records"] for entry in sequences),
+        "sequences": sequences,
+    }
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def incremental_build(
+    output_path: Path,
+    info_files: list[Path],
+    entries_fn: Callable[[Path], list[dict]],
+    generator: str,
+    workers: int = 1,
+    checkpoint_every: int = 50,
+    progress: Callable = iter,
+) -> tuple[int, int]:
+    """
+    Build (or update) a JSONL dataset, regenerating only added or changed sequences.
+
+    Args:
+        output_path: JSONL output file
+        info_files: Sorted info files that make up the dataset
+        entries_fn: Picklable function returning the records of one info file
+        generator: Generator name and version; a mismatch invalidates the whole manifest
+        workers: Number of worker processes used to regenerate sequences
+        checkpoint_every: Number of sequences between partial manifest checkpoints
+        progress: Wrapper for the sequence loop, e.g. tqdm
+
+    Returns:
+        (number of records, number of regenerated sequences)
+    """
+    if split_record_suffix(output_path)[1] != ".jsonl":
+        raise ValueError(f"Incremental builds need an uncompressed .jsonl output, got {output_path.name}")
+
+    partial_path = output_path.with_name(output_path.name + ".partial")
+    partial_manifest_path = manifest_path(partial_path)
+
+    # The stat check catches an output and manifest that do not belong together (e.g. a crash
+    # between replacing the output and writing its manifest); such a pair is rebuilt from scratch
+    previous = load_manifest(manifest_path(output_path), generator) if output_path.exists() else None
+    if previous and previous["output_stat"] != output_stat(output_path):
+        previous = None
+    previous_entries = {entry["name"]: entry for entry in previous["sequences"]} if previous else {}
+
+    # Resume: keep the longest prefix of the partial output that is still valid
+    resumed: list[dict] = []
+    partial = load_manifest(partial_manifest_path, generator) if partial_path.exists() else None
+    if partial:
+        partial_size = partial_path.stat().st_size
+        for entry, info_path in zip(partial["sequences"], info_files):
+            if entry["offset"] + entry["length"] > partial_size:
+                break
+            if not is_up_to_date(entry, info_path, fingerprint(info_path)):
+                break
+            resumed.append(entry)
+
+    # Decide per remaining sequence whether its records can be copied from the previous output
+    plan = []
+    for info_path in info_files[len(resumed) :]:
+        current = fingerprint(info_path)
+        entry = previous_entries.get(info_path.name)
+        plan.append((info_path, current, entry if is_up_to_date(entry, info_path, current) else None))
+
+    stale = [info_path for info_path, _, entry in plan if entry is None]
+    generated = map_sequences(entries_fn, stale, workers)
+
+    sequences = list(resumed)
+    offset = resumed[-1]["offset"] + resumed[-1]["length"] if resumed else 0
+
+    with open(partial_path, "r+b" if resumed else "wb") as out:
+        out.truncate(offset)
+        out.seek(offset)
+        old_output = open(output_path, "rb") if previous else None
+
+        try:
+            for i, (info_path, current, entry) in enumerate(progress(plan)):
+                if entry is not None:
+                    old_output.seek(entry["offset"])
+                    chunk = old_output.read(entry["length"])
+                    num_records = entry["num_records"]
+                    current["sha256"] = entry["sha256"]
+                else:
+                    records = next(generated)
+                    chunk = b"".join((json.dumps(record) + "\n").encode() for record in records)
+                    num_records = len(records)
+                    current["sha256"] = file_hash(info_path)
+
+                out.write(chunk)
+                sequences.append({**current, "offset": offset, "length": len(chunk), "num_records": num_records})
+                offset += len(chunk)
+
+                if (i + 1) % checkpoint_every == 0:
+                    out.flush()
+                    os.fsync(out.fileno())
+                    write_manifest(partial_manifest_path, generator, partial_path, sequences)
+        finally:
+            if old_output is not None:
+                old_output.close()
+
+    os.replace(partial_path, output_path)
+    write_manifest(manifest_path(output_path), generator, output_path, sequences)
+    partial_manifest_path.unlink(missing_ok=True)
+
+    return sum(entry["num_records"] for entry in sequences), len(stale)
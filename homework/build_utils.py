@@ -0,0 +1,171 @@
+import os
+import re
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from records import RecordWriter, iter_records, split_record_suffix
+from sequence_index import load_index
+
+
+def parse_shard(shard: str | None) -> tuple[int, int] | None:
+    """
+    Parse a shard spec of the form "i/n" (0 <= i < n) into (i, n).
+    """
+    if shard is None:
+        return None
+
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", str(shard))
+    if match is None:
+        raise ValueError(f"Shard must look like 'i/n', got {shard!r}")
+
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or index >= count:
+        raise ValueError(f"Shard index must satisfy 0 <= i < n, got {shard!r}")
+    return index, count
+
+
+def list_info_files(split_dir: Path, shard: tuple[int, int] | None = None) -> list[Path]:
+    """
+    Sorted *_info.json files of a split, optionally restricted to one shard.
+
+    Shards are contiguous slices of the sorted list, so concatenating the shard
+    outputs in shard order reproduces the output of an unsharded build.
+    """
+    return select_shard(with_indexed_sequences(split_dir, split_dir.glob("*_info.json")), shard)
+
+
+def with_indexed_sequences(split_dir: Path, info_files) -> list[Path]:
+    """
+    Sorted info files plus those only kept in the split's sequence index (see sequence_index.py).
+    """
+    info_files = set(info_files)
+    index = load_index(split_dir)
+    if index is not None:
+        info_files.update(split_dir / name for name in index.info_files())
+    return sorted(info_files)
+
+
+def select_shard(items: list, shard: tuple[int, int] | None) -> list:
+    """
+    Contiguous slice of a sorted list belonging to one shard.
+    """
+    if shard is None:
+        return items
+
+    index, count = shard
+    start = index * len(items) // count
+    stop = (index + 1) * len(items) // count
+    return items[start:stop]
+
+
+IMAGE_NAME_RE = re.compile(r"(?P<base>.+)_(?P<view>\d{2})_im\.jpg")
+
+
+def index_split(split_dir: Path, num_views: int = 10) -> dict[Path, list[int]]:
+    """
+    Scan a split directory once and map every info file (sorted) to the views that have an image.
+
+    Equivalent to calling sequence_views for every info file, without an exists() call per view.
+    """
+    info_files = []
+    views: dict[str, list[int]] = defaultdict(list)
+
+    with os.scandir(split_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith("_info.json"):
+                info_files.append(split_dir / entry.name)
+            elif match := IMAGE_NAME_RE.fullmatch(entry.name):
+                if int(match["view"]) < num_views:
+                    views[match["base"]].append(int(match["view"]))
+
+    return {
+        info_path: sorted(views.get(info_path.stem.replace("_info", ""), []))
+        for info_path in with_indexed_sequences(split_dir, info_files)
+    }
+
+
+def sequence_views(info_path: Path, num_views: int = 10) -> list[int]:
+    """
+    Camera views of a sequence that have an image next to its info file.
+    """
+    base_name = info_path.stem.replace("_info", "")
+    return [v for v in range(num_views) if (info_path.parent / f"{base_name}_{v:02d}_im.jpg").exists()]
+
+
+def shard_output_path(output_path: Path, shard: tuple[int, int] | None) -> Path:
+    """
+    Output file of one shard, e.g. balanced_qa_pairs-00001-of-00004.jsonl.
+
+    The name deliberately does not match the *_qa_pairs / *_captions globs of the
+    dataset loaders, so partial shards are never picked up by training.
+    """
+    if shard is None:
+        return output_path
+
+    index, count = shard
+    base, suffix = split_record_suffix(output_path)
+    return output_path.with_name(f"{base}-{index:05d}-of-{count:05d}{suffix}")
+
+
+def map_sequences(fn: Callable[[Path], list], info_files: list[Path], workers: int = 1) -> Iterator[list]:
+    """
+    Apply fn to every info file and yield the results in input order.
+
+    With workers > 1 the files are processed by a process pool; fn must be a
+    picklable module-level function (or a functools.partial of one).
+    """
+    if workers <= 1:
+        yield from map(fn, info_files)
+        return
+
+    chunksize = max(1, len(info_files) // (workers * 8))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(fn, info_files, chunksize=chunksize)
+
+
+def find_shard_outputs(output_path: Path) -> list[Path]:
+    """
+    Locate the complete, ordered set of shard outputs belonging to output_path.
+    """
+    base, suffix = split_record_suffix(output_path)
+    pattern = re.compile(rf"{re.escape(base)}-(\d{{5}})-of-(\d{{5}}){re.escape(suffix)}")
+
+    shards: dict[int, dict[int, Path]] = {}
+    for path in output_path.parent.iterdir():
+        match = pattern.fullmatch(path.name)
+        if match:
+            shards.setdefault(int(match.group(2)), {})[int(match.group(1))] = path
+
+    if not shards:
+        raise FileNotFoundError(f"No shard outputs found for {output_path}")
+    if len(shards) > 1:
+        raise ValueError(f"Found shard outputs with different shard counts {sorted(shards)} for {output_path}")
+
+    count, by_index = next(iter(shards.items()))
+    missing = sorted(set(range(count)) - set(by_index))
+    if missing:
+        raise FileNotFoundError(f"Missing shards {missing} of {count} for {output_path}")
+
+    return [by_index[i] for i in range(count)]
+
+
+def merge_shard_outputs(output_path: Path, remove_shards: bool = False) -> int:
+    """
+    Stream the shard outputs of output_path in shard order into output_path.
+
+    Returns the number of merged records.
+    """
+    shard_paths = find_shard_outputs(output_path)
+
+    with RecordWriter(output_path) as writer:
+        for shard_path in shard_paths:
+            writer.write_all(iter_records(shard_path))
+
+    if remove_shards:
+        for shard_path in shard_paths:
+            shard_path.unlink()
+
+    return writer.count
+
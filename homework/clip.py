@@ -1,18 +1,23 @@
 from pathlib import Path
 from typing import Any
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision as tv
 from peft import LoraConfig, TaskType, get_peft_model
-from PIL import Image
 from torch.utils.data import Dataset
 from torch.utils.tensorboard import SummaryWriter
-from transformers import AutoProcessor, Trainer, TrainingArguments
+from transformers import AutoProcessor, TrainingArguments
 
 from .base_vlm import BaseVLM
 from .data import CaptionDataset, MultiChoiceQADataset
+from .image_cache import SharedImageCache
+from .image_io import load_image, set_image_packs, to_pil
+from .image_packs import ImagePacks
+from .pixel_store import PixelStore
+from .samplers import LengthBucketedSampler, SamplerTrainer
 
 processor = AutoProcessor.from_pretrained("HuggingFaceTB/SmolVLM-256M-Instruct")
 
@@ -46,26 +51,45 @@ def clip_data_collator(features: list[dict[str, torch.Tensor]]) -> dict[str, tor
     """
     # Get max sequence length
     max_length = max(f["input_ids"].shape[0] for f in features)
-
-    def pad_tensor(tensor, pad_value):
-        return torch.cat([tensor, torch.full((max_length - tensor.shape[0],), pad_value, dtype=tensor.dtype)])
-
-    input_ids = torch.stack([pad_tensor(f["input_ids"], pad_value=processor.tokenizer.eos_token_id) for f in features])
-    attention_mask = torch.stack([pad_tensor(f["attention_mask"], pad_value=0) for f in features])
-    pixel_values = torch.stack([f["pixel_values"] for f in features])  # assume all are same shape
-    labels = torch.stack([pad_tensor(f["labels"], pad_value=-100) for f in features])
+    batch_size = len(features)
+
+    # One padded output tensor per field, filled in place
+    input_ids = torch.full((batch_size, max_length), processor.tokenizer.eos_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((batch_size, max_length), dtype=torch.long)
+    labels = torch.full((batch_size, max_length), -100, dtype=torch.long)
+    # assume all are same shape
+    pixel_values = torch.empty((batch_size, *features[0]["pixel_values"].shape), dtype=torch.float)
+
+    for i, f in enumerate(features):
+        length = f["input_ids"].shape[0]
+        input_ids[i, :length] = f["input_ids"]
+        attention_mask[i, :length] = f["attention_mask"]
+        labels[i, :length] = f["labels"]
+        pixel_values[i] = f["pixel_values"]
 
     return {
-        "input_ids": input_ids.long(),
-        "attention_mask": attention_mask.long(),
-        "pixel_values": pixel_values.float(),
-        "labels": labels.long(),
+        "input_ids": input_ids,
+        "attention_mask": attention_mask,
+        "pixel_values": pixel_values,
+        "labels": labels,
     }
 
 
 class CaptionDatasetForTraining(Dataset):
-    def __init__(self, dataset: CaptionDataset, processor: AutoProcessor):
+    def __init__(
+        self,
+        dataset: CaptionDataset,
+        processor: AutoProcessor,
+        image_cache: SharedImageCache | None = None,
+        image_backend: str = "pil",
+        pixel_store: PixelStore | None = None,
+    ):
         self.dataset = dataset
+        self.image_cache = image_cache
+        self.image_backend = image_backend
+        # Optional "clip" PixelStore holding the frames after Resize(192)
+        self.pixel_store = pixel_store
+        self.pixel_rows = pixel_store.rows(dataset.captions.image_paths()) if pixel_store else None
         self.image_processor = tv.transforms.Compose(
             [
                 tv.transforms.Resize(192),
@@ -74,15 +98,36 @@ class CaptionDatasetForTraining(Dataset):
                 tv.transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
             ]
         )
+        # The same augmentation on the stored, already resized uint8 pixels
+        self.stored_image_processor = tv.transforms.Compose(
+            [
+                tv.transforms.RandomResizedCrop(192, scale=(0.5, 1.0)),
+                tv.transforms.ConvertImageDtype(torch.float32),
+                tv.transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
+            ]
+        )
         self.processor = processor
 
     def __len__(self):
         return len(self.dataset)
 
+    def lengths(self) -> np.ndarray:
+        """
+        Token count of every caption, for length-bucketed sampling.
+        """
+        tokenizer = self.processor.tokenizer
+        return self.dataset.captions.token_counts("caption", tokenizer, suffix=tokenizer.eos_token)
+
     def __getitem__(self, idx: int) -> dict[str, Any]:
         item = self.dataset[idx]
-        image = Image.open(item["image_path"]).convert("RGB")
-        pixel_values = self.image_processor(image)
+        if self.pixel_store is not None:
+            pixel_values = self.stored_image_processor(self.pixel_store[self.pixel_rows[self.dataset.image_index(idx)]])
+        else:
+            if self.image_cache is not None:
+                image = self.image_cache.load(self.dataset.image_index(idx), item["image_path"], self.image_backend)
+            else:
+                image = load_image(item["image_path"], self.image_backend)
+            pixel_values = self.image_processor(to_pil(image))
         text = item["caption"] + self.processor.tokenizer.eos_token
         text_inputs = self.processor(text=text, return_tensors="pt", padding=True, truncation=True)
         input_ids = text_inputs["input_ids"].squeeze(0).long()
@@ -264,6 +309,11 @@ def train(
     gradient_accumulation_steps: int = 1,
     learning_rate: float = 5e-4,
     num_workers: int = 16,
+    image_cache_mb: float = 1024,
+    group_by_length: bool = False,
+    image_backend: str = "pil",
+    pixel_store: bool = False,
+    image_packs: bool = False,
 ):
     vlm = BaseVLM()
 
@@ -300,7 +350,17 @@ def train(
 
     # load dataset
     train_dataset = CaptionDataset("train", data_dir)
-    train_dataset = CaptionDatasetForTraining(train_dataset, processor)
+    if image_packs:
+        # Read the images from the tar shards of their split instead of one file at a time
+        set_image_packs(ImagePacks.for_dataset(train_dataset))
+    if pixel_store:
+        # Frames after Resize(192) from a memory-mapped store, built on first use
+        store = PixelStore.load_or_build(train_dataset, "clip", image_backend=image_backend)
+        image_cache = None
+    else:
+        store = None
+        image_cache = SharedImageCache.for_dataset(train_dataset, image_cache_mb)
+    train_dataset = CaptionDatasetForTraining(train_dataset, processor, image_cache, image_backend, store)
 
     training_args = TrainingArguments(
         output_dir=output_dir,
@@ -320,12 +380,20 @@ def train(
         dataloader_num_workers=num_workers,
     )
 
-    trainer = Trainer(
+    train_sampler = None
+    if group_by_length:
+        # Batch captions of similar length together to cut padding
+        train_sampler = LengthBucketedSampler(
+            train_dataset.lengths(), per_device_train_batch_size, seed=training_args.seed
+        )
+
+    trainer = SamplerTrainer(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
         data_collator=clip_data_collator,
         compute_loss_func=compute_clip_loss,
+        train_sampler=train_sampler,
     )
 
     trainer.train()
@@ -351,10 +419,18 @@ def demo_train():
     )
 
 
-def test(ckpt_path: str, val_dataset: str = "valid_grader"):
+def test(
+    ckpt_path: str,
+    val_dataset: str = "valid_grader",
+    image_backend: str = "pil",
+    pixel_store: bool = False,
+    image_packs: bool = False,
+):
     import tqdm
 
     testset = MultiChoiceQADataset(val_dataset)
+    if image_packs:
+        set_image_packs(ImagePacks.for_dataset(testset))
 
     clip = load(ckpt_path)
     clip = clip.model.to(device)
@@ -367,13 +443,29 @@ def test(ckpt_path: str, val_dataset: str = "valid_grader"):
             tv.transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
         ]
     )
+    store = None
+    if pixel_store:
+        # Same pixels as image_processor: the store holds the frames after Resize(192)
+        store = PixelStore.load_or_build(testset, "clip", image_backend=image_backend)
+        stored_image_processor = tv.transforms.Compose(
+            [
+                tv.transforms.CenterCrop(192),
+                tv.transforms.ConvertImageDtype(torch.float32),
+                tv.transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
+            ]
+        )
+        table = testset.qa_pairs
+        store_rows = store.rows(table.image_paths())[table.columns["image_index"]]
 
     correct_count = 0
     total_count = 0
 
-    for pair in tqdm.tqdm(testset):
-        image = Image.open(pair["image_path"]).convert("RGB")
-        pixel_values = image_processor(image).unsqueeze(0).to(device).bfloat16()
+    for i, pair in enumerate(tqdm.tqdm(testset)):
+        if store is not None:
+            pixel_values = stored_image_processor(store[store_rows[i]])
+        else:
+            pixel_values = image_processor(to_pil(load_image(pair["image_path"], image_backend)))
+        pixel_values = pixel_values.unsqueeze(0).to(device).bfloat16()
         text_inputs = processor(
             text=[s + processor.tokenizer.eos_token for s in pair["candidates"]],
             return_tensors="pt",
@@ -0,0 +1,192 @@
+"""
+Columnar binary record shards (``.npz``).
+
+A shard stores a list of flat records with a fixed schema as int32 columns plus one
+deduplicated string table. String fields become string ids, lists of strings of any length
+(the multiple-choice ``candidates``) become flat ids plus bounds, and int fields are stored as is:
+
+- ``strings_data`` / ``strings_offsets``: UTF-8 blob of all unique strings and their offsets
+- ``schema``: JSON list of ``{"name", "kind"}`` describing the columns, in record order
+- ``column_<name>``: one int32 column per "str" or "int" field; for a "str_list" field an
+  int64 (count, 2) column of the (start, end) bounds of every record's ids in ``list_<name>``
+- ``list_<name>``: the concatenated int32 string ids of a "str_list" field
+
+Version 1 shards, which stored fixed-length lists as (count, width) id columns, are still read.
+"""
+
+import json
+from array import array
+from collections.abc import Iterator
+from pathlib import Path
+from typing import IO, Any
+
+import numpy as np
+
+FORMAT_VERSION = 2
+
+
+class StringTable:
+    """
+    Interns strings to dense int ids.
+    """
+
+    def __init__(self, strings: list[str] | None = None):
+        self.strings: list[str] = list(strings or [])
+        self.ids: dict[str, int] = {s: i for i, s in enumerate(self.strings)}
+
+    def intern(self, s: str) -> int:
+        string_id = self.ids.get(s)
+        if string_id is None:
+            string_id = self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return string_id
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+    def to_arrays(self) -> tuple[np.ndarray, np.ndarray]:
+        encoded = [s.encode("utf-8") for s in self.strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+    @classmethod
+    def from_arrays(cls, data: np.ndarray, offsets: np.ndarray) -> "StringTable":
+        blob = data.tobytes()
+        bounds = offsets.tolist()
+        return cls([blob[bounds[i] : bounds[i + 1]].decode("utf-8") for i in range(len(bounds) - 1)])
+
+
+def _field_kind(value: Any) -> str:
+    if isinstance(value, str):
+        return "str"
+    if isinstance(value, bool) or not isinstance(value, (int, list, tuple)):
+        raise TypeError(f"Unsupported field value {value!r} for a columnar shard")
+    if isinstance(value, int):
+        return "int"
+    if not all(isinstance(v, str) for v in value):
+        raise TypeError(f"Only lists of strings are supported in a columnar shard, got {value!r}")
+    return "str_list"
+
+
+class ColumnarBuilder:
+    """
+    Accumulates records as compact int32 columns and writes them as one shard.
+    """
+
+    def __init__(self):
+        self.strings = StringTable()
+        self.schema: list[dict[str, Any]] | None = None
+        self.columns: dict[str, array] = {}
+        self.lists: dict[str, array] = {}
+        self.count = 0
+
+    def append(self, record: dict[str, Any]):
+        if self.schema is None:
+            self.schema = []
+            for name, value in record.items():
+                kind = _field_kind(value)
+                self.schema.append({"name": name, "kind": kind})
+                # str_list columns hold the end of every record's ids in lists[name]
+                self.columns[name] = array("q" if kind == "str_list" else "i")
+                if kind == "str_list":
+                    self.lists[name] = array("i")
+
+        if len(record) != len(self.schema):
+            raise ValueError(f"Record {record!r} does not match the shard schema {self.schema}")
+
+        for field in self.schema:
+            value = record[field["name"]]
+            column = self.columns[field["name"]]
+            if field["kind"] == "str":
+                column.append(self.strings.intern(value))
+            elif field["kind"] == "int":
+                column.append(value)
+            else:
+                ids = self.lists[field["name"]]
+                ids.extend(self.strings.intern(v) for v in value)
+                column.append(len(ids))
+
+        self.count += 1
+
+    def save(self, f: IO[bytes]):
+        strings_data, strings_offsets = self.strings.to_arrays()
+        arrays = {
+            "format_version": np.array(FORMAT_VERSION, dtype=np.int32),
+            "schema": np.frombuffer(json.dumps(self.schema or []).encode("utf-8"), dtype=np.uint8),
+            "strings_data": strings_data,
+            "strings_offsets": strings_offsets,
+        }
+        for field in self.schema or []:
+            name = field["name"]
+            if field["kind"] == "str_list":
+                ends = np.frombuffer(self.columns[name], dtype=np.int64)
+                arrays[f"column_{name}"] = np.stack([np.concatenate([[0], ends[:-1]]).astype(np.int64), ends], axis=1)
+                arrays[f"list_{name}"] = np.frombuffer(self.lists[name], dtype=np.int32)
+            else:
+                arrays[f"column_{name}"] = np.frombuffer(self.columns[name], dtype=np.int32)
+        np.savez_compressed(f, **arrays)
+
+
+class ColumnarRecords:
+    """
+    Read-only view of a columnar shard: a string table plus int32 columns. The column of a
+    "str_list" field holds the (start, end) bounds of every record's string ids in lists[name].
+    """
+
+    def __init__(
+        self,
+        strings: list[str],
+        schema: list[dict[str, Any]],
+        columns: dict[str, np.ndarray],
+        lists: dict[str, np.ndarray] | None = None,
+    ):
+        self.strings = strings
+        self.schema = schema
+        self.columns = columns
+        self.lists = lists or {}
+
+    @classmethod
+    def load(cls, path: str | Path) -> "ColumnarRecords":
+        with np.load(path, allow_pickle=False) as shard:
+            version = int(shard["format_version"])
+            if version not in (1, FORMAT_VERSION):
+                raise ValueError(f"Unsupported columnar shard version {version} in {path}")
+            schema = json.loads(shard["schema"].tobytes().decode("utf-8"))
+            strings = StringTable.from_arrays(shard["strings_data"], shard["strings_offsets"]).strings
+            columns = {field["name"]: shard[f"column_{field['name']}"] for field in schema}
+            lists = {}
+            for field in schema:
+                name = field["name"]
+                if field["kind"] != "str_list":
+                    continue
+                if version == 1:
+                    # (count, width) id columns: every record holds width ids
+                    ids = columns[name]
+                    ends = np.arange(1, len(ids) + 1, dtype=np.int64) * ids.shape[1]
+                    lists[name] = ids.reshape(-1).astype(np.int32)
+                    columns[name] = np.stack([ends - ids.shape[1], ends], axis=1)
+                else:
+                    lists[name] = shard[f"list_{name}"]
+        return cls(strings, schema, columns, lists)
+
+    def __len__(self) -> int:
+        if not self.schema:
+            return 0
+        return len(self.columns[self.schema[0]["name"]])
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        values = []
+        for field in self.schema:
+            column = self.columns[field["name"]].tolist()
+            if field["kind"] == "str":
+                values.append([self.strings[i] for i in column])
+            elif field["kind"] == "int":
+                values.append(column)
+            else:
+                ids = self.lists[field["name"]].tolist()
+                values.append([[self.strings[i] for i in ids[start:end]] for start, end in column])
+
+        names = [field["name"] for field in self.schema]
+        for row in zip(*values):
+            yield dict(zip(names, row))
@@ -1,12 +1,200 @@
-import json
 import os
+from array import array
+from collections.abc import Callable
 from dataclasses import dataclass
+from itertools import islice
 from pathlib import Path
 from typing import Any
 
+import numpy as np
+
+from .columnar import ColumnarRecords, StringTable
+from .records import find_record_files, iter_records, split_record_suffix
+
 DATA_DIR = Path(__file__).parent.parent / "data"
 
 
+class RecordTable:
+    """
+    Compact, array-backed storage for dataset records.
+
+    Every distinct string is stored once in a contiguous UTF-8 buffer indexed by a NumPy offset
+    array, and every record is a row of int32 columns. Forked DataLoader workers therefore share
+    a handful of arrays instead of slowly copying millions of Python objects through refcount
+    updates. Field kinds are "str", "int" or "str_list" (a list of strings of any length). The
+    column of a "str_list" field holds the (start, end) bounds of every record's string ids in
+    lists[name].
+    """
+
+    def __init__(
+        self,
+        strings_data: np.ndarray,
+        strings_offsets: np.ndarray,
+        columns: dict[str, np.ndarray],
+        kinds: dict,
+        lists: dict[str, np.ndarray] | None = None,
+    ):
+        self.strings_data = strings_data
+        self.strings_offsets = strings_offsets
+        self.columns = columns
+        self.kinds = kinds
+        self.lists = lists or {}
+
+    @classmethod
+    def load(
+        cls, files: list[Path], kinds: dict[str, str], data_dir: Path | None = None, max_samples: int | None = None
+    ) -> "RecordTable":
+        """
+        Load the given record files, keeping at most max_samples records.
+
+        Records beyond max_samples are never materialized. With data_dir, an extra "image_path"
+        column holds each distinct image_file joined to data_dir, resolved once at load time, and
+        an "image_index" column numbers the distinct images from 0.
+        """
+        strings = StringTable()
+        chunks: dict[str, list[np.ndarray]] = {name: [] for name in kinds}
+        # Flat string ids and per-record lengths of the "str_list" fields
+        list_chunks: dict[str, list[np.ndarray]] = {name: [] for name, kind in kinds.items() if kind == "str_list"}
+        length_chunks: dict[str, list[np.ndarray]] = {name: [] for name in list_chunks}
+        remaining = max_samples
+
+        for path in files:
+            if remaining is not None and remaining <= 0:
+                break
+
+            if split_record_suffix(path)[1] == ".npz":
+                # Columnar shards are remapped into the shared string table without touching rows
+                shard = ColumnarRecords.load(path)
+                if not len(shard):
+                    # Shards written without records have no schema and no columns
+                    continue
+                count = len(shard) if remaining is None else min(len(shard), remaining)
+                remap = np.array([strings.intern(s) for s in shard.strings], dtype=np.int32)
+                for name, kind in kinds.items():
+                    column = shard.columns[name][:count]
+                    if kind == "str_list":
+                        # Columnar shards store lists as flat ids plus (start, end) bounds, like this table
+                        end = int(column[-1, 1]) if count else 0
+                        list_chunks[name].append(remap[shard.lists[name][:end]])
+                        length_chunks[name].append(column[:, 1] - column[:, 0])
+                    else:
+                        chunks[name].append(column if kind == "int" else remap[column])
+            else:
+                records = iter_records(path)
+                if remaining is not None:
+                    records = islice(records, remaining)
+
+                buffers = {name: array("i") for name in kinds}
+                lengths = {name: array("i") for name in list_chunks}
+                count = 0
+                for record in records:
+                    for name, kind in kinds.items():
+                        value = record[name]
+                        if kind == "str":
+                            buffers[name].append(strings.intern(value))
+                        elif kind == "int":
+                            buffers[name].append(value)
+                        else:
+                            lengths[name].append(len(value))
+                            buffers[name].extend(strings.intern(v) for v in value)
+                    count += 1
+
+                for name, buffer in buffers.items():
+                    column = np.frombuffer(buffer, dtype=np.int32)
+                    if name in list_chunks:
+                        list_chunks[name].append(column)
+                        length_chunks[name].append(np.frombuffer(lengths[name], dtype=np.int32))
+                    else:
+                        chunks[name].append(column)
+
+            if remaining is not None:
+                remaining -= count
+
+        columns = {
+            name: np.concatenate(parts) if parts else np.empty((0,), dtype=np.int32)
+            for name, parts in chunks.items()
+            if name not in list_chunks
+        }
+        lists = {}
+        for name in list_chunks:
+            lists[name] = np.concatenate([np.empty(0, dtype=np.int32), *list_chunks[name]]).astype(np.int32)
+            lengths = np.concatenate([np.empty(0, dtype=np.int64), *length_chunks[name]]).astype(np.int64)
+            ends = np.cumsum(lengths)
+            columns[name] = np.stack([ends - lengths, ends], axis=1)
+        kinds = dict(kinds)
+
+        if data_dir is not None and "image_file" in columns:
+            image_ids, inverse = np.unique(columns["image_file"], return_inverse=True)
+            path_ids = np.array(
+                [strings.intern(os.path.join(data_dir, strings.strings[i])) for i in image_ids.tolist()],
+                dtype=np.int32,
+            )
+            columns["image_path"] = path_ids[inverse.reshape(-1)]
+            kinds["image_path"] = "str"
+            # Dense per-image index, shared by all records of an image
+            columns["image_index"] = inverse.reshape(-1).astype(np.int32)
+            kinds["image_index"] = "int"
+
+        strings_data, strings_offsets = strings.to_arrays()
+        return cls(strings_data, strings_offsets, columns, kinds, lists)
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def string(self, string_id: int) -> str:
+        start, end = self.strings_offsets[string_id], self.strings_offsets[string_id + 1]
+        return self.strings_data[start:end].tobytes().decode("utf-8")
+
+    def get(self, idx: int, name: str) -> Any:
+        value = self.columns[name][idx]
+        kind = self.kinds[name]
+        if kind == "str":
+            return self.string(value)
+        if kind == "int":
+            return int(value)
+        start, end = value
+        return [self.string(i) for i in self.lists[name][start:end].tolist()]
+
+    def __getitem__(self, idx: int) -> dict[str, Any]:
+        return {name: self.get(idx, name) for name in self.kinds}
+
+    @property
+    def num_images(self) -> int:
+        """
+        Number of distinct images, i.e. one past the largest "image_index".
+        """
+        image_index = self.columns.get("image_index")
+        return int(image_index.max()) + 1 if image_index is not None and len(image_index) else 0
+
+    def image_paths(self) -> list[str]:
+        """
+        Path of every distinct image, in "image_index" order.
+        """
+        _, first_records = np.unique(self.columns["image_index"], return_index=True)
+        return [self.string(string_id) for string_id in self.columns["image_path"][first_records].tolist()]
+
+    def token_counts(
+        self,
+        name: str,
+        tokenizer,
+        suffix: str = "",
+        template: Callable[[str], str] | None = None,
+        add_special_tokens: bool = True,
+    ) -> np.ndarray:
+        """
+        Number of tokens of a string column (plus suffix) for every record.
+
+        Each distinct string is tokenized once, so this is cheap even for large tables. With a
+        template, the tokens of template(string) + suffix are counted instead.
+        """
+        string_ids, inverse = np.unique(self.columns[name], return_inverse=True)
+        texts = [self.string(string_id) for string_id in string_ids.tolist()]
+        texts = [(template(text) if template is not None else text) + suffix for text in texts]
+        token_ids = tokenizer(texts, add_special_tokens=add_special_tokens)["input_ids"] if texts else []
+        counts = np.array([len(ids) for ids in token_ids], dtype=np.int64)
+        return counts[inverse.reshape(-1)]
+
+
 class VQADataset:
     def __init__(self, split: str, data_dir: Path = None, max_samples: int = None):
         """
@@ -15,25 +203,24 @@ class VQADataset:
         Args:
             split: Dataset split ('train', 'valid_grader', 'train_demo')
             data_dir: Directory containing the dataset (default: DATA_DIR)
+            max_samples: Only load the first max_samples QA pairs
         """
         self.data_dir = data_dir or DATA_DIR
 
-        # Load all QA pairs for the split
-        self.qa_pairs = []
-
-        # Find all QA pair files for the split
-        qa_files = list(self.data_dir.glob(f"{split}/*_qa_pairs.json"))
-
-        for qa_file in qa_files:
-            with open(qa_file) as f:
-                qa_pairs = json.load(f)
-                self.qa_pairs.extend(qa_pairs)
+        # Find all QA pair files (.json, .jsonl, .jsonl.gz, .jsonl.zst, .npz) for the split
+        qa_files = find_record_files(Path(self.data_dir) / split, "*_qa_pairs")
 
-        if max_samples is not None:
-            self.qa_pairs = self.qa_pairs[:max_samples]
+        # Load all QA pairs for the split into compact, fork-friendly arrays
+        self.qa_pairs = RecordTable.load(
+            qa_files, {"image_file": "str", "question": "str", "answer": "str"}, self.data_dir, max_samples
+        )
 
         print(f"Loaded {len(self.qa_pairs)} QA pairs for {split} split")
 
+    @property
+    def records(self) -> RecordTable:
+        return self.qa_pairs
+
     def __len__(self):
         return len(self.qa_pairs)
 
@@ -47,69 +234,89 @@ class VQADataset:
         Returns:
             Dictionary containing the QA pair and image path
         """
-        qa_pair = self.qa_pairs[idx]
-
-        # Construct the full path to the image
-        image_path = os.path.join(self.data_dir, qa_pair["image_file"])
-
         return {
-            "image_path": image_path,
-            "question": qa_pair["question"],
-            "answer": qa_pair["answer"],
+            "image_path": self.qa_pairs.get(idx, "image_path"),
+            "question": self.qa_pairs.get(idx, "question"),
+            "answer": self.qa_pairs.get(idx, "answer"),
         }
 
+    @property
+    def num_images(self) -> int:
+        return self.qa_pairs.num_images
+
+    def image_index(self, idx: int) -> int:
+        """
+        Index of the record's image among the distinct images of the dataset.
+        """
+        return self.qa_pairs.get(idx, "image_index")
+
 
 class CaptionDataset:
     def __init__(self, split: str, data_dir: Path = None, max_samples: int = None):
         self.data_dir = data_dir or DATA_DIR
 
-        self.captions = []
-
-        caption_files = list(self.data_dir.glob(f"{split}/*_captions.json"))
+        caption_files = find_record_files(Path(self.data_dir) / split, "*_captions")
 
-        for caption_file in caption_files:
-            with open(caption_file) as f:
-                captions = json.load(f)
-                self.captions.extend(captions)
-
-        if max_samples is not None:
-            self.captions = self.captions[:max_samples]
+        self.captions = RecordTable.load(
+            caption_files, {"image_file": "str", "caption": "str"}, self.data_dir, max_samples
+        )
 
         print(f"Loaded {len(self.captions)} captions for {split} split")
 
+    @property
+    def records(self) -> RecordTable:
+        return self.captions
+
     def __len__(self):
         return len(self.captions)
 
     def __getitem__(self, idx: int) -> dict[str, Any]:
-        caption = self.captions[idx]
-        image_path = os.path.join(self.data_dir, caption["image_file"])
         return {
-            "image_path": image_path,
-            "caption": caption["caption"],
+            "image_path": self.captions.get(idx, "image_path"),
+            "caption": self.captions.get(idx, "caption"),
         }
 
+    @property
+    def num_images(self) -> int:
+        return self.captions.num_images
+
+    def image_index(self, idx: int) -> int:
+        """
+        Index of the record's image among the distinct images of the dataset.
+        """
+        return self.captions.get(idx, "image_index")
+
 
 class MultiChoiceQADataset:
     def __init__(self, split: str, data_dir: Path = None, max_samples: int = None):
         self.data_dir = data_dir or DATA_DIR
 
-        metafile = f"{self.data_dir}/{split}/all_mc_qas.json"
+        # all_mc_qas.json, or its .jsonl / .jsonl.gz / .jsonl.zst / .npz variants
+        mc_files = find_record_files(Path(self.data_dir) / split, "all_mc_qas")
+        if not mc_files:
+            raise FileNotFoundError(f"No all_mc_qas file found in {self.data_dir}/{split}")
 
-        with open(metafile) as f:
-            self.qa_pairs = json.load(f)
+        self.qa_pairs = RecordTable.load(
+            mc_files,
+            {"image_file": "str", "candidates": "str_list", "correct_index": "int"},
+            self.data_dir,
+            max_samples,
+        )
 
         print(f"Loaded {len(self.qa_pairs)} QA pairs for {split} split")
 
+    @property
+    def records(self) -> RecordTable:
+        return self.qa_pairs
+
     def __len__(self):
         return len(self.qa_pairs)
 
     def __getitem__(self, idx: int) -> dict[str, Any]:
-        qa_pair = self.qa_pairs[idx]
-        image_path = os.path.join(self.data_dir, qa_pair["image_file"])
         return {
-            "image_path": image_path,
-            "candidates": qa_pair["candidates"],
-            "correct_index": qa_pair["correct_index"],
+            "image_path": self.qa_pairs.get(idx, "image_path"),
+            "candidates": self.qa_pairs.get(idx, "candidates"),
+            "correct_index": self.qa_pairs.get(idx, "correct_index"),
         }
 
 
@@ -199,6 +406,8 @@ def benchmark(model, dataset: VQADataset, max_samples: int = None) -> VQABenchma
     import random
 
     sample_indices = random.sample(range(len(dataset)), dataset_size)
+    # Questions about the same image share a batch, so the model can encode the image once
+    sample_indices.sort(key=dataset.image_index)
 
     # Extract questions and image paths
     questions = [dataset[i]["question"] for i in sample_indices]
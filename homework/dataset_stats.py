@@ -0,0 +1,224 @@
+"""
+Streaming statistics of built QA and caption files.
+
+Every record is looked at once and only counters and fixed-size quantile sketches are kept, so
+memory does not grow with the size of a split. Per-image counts assume that the records of an
+image are contiguous, which holds for every builder in this directory.
+"""
+
+import json
+import random
+import re
+from collections import Counter
+from pathlib import Path
+
+from balance import question_template
+from generate_captions import caption_family
+from records import find_record_files, iter_records
+
+COUNT_QUESTION = "How many karts are there in the scenario?"
+TRACK_QUESTION = "What track is this?"
+COUNT_CAPTION = re.compile(r"^There are (\d+) karts in the scene\.$")
+TRACK_CAPTION = re.compile(r"^The track is (.+)\.$")
+KART_CAPTION = re.compile(r"^.+ (is (?:the ego car|left of|right of|in front of|behind)(?: the ego car)?\.)$")
+
+
+class QuantileSketch:
+    """
+    Approximate quantiles of a stream in bounded memory (a simplified KLL sketch).
+
+    Values are buffered in levels of at most k items. A full level is sorted and every other
+    item, starting at a random offset, is promoted to the next level with twice the weight, so
+    memory stays O(k log(n / k)) and the rank error is a few percent for k = 200.
+    """
+
+    def __init__(self, k: int = 200, seed: int = 0):
+        self.k = k
+        self.rng = random.Random(seed)
+        self.levels: list[list[float]] = [[]]
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def add(self, value: float):
+        self.levels[0].append(value)
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+        if len(self.levels[0]) >= self.k:
+            self._compact()
+
+    def _compact(self):
+        for height in range(len(self.levels)):
+            level = self.levels[height]
+            if len(level) < self.k:
+                break
+            level.sort()
+            promoted = level[self.rng.randint(0, 1) :: 2]
+            level.clear()
+            if height + 1 == len(self.levels):
+                self.levels.append([])
+            self.levels[height + 1].extend(promoted)
+
+    def quantiles(self, qs: list[float]) -> list[float]:
+        items = sorted((value, 1 << height) for height, level in enumerate(self.levels) for value in level)
+        if not items:
+            return [float("nan")] * len(qs)
+
+        weight = sum(w for _, w in items)
+        results = []
+        for q in qs:
+            target, cumulative = q * weight, 0
+            for value, w in items:
+                cumulative += w
+                if cumulative >= target:
+                    break
+            results.append(value)
+        return results
+
+    def summary(self) -> dict[str, float]:
+        if self.count == 0:
+            return {"count": 0}
+        p50, p90, p99 = self.quantiles([0.5, 0.9, 0.99])
+        return {
+            "count": self.count,
+            "min": self.min,
+            "mean": round(self.total / self.count, 3),
+            "p50": p50,
+            "p90": p90,
+            "p99": p99,
+            "max": self.max,
+        }
+
+
+class _PerImage:
+    """
+    Records per image, counted over runs of identical image_file values.
+    """
+
+    def __init__(self):
+        self.sketch = QuantileSketch()
+        self.image = None
+        self.run = 0
+
+    def add(self, image_file: str):
+        if image_file != self.image:
+            self.flush()
+            self.image = image_file
+        self.run += 1
+
+    def flush(self):
+        if self.run:
+            self.sketch.add(self.run)
+        self.run = 0
+
+
+def qa_stats(files: list[Path]) -> dict:
+    records = 0
+    per_image = _PerImage()
+    templates = Counter()
+    answers: dict[str, Counter] = {}
+    karts_per_view = QuantileSketch()
+    karts_histogram = Counter()
+    tracks = Counter()
+
+    for path in files:
+        for record in iter_records(path):
+            records += 1
+            per_image.add(record["image_file"])
+
+            template = question_template(record["question"])
+            templates[template] += 1
+            answers.setdefault(template, Counter())[record["answer"]] += 1
+
+            if record["question"] == COUNT_QUESTION and record["answer"].isdigit():
+                karts_per_view.add(int(record["answer"]))
+                karts_histogram[record["answer"]] += 1
+            elif record["question"] == TRACK_QUESTION:
+                tracks[record["answer"]] += 1
+    per_image.flush()
+
+    return {
+        "records": records,
+        "images": per_image.sketch.count,
+        "questions_per_image": per_image.sketch.summary(),
+        "templates": dict(templates.most_common()),
+        "answers": {template: dict(counts.most_common()) for template, counts in sorted(answers.items())},
+        "karts_per_view": {**karts_per_view.summary(), "histogram": dict(sorted(karts_histogram.items(), key=_numeric))},
+        "tracks": dict(tracks.most_common()),
+    }
+
+
+def caption_stats(files: list[Path]) -> dict:
+    records = 0
+    per_image = _PerImage()
+    families = Counter()
+    templates = Counter()
+    karts_per_view = QuantileSketch()
+    karts_histogram = Counter()
+    tracks = Counter()
+
+    for path in files:
+        for record in iter_records(path):
+            records += 1
+            per_image.add(record["image_file"])
+
+            caption = record["caption"]
+            families[caption_family(caption)] += 1
+
+            if match := COUNT_CAPTION.match(caption):
+                karts_per_view.add(int(match.group(1)))
+                karts_histogram[match.group(1)] += 1
+                templates["There are {n} karts in the scene."] += 1
+            elif match := TRACK_CAPTION.match(caption):
+                tracks[match.group(1)] += 1
+                templates["The track is {track}."] += 1
+            elif match := KART_CAPTION.match(caption):
+                templates["{kart} " + match.group(1)] += 1
+            else:
+                templates[caption] += 1
+    per_image.flush()
+
+    return {
+        "records": records,
+        "images": per_image.sketch.count,
+        "captions_per_image": per_image.sketch.summary(),
+        "families": dict(families.most_common()),
+        "templates": dict(templates.most_common()),
+        "karts_per_view": {**karts_per_view.summary(), "histogram": dict(sorted(karts_histogram.items(), key=_numeric))},
+        "tracks": dict(tracks.most_common()),
+    }
+
+
+def _numeric(item: tuple[str, int]) -> int:
+    return int(item[0])
+
+
+def stats(root_dir="../data", split="train", output=None, indent=None):
+    """
+    Profile the *_qa_pairs and *_captions files of a split and print a JSON report.
+
+    Args:
+        root_dir: Base data directory
+        split: Dataset split to profile
+        output: Also write the report to this file
+        indent: JSON indentation, None for a compact single-line report
+    """
+    split_dir = Path(root_dir) / split
+    qa_files = find_record_files(split_dir, "*_qa_pairs")
+    caption_files = find_record_files(split_dir, "*_captions")
+
+    report = {"split": split}
+    if qa_files:
+        report["qa_pairs"] = {"files": [p.name for p in qa_files], **qa_stats(qa_files)}
+    if caption_files:
+        report["captions"] = {"files": [p.name for p in caption_files], **caption_stats(caption_files)}
+
+    text = json.dumps(report, indent=indent)
+    print(text)
+
+    if output is not None:
+        Path(output).write_text(text + "\n")
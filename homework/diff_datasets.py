@@ -0,0 +1,163 @@
+"""
+Hash-indexed comparison of a golden and a generated dataset file.
+
+QA records are keyed by (image_file, question) and compared on their answer, caption records
+by (image_file, caption). A golden multiple-choice file (all_mc_qas.json) is compared through
+the correct candidate of every set, so every other generated caption shows up as extra.
+The generated side is indexed in one pass, the golden side is streamed against it in another,
+and the result is a JSON summary with matched, wrong, missing and extra counts, overall and
+per question type (or caption family).
+"""
+
+import json
+from collections import Counter, defaultdict
+from collections.abc import Iterator
+from pathlib import Path
+
+import fire
+
+from balance import question_template
+from generate_captions import caption_family
+from records import iter_records
+
+OUTCOMES = ("matched", "wrong", "missing", "extra")
+
+
+def record_kind(record: dict) -> str:
+    if "question" in record:
+        return "qa"
+    if "caption" in record or "candidates" in record:
+        return "captions"
+    raise ValueError(f"Cannot tell whether {record!r} is a QA or a caption record")
+
+
+def map_split(image_file: str, split_map: tuple[str, str] | None) -> str:
+    """
+    Rewrite the split directory of an image path, e.g. valid/00000_00_im.jpg -> train/...
+    """
+    if split_map is None:
+        return image_file
+    split, _, rest = image_file.partition("/")
+    return f"{split_map[1]}/{rest}" if split == split_map[0] and rest else image_file
+
+
+def keyed_records(paths: list[Path], kind: str, split_map=None) -> Iterator[tuple[tuple[str, str], str | None]]:
+    """
+    Yield ((image_file, question or caption), answer) for every record; captions have no answer.
+    """
+    for path in paths:
+        for record in iter_records(path):
+            image_file = map_split(record["image_file"], split_map)
+            if kind == "qa":
+                yield (image_file, record["question"]), record["answer"]
+            elif "candidates" in record:
+                yield (image_file, record["candidates"][record["correct_index"]]), None
+            else:
+                yield (image_file, record["caption"]), None
+
+
+def _paths(paths: str | Path | list | tuple) -> list[Path]:
+    if isinstance(paths, (str, Path)):
+        paths = [paths]
+    return [Path(p) for p in paths]
+
+
+def diff_records(golden, generated, kind="auto", split_map=None, show=5) -> tuple[dict, dict[str, list]]:
+    """
+    Compare golden against generated records in a single linear pass over each file.
+
+    Returns:
+        The summary and up to `show` example records per wrong / missing / extra outcome
+    """
+    golden_paths, generated_paths = _paths(golden), _paths(generated)
+    if isinstance(split_map, str):
+        split_map = tuple(split_map.split(":", 1))
+
+    if kind == "auto":
+        first = next(iter_records(golden_paths[0]), None)
+        kind = record_kind(first) if first is not None else "qa"
+    record_type = (lambda key: question_template(key[1])) if kind == "qa" else (lambda key: caption_family(key[1]))
+
+    # Index the generated side: key -> answer (None for captions)
+    index: dict[tuple[str, str], str | None] = {}
+    duplicates = 0
+    generated_count = 0
+    images = set()
+    for key, answer in keyed_records(generated_paths, kind):
+        generated_count += 1
+        if key in index:
+            duplicates += 1
+            continue
+        index[key] = answer
+        images.add(key[0])
+
+    totals = Counter()
+    by_type: dict[str, Counter] = defaultdict(Counter)
+    examples: dict[str, list] = {outcome: [] for outcome in OUTCOMES[1:]}
+    golden_count = 0
+
+    def record(outcome: str, key: tuple[str, str], example):
+        totals[outcome] += 1
+        by_type[record_type(key)][outcome] += 1
+        if outcome != "matched" and len(examples[outcome]) < show:
+            examples[outcome].append(example)
+
+    for key, answer in keyed_records(golden_paths, kind, split_map):
+        golden_count += 1
+        if key not in index:
+            # A caption of a known image that was not generated counts as a wrong caption
+            outcome = "wrong" if kind == "captions" and key[0] in images else "missing"
+            record(outcome, key, {"image_file": key[0], "expected": key[1]})
+            continue
+
+        generated_answer = index.pop(key)
+        if answer == generated_answer:
+            record("matched", key, None)
+        else:
+            record("wrong", key, {"image_file": key[0], "question": key[1], "expected": answer, "got": generated_answer})
+
+    # Whatever was not matched by a golden record is extra
+    for key, answer in index.items():
+        record("extra", key, {"image_file": key[0], "record": key[1], "answer": answer})
+
+    summary = {
+        "kind": kind,
+        "golden": [str(p) for p in golden_paths],
+        "generated": [str(p) for p in generated_paths],
+        "golden_records": golden_count,
+        "generated_records": generated_count,
+        "duplicates": duplicates,
+        **{outcome: totals[outcome] for outcome in OUTCOMES},
+        "by_type": {t: {outcome: counts[outcome] for outcome in OUTCOMES} for t, counts in sorted(by_type.items())},
+    }
+
+    return summary, examples
+
+
+def diff(golden, generated, kind="auto", split_map=None, show=5, output=None):
+    """
+    Compare a golden and a generated dataset file and print a JSON summary.
+
+    Args:
+        golden: Golden record file (QA pairs, captions or multiple-choice sets)
+        generated: Generated record file, or a list of files that are concatenated
+        kind: "qa", "captions" or "auto" to detect it from the first golden record
+        split_map: Optional "golden_split:generated_split" to compare e.g. the valid grader
+            files against a train build ("valid:train")
+        show: Print up to this many wrong / missing / extra records as examples
+        output: Also write the JSON summary to this file
+    """
+    summary, examples = diff_records(golden, generated, kind, split_map, show)
+
+    for outcome, items in examples.items():
+        for item in items:
+            print(f"{outcome}: {item}")
+    print(json.dumps(summary, indent=2))
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    fire.Fire(diff)
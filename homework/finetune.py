@@ -1,15 +1,23 @@
 from pathlib import Path
 
+import numpy as np
 import torch
 import torch.nn as nn
 from peft import LoraConfig, TaskType, get_peft_model
 from PIL import Image
 from torch.utils.data import DataLoader, Dataset
 from torch.utils.tensorboard import SummaryWriter
-from transformers import AutoProcessor, Trainer, TrainingArguments
+from transformers import AutoProcessor, TrainingArguments
 
-from .base_vlm import BaseVLM
+from .base_vlm import BaseVLM, with_expanded_images, with_image_hidden_states
 from .data import VQADataset, benchmark
+from .image_cache import SharedImageCache
+from .image_io import load_image, set_image_packs
+from .image_packs import ImagePacks
+from .pixel_store import PixelStore
+from .samplers import ImageGroupedSampler, LengthBucketedSampler, SamplerTrainer, image_groups
+from .token_cache import TokenCache, follow_up_prompt, tokenize_follow_up, tokenize_qa
+from .vision_cache import VisionEmbeddingCache
 
 DEVICE = "cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu"
 
@@ -33,78 +41,236 @@ def load(model_name: str = "vlm_model") -> BaseVLM:
 def custom_data_collator(features: list[dict[str, torch.Tensor]]) -> dict[str, torch.Tensor]:
     # Get max sequence length
     max_length = max(f["input_ids"].shape[0] for f in features)
+    batch_size = len(features)
 
-    def pad_tensor(tensor, pad_value):
-        return torch.cat([tensor, torch.full((max_length - tensor.shape[0],), pad_value, dtype=tensor.dtype)])
+    # One padded output tensor per field, filled in place
+    input_ids = torch.full((batch_size, max_length), processor.tokenizer.eos_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((batch_size, max_length), dtype=torch.long)
+    labels = torch.full((batch_size, max_length), -100, dtype=torch.long)
 
-    input_ids = torch.stack([pad_tensor(f["input_ids"], pad_value=processor.tokenizer.eos_token_id) for f in features])
-    attention_mask = torch.stack([pad_tensor(f["attention_mask"], pad_value=0) for f in features])
-    labels = torch.stack([pad_tensor(f["labels"], pad_value=-100) for f in features])
-    pixel_values = torch.stack([f["pixel_values"] for f in features])  # assume all are same shape
+    for i, f in enumerate(features):
+        length = f["input_ids"].shape[0]
+        input_ids[i, :length] = f["input_ids"]
+        attention_mask[i, :length] = f["attention_mask"]
+        labels[i, :length] = f["labels"]
 
-    return {
+    batch = {
         "input_ids": input_ids,
         "attention_mask": attention_mask,
         "labels": labels,
-        "pixel_values": pixel_values,
     }
 
+    if "image_hidden_states" in features[0]:
+        # Precomputed image-token embeddings, one row per image token of the batch in order
+        batch["image_hidden_states"] = torch.cat([f["image_hidden_states"] for f in features])
+    else:
+        images = features
+        if "image_index" in features[0]:
+            # Every distinct image once, image_map[i] is the pixel_values row of sequence i's image
+            distinct = {}
+            for f in features:
+                distinct.setdefault(f["image_index"], f)
+            rows = {image_index: row for row, image_index in enumerate(distinct)}
+            batch["image_map"] = torch.tensor([rows[f["image_index"]] for f in features])
+            images = list(distinct.values())
+
+        first_pixels = images[0]["pixel_values"]  # assume all are same shape
+        pixel_values = torch.empty((len(images), *first_pixels.shape), dtype=first_pixels.dtype)
+        for i, f in enumerate(images):
+            pixel_values[i] = f["pixel_values"]
+        batch["pixel_values"] = pixel_values
+
+    return batch
+
 
 class VQADatasetForTraining(Dataset):
-    def __init__(self, dataset: VQADataset, processor: AutoProcessor):
+    def __init__(
+        self,
+        dataset: VQADataset,
+        processor: AutoProcessor,
+        token_cache: bool = False,
+        image_cache: SharedImageCache | None = None,
+        pack_questions: int = 0,
+        vision_cache: VisionEmbeddingCache | None = None,
+        image_backend: str = "pil",
+        pixel_store: PixelStore | None = None,
+    ):
+        """
+        Args:
+            dataset: QA pairs to train on
+            processor: Processor of the model
+            token_cache: Read the token ids from a pre-tokenized TokenCache (built on first use)
+                instead of running the processor on the text in every __getitem__ call
+            image_cache: Optional decoded-image cache shared by the DataLoader workers
+            pack_questions: Pack up to this many QA pairs of one image into a single multi-turn
+                example, so the image is encoded once for all of them (0 gives one QA pair per
+                example). The loss covers every answer and nothing else.
+            vision_cache: Precomputed image-token embeddings of a frozen vision tower. Examples
+                then carry "image_hidden_states" instead of "pixel_values" and no image is loaded.
+            image_backend: image_io backend that decodes the images
+            pixel_store: Read the resized pixels of the images from a "smolvlm" PixelStore instead
+                of decoding and resizing them (takes precedence over image_cache)
+        """
         self.dataset = dataset
         self.processor = processor
+        self.image_cache = image_cache
+        self.vision_cache = vision_cache
+        self.image_backend = image_backend
+        self.pixel_store = pixel_store
+        # Store row of every image of the dataset
+        self.pixel_rows = pixel_store.rows(dataset.qa_pairs.image_paths()) if pixel_store else None
         self.features = ["image", "question", "answer"]
         self.image_token_id = self.processor.tokenizer.additional_special_tokens_ids[
             self.processor.tokenizer.additional_special_tokens.index("<image>")
         ]
         self.processor.tokenizer.pad_token = self.processor.tokenizer.eos_token
+        self.token_cache = TokenCache.load_or_build(dataset, processor) if token_cache else None
+
+        # Records of pack i are pack_records[pack_offsets[i] : pack_offsets[i + 1]]
+        self.pack_records = self.pack_offsets = None
+        if pack_questions > 0:
+            self.pack_records, group_ids = image_groups(dataset.qa_pairs.columns["image_index"], pack_questions)
+            num_packs = int(group_ids[-1]) + 1 if len(group_ids) else 0
+            self.pack_offsets = np.searchsorted(group_ids, np.arange(num_packs + 1))
+
+    def lengths(self) -> np.ndarray:
+        """
+        Sequence length of every example, for length-bucketed sampling.
+
+        Exact with the token cache. Without it, the question and answer tokens counted separately
+        plus the prompt and image tokens every example shares, which can be off by a token where
+        the tokenizer merges across the boundary of the question or the answer. Packed examples
+        add up the lengths of the turns that __getitem__ keeps.
+        """
+        table = self.dataset.qa_pairs
+        tokenizer = self.processor.tokenizer
+        if self.token_cache is not None:
+            lengths = self.token_cache.lengths()
+        else:
+            # Chat template, image tokens and end-of-utterance token of an empty QA pair
+            template_length = len(tokenize_qa(self.processor, Image.new("RGB", (150, 100)), "", "")["input_ids"])
+            lengths = (
+                table.token_counts("question", tokenizer, add_special_tokens=False)
+                + table.token_counts("answer", tokenizer, add_special_tokens=False)
+                + template_length
+            )
+
+        if self.pack_offsets is None:
+            return lengths
+        if len(self.pack_records) == 0:
+            return lengths[:0]
+
+        # Length of every record as a follow-up turn (see tokenize_follow_up)
+        prompt_lengths = table.token_counts(
+            "question", tokenizer, template=lambda q: follow_up_prompt(self.processor, q), add_special_tokens=False
+        )
+        turn_lengths = prompt_lengths + table.token_counts("answer", tokenizer, add_special_tokens=False) + 1
+
+        # Running length within every pack; turns past model_max_length are dropped
+        starts = self.pack_offsets[:-1]
+        is_first = np.zeros(len(self.pack_records), dtype=bool)
+        is_first[starts] = True
+        steps = np.where(is_first, lengths[self.pack_records], turn_lengths[self.pack_records])
+        running = np.cumsum(steps)
+        running -= np.repeat(running[starts] - steps[starts], np.diff(self.pack_offsets))
+        max_length = min(tokenizer.model_max_length, np.iinfo(np.int64).max)
+        kept = np.where(is_first | (running <= max_length), running, 0)
+        return np.maximum.reduceat(kept, starts)
 
     def __len__(self):
+        if self.pack_offsets is not None:
+            return len(self.pack_offsets) - 1
         return len(self.dataset)
 
     def __getitem__(self, idx: int) -> dict:
+        if self.pack_offsets is None:
+            return self.example(idx)
+
+        # The first record carries the image, the others follow as more chat turns
+        records = self.pack_records[self.pack_offsets[idx] : self.pack_offsets[idx + 1]].tolist()
+        features = self.example(records[0])
+        input_ids, labels = [features["input_ids"]], [features["labels"]]
+        length = len(features["input_ids"])
+
+        for record in records[1:]:
+            item = self.dataset[record]
+            turn = tokenize_follow_up(self.processor, item["question"], item["answer"])
+            length += len(turn["input_ids"])
+            if length > self.processor.tokenizer.model_max_length:
+                break
+            input_ids.append(turn["input_ids"])
+            labels.append(turn["labels"])
+
+        features["input_ids"] = torch.cat(input_ids)
+        features["labels"] = torch.cat(labels)
+        features["attention_mask"] = torch.ones_like(features["input_ids"])
+        return features
+
+    def example(self, idx: int) -> dict:
+        """
+        Features of a single QA pair.
+        """
         item = self.dataset[idx]
-        image = Image.open(item["image_path"]).convert("RGB")
-        # Prepare input text in chat format
-        input_message = [{"role": "user", "content": [{"type": "image"}, {"type": "text", "text": item["question"]}]}]
-        prompt = self.processor.apply_chat_template(input_message, add_generation_prompt=True)
-        full_text = prompt + item["answer"]  # append the answer to the prompt
-
-        inputs = self.processor(
-            images=image,
-            text=full_text,
-            return_tensors="pt",
-            padding=True,
-            truncation=True,
-            padding_side="left",
-        )
-
-        input_ids = inputs["input_ids"].squeeze(0)
-        attention_mask = inputs["attention_mask"].squeeze(0)
-
-        # Get answer length
-        answer_ids = self.processor(
-            images=None, text=item["answer"], return_tensors="pt", truncation=True
-        ).input_ids.squeeze(0)
-        answer_len = len(answer_ids)
-
-        # Prepare labels: mask everything except the answer tokens
-        labels = input_ids.clone()
-        labels[:-answer_len] = -100  # only keep loss on answer
+        image_index = self.dataset.image_index(idx)
+
+        if self.vision_cache is not None:
+            # Cached embeddings of the image in place of its pixels
+            features = self.text_features(idx, item)
+            features["image_hidden_states"] = self.vision_cache[image_index]
+            return features
+
+        if self.pixel_store is not None:
+            features = self.text_features(idx, item)
+            features["pixel_values"] = self.pixel_store.pixel_values(self.pixel_rows[image_index])
+            features["image_index"] = image_index
+            return features
+
+        if self.image_cache is not None:
+            image = self.image_cache.load(image_index, item["image_path"], self.image_backend)
+        else:
+            image = load_image(item["image_path"], self.image_backend)
+        image = image.numpy()
+
+        if self.token_cache is None:
+            features = tokenize_qa(self.processor, image, item["question"], item["answer"])
+        else:
+            # Token ids come from the cache, only the image still goes through the processor
+            features = self.token_cache[idx]
+            pixel_values = self.processor.image_processor([[image]], return_tensors="pt")["pixel_values"]
+            features["pixel_values"] = pixel_values.squeeze(0)
+
+        # Lets the collator send every distinct image of a batch through the vision tower once
+        features["image_index"] = image_index
+        return features
+
+    def text_features(self, idx: int, item: dict) -> dict:
+        """
+        Token ids of a single QA pair, for examples whose image comes precomputed.
+        """
+        if self.token_cache is not None:
+            return self.token_cache[idx]
+
+        # The pixels do not affect the token ids, so a blank image stands in for the real one
+        features = tokenize_qa(self.processor, Image.new("RGB", (150, 100)), item["question"], item["answer"])
+        del features["pixel_values"]
+        return features
+
+
+class VQATrainer(SamplerTrainer):
+    """
+    Trainer that encodes every distinct image of a batch once, see custom_data_collator.
 
-        # Ensure EOS token is at the end of the sequence
-        if input_ids[-1] != self.processor.tokenizer.eos_token_id:
-            input_ids = torch.cat([input_ids, torch.tensor([self.processor.tokenizer.eos_token_id])])
-            attention_mask = torch.cat([attention_mask, torch.tensor([1])])
-            labels = torch.cat([labels, torch.tensor([self.processor.tokenizer.eos_token_id])])
+    Only an unwrapped model is sent through the vision tower ahead of its forward. Under
+    DataParallel or DistributedDataParallel the vision tower has to run inside the wrapped
+    forward, so every sequence gets its own copy of its image again.
+    """
 
-        return {
-            "input_ids": input_ids.long(),
-            "attention_mask": attention_mask.long(),
-            "pixel_values": inputs["pixel_values"].squeeze(0),
-            "labels": labels.long(),
-        }
+    def compute_loss(self, model, inputs, *args, **kwargs):
+        if self.accelerator.unwrap_model(model) is model:
+            inputs = with_image_hidden_states(model, inputs)
+        else:
+            inputs = with_expanded_images(inputs)
+        return super().compute_loss(model, inputs, *args, **kwargs)
 
 
 def train(
@@ -119,6 +285,15 @@ def train(
     lora_alpha: int = 32,
     lora_dropout: float = 0.0,
     num_workers: int = 16,
+    token_cache: bool = False,
+    image_cache_mb: float = 1024,
+    questions_per_image: int = 0,
+    group_by_length: bool = False,
+    pack_questions: int = 0,
+    vision_cache: bool = False,
+    image_backend: str = "pil",
+    pixel_store: bool = False,
+    image_packs: bool = False,
 ):
     """
     Fine-tune a VLM model using LoRA.
@@ -134,7 +309,31 @@ def train(
         lora_r: LoRA rank
         lora_alpha: LoRA alpha
         lora_dropout: LoRA dropout
+        token_cache: Tokenize every (question, answer) pair once up front into a memory-mapped
+            cache under <data_dir>/.token_cache (built on first use) instead of in every
+            __getitem__ call
+        image_cache_mb: Shared-memory budget for decoded images reused across samples and
+            DataLoader workers (0 disables the cache)
+        questions_per_image: Put up to this many questions about the same image next to each
+            other in the batches (0 keeps uniform random sampling)
+        group_by_length: Batch records of similar sequence length together to cut padding
+            (cannot be combined with questions_per_image)
+        pack_questions: Train on multi-turn examples of up to this many QA pairs of one image,
+            with the loss on all answers (0 trains on one QA pair per example)
+        vision_cache: Freeze the vision tower and connector (LoRA on the text model only) and
+            precompute their image-token embeddings once per image into a memory-mapped cache
+            under the data directory, so training never runs the vision tower
+        image_backend: Image decoder, "pil", "opencv" or "torchvision" (see image_io)
+        pixel_store: Read the pixels from a memory-mapped store of the dataset's images at processor
+            resolution (built on first use) instead of decoding and resizing them every epoch
+        image_packs: Read the images from the tar shards of the split holding them (see image_packs,
+            packed ahead of time) instead of opening every image file
     """
+    if questions_per_image > 0 and group_by_length:
+        raise ValueError("questions_per_image and group_by_length cannot be combined")
+    if questions_per_image > 0 and pack_questions > 0:
+        raise ValueError("questions_per_image and pack_questions cannot be combined, packing already groups by image")
+
     vlm = BaseVLM()
 
     # Create output directory
@@ -150,6 +349,17 @@ def train(
     processor = vlm.processor
     model = vlm.model
 
+    vqa_dataset = VQADataset(train_dataset_name, data_dir)
+    if image_packs:
+        set_image_packs(ImagePacks.for_dataset(vqa_dataset))
+    if vision_cache:
+        # Embed the images with the frozen vision tower once, before LoRA is applied
+        vision_embeddings = VisionEmbeddingCache.load_or_build(
+            vqa_dataset, model, processor, image_backend=image_backend
+        )
+    else:
+        vision_embeddings = None
+
     # Configure LoRA
     peft_config = LoraConfig(
         task_type=TaskType.CAUSAL_LM,
@@ -158,6 +368,8 @@ def train(
         lora_alpha=lora_alpha,
         lora_dropout=lora_dropout,
         target_modules="all-linear",
+        # A frozen vision tower and connector get no adapters
+        exclude_modules=r".*(vision_model|connector)\..*" if vision_cache else None,
         bias="none",
     )
 
@@ -169,9 +381,13 @@ def train(
     model.train()
 
     # Prepare datasets
-    train_dataset = VQADataset(train_dataset_name, data_dir)
-
-    train_dataset = VQADatasetForTraining(train_dataset, processor)
+    store = None
+    if pixel_store and not vision_cache:
+        store = PixelStore.load_or_build(vqa_dataset, "smolvlm", processor, image_backend)
+    image_cache = None if vision_cache or store else SharedImageCache.for_dataset(vqa_dataset, image_cache_mb)
+    train_dataset = VQADatasetForTraining(
+        vqa_dataset, processor, token_cache, image_cache, pack_questions, vision_embeddings, image_backend, store
+    )
 
     if processor.tokenizer.pad_token is None:
         processor.tokenizer.pad_token = processor.tokenizer.eos_token
@@ -194,12 +410,23 @@ def train(
         dataloader_num_workers=num_workers,
     )
 
+    train_sampler = None
+    if questions_per_image > 0:
+        train_sampler = ImageGroupedSampler(
+            vqa_dataset.qa_pairs.columns["image_index"], questions_per_image, seed=training_args.seed
+        )
+    elif group_by_length:
+        train_sampler = LengthBucketedSampler(
+            train_dataset.lengths(), per_device_train_batch_size, seed=training_args.seed
+        )
+
     # Initialize trainer
-    trainer = Trainer(
+    trainer = VQATrainer(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
         data_collator=custom_data_collator,
+        train_sampler=train_sampler,
     )
 
     # Train the model
@@ -234,7 +461,7 @@ def evaluate(model: nn.Module, val_loader: DataLoader) -> float:
             batch = {k: v.to(DEVICE) for k, v in batch.items()}
 
             # Forward pass
-            outputs = model(**batch)
+            outputs = model(**with_image_hidden_states(model, batch))
             val_loss += outputs.loss.item()
 
     model.train()
@@ -253,10 +480,12 @@ def demo_train():
     )
 
 
-def test_model(ckpt_path: str, val_dataset: str = "valid_grader"):
+def test_model(ckpt_path: str, val_dataset: str = "valid_grader", pixel_store: bool = False):
     testset = VQADataset(val_dataset)
 
     llm = load(ckpt_path)
+    if pixel_store:
+        llm.pixel_store = PixelStore.load_or_build(testset, "smolvlm", llm.processor)
 
     benchmark_result = benchmark(llm, testset, 128)
     print(benchmark_result.accuracy)
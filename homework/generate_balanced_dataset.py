@@ -1,62 +1,192 @@
-import json
+from functools import partial
 from pathlib import Path
 
 import fire
 from tqdm import tqdm
 
-from generate_qa import generate_qa_pairs  # your own module
-
+from balance import AnswerBalancer
+from build_manifest import incremental_build
+from build_utils import (
+    list_info_files,
+    map_sequences,
+    merge_shard_outputs,
+    parse_shard,
+    sequence_views,
+    shard_output_path,
+)
+from dataset_stats import stats
+from generate_qa import QA_GENERATOR_VERSION, generate_qa_pairs, load_sequence_info  # your own module
+from records import RecordWriter, iter_records
+
+
+def sequence_qa_entries(info_path: Path, split: str, views: list[int] | None = None) -> list[dict[str, str]]:
+    """
+    Generate the formatted Q/A entries for all camera views of one sequence.
 
-def build_dataset(root_dir="../data", split="train", output_name="balanced_qa_pairs.json"):
+    `views` lists the views that have an image; they are looked up on disk when not given.
+    """
+    split_dir = info_path.parent
+    base_name = info_path.stem.replace("_info", "")
+    info = load_sequence_info(info_path)  # parsed once, shared by all views
+    if views is None:
+        views = sequence_views(info_path)
+
+    entries = []
+
+    # Loop over the camera views that have an image
+    for view_index in views:
+        img_path = split_dir / f"{base_name}_{view_index:02d}_im.jpg"
+
+        # Generate Q/A pairs
+        qa_pairs = generate_qa_pairs(info, view_index)
+
+        # Append formatted entries
+        for qa in qa_pairs:
+            entries.append(
+                {
+                    "question": qa["question"],
+                    "answer": qa["answer"],
+                    "image_file": f"{split}/{img_path.name}",
+                }
+            )
+
+    return entries
+
+
+def build_dataset(
+    root_dir="../data",
+    split="train",
+    output_name="balanced_qa_pairs.json",
+    workers=1,
+    shard=None,
+    incremental=False,
+    quota=None,
+    template_quotas=None,
+    seed=0,
+):
     """
     Build QA dataset for a particular SuperTuxKart split.
 
     Args:
         root_dir: Base data directory (defaults to ../data relative to this file)
         split: Dataset split to parse (e.g. 'train', 'valid')
-        output_name: Name of the json file to create inside the split directory
+        output_name: Name of the file to create inside the split directory. A .jsonl, .jsonl.gz
+            or .jsonl.zst suffix writes one record per line instead of an indented JSON array,
+            .npz writes a columnar binary shard
+        workers: Number of worker processes; the output order does not depend on it
+        shard: Optional "i/n" to build only the i-th of n slices of the split (see `merge`)
+        incremental: Only regenerate added or changed sequences, tracked in a manifest next to the
+            output, and resume interrupted builds (requires a .jsonl output_name)
+        quota: Keep at most this many Q/A pairs per (question template, answer), sampled
+            uniformly with a streaming reservoir; applies per shard (see `balance`)
+        template_quotas: Optional {template: quota} overrides, e.g.
+            {"How many karts are to the left of the ego car?": 500}
+        seed: Seed of the quota sampling
     """
+    balancing = quota is not None or bool(template_quotas)
+    if balancing and incremental:
+        raise ValueError("quota and template_quotas are not supported with incremental builds")
+
     root = Path(root_dir)
     split_dir = root / split
+    shard = parse_shard(shard)
 
-    output_path = split_dir / output_name
+    output_path = shard_output_path(split_dir / output_name, shard)
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
-    # Storage for full JSON array
-    full_dataset = []
-
     # Find all *_info.json files
-    info_files = sorted(split_dir.glob("*_info.json"))
+    info_files = list_info_files(split_dir, shard)
     print(f"Found {len(info_files)} {split} sequences.")
 
-    for info_path in tqdm(info_files):
-        base_name = info_path.stem.replace("_info", "")
+    if incremental:
+        count, regenerated = incremental_build(
+            output_path,
+            info_files,
+            partial(sequence_qa_entries, split=split),
+            generator=f"qa_pairs-v{QA_GENERATOR_VERSION}",
+            workers=workers,
+            progress=tqdm,
+        )
+        print(f"\n✓ Saved {count} Q/A pairs to {output_path} ({regenerated} sequences regenerated)")
+        return
+
+    # Entries are streamed to disk sequence by sequence instead of being collected in memory
+    results = map_sequences(partial(sequence_qa_entries, split=split), info_files, workers)
+
+    if balancing:
+        balancer = AnswerBalancer(quota, template_quotas, seed)
+        for entries in tqdm(results, total=len(info_files)):
+            balancer.add_all(entries)
+        with RecordWriter(output_path) as writer:
+            writer.write_all(balancer.records())
+        print(f"\n✓ Saved {writer.count} of {balancer.count} Q/A pairs to {output_path}")
+        return
+
+    with RecordWriter(output_path) as writer:
+        for entries in tqdm(results, total=len(info_files)):
+            writer.write_all(entries)
+
+    print(f"\n✓ Saved {writer.count} Q/A pairs to {output_path}")
+
+
+def merge(root_dir="../data", split="train", output_name="balanced_qa_pairs.json", remove_shards=False):
+    """
+    Merge the outputs of `build --shard i/n` runs into a single QA file.
+
+    Args:
+        root_dir: Base data directory
+        split: Dataset split the shards were built for
+        output_name: Output name that was passed to the sharded builds
+        remove_shards: Delete the shard files after a successful merge
+    """
+    output_path = Path(root_dir) / split / output_name
+    count = merge_shard_outputs(output_path, remove_shards)
+
+    print(f"\n✓ Merged {count} Q/A pairs into {output_path}")
+
+
+def balance(
+    root_dir="../data",
+    split="train",
+    input_name="balanced_qa_pairs.json",
+    output_name=None,
+    quota=1000,
+    template_quotas=None,
+    seed=0,
+    summary=False,
+):
+    """
+    Cap the Q/A pairs per (question template, answer) of an existing QA file, e.g. after `merge`.
 
-        # Loop over all 10 camera views
-        for view_index in range(10):
-            img_path = split_dir / f"{base_name}_{view_index:02d}_im.jpg"
-            if not img_path.exists():
-                continue
+    Args:
+        root_dir: Base data directory
+        split: Dataset split of the file
+        input_name: QA file to balance, in any record format
+        output_name: File to write, defaults to overwriting input_name
+        quota: Maximum Q/A pairs kept per template and answer, None for no cap
+        template_quotas: Optional {template: quota} overrides
+        seed: Seed of the reservoir sampling
+        summary: Print the seen / kept counts of every template and answer
+    """
+    split_dir = Path(root_dir) / split
+    input_path = split_dir / input_name
+    output_path = split_dir / (output_name or input_name)
 
-            # Generate Q/A pairs
-            qa_pairs = generate_qa_pairs(str(info_path), view_index)
+    balancer = AnswerBalancer(quota, template_quotas, seed)
+    balancer.add_all(iter_records(input_path))
 
-            # Append formatted entries
-            for qa in qa_pairs:
-                full_dataset.append(
-                    {
-                        "question": qa["question"],
-                        "answer": qa["answer"],
-                        "image_file": f"{split}/{img_path.name}",
-                    }
-                )
+    # RecordWriter only replaces output_path on close, so balancing in place is safe
+    with RecordWriter(output_path) as writer:
+        writer.write_all(balancer.records())
 
-    # Save as a JSON array (not JSONL)
-    with open(output_path, "w") as f:
-        json.dump(full_dataset, f, indent=2)
+    if summary:
+        for template, answers in balancer.summary().items():
+            print(template)
+            for answer, counts in answers.items():
+                print(f"  {answer}: {counts['kept']} / {counts['seen']}")
 
-    print(f"\n✓ Saved {len(full_dataset)} Q/A pairs to {output_path}")
+    print(f"\n✓ Saved {writer.count} of {balancer.count} Q/A pairs to {output_path}")
 
 
 if __name__ == "__main__":
-    fire.Fire({"build": build_dataset})
+    fire.Fire({"build": build_dataset, "merge": merge, "balance": balance, "stats": stats})
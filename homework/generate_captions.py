@@ -1,17 +1,47 @@
-from pathlib import Path
+import re
 
 import fire
-from matplotlib import pyplot as plt
 
-from generate_qa import draw_detections, extract_frame_info, extract_kart_objects, extract_track_info
-
-
-def generate_caption(info_path: str, view_index: int, img_width: int = 150, img_height: int = 100) -> list:
+from generate_qa import (
+    SequenceInfo,
+    draw_detections,
+    extract_frame_info,
+    extract_kart_objects,
+    extract_track_info,
+    load_sequence_info,
+    view_image_path,
+)
+from relations import BACK, FRONT, LEFT, RIGHT, SceneRelations, caption_thresholds
+
+# Bump whenever the generated captions change (including changes to kart extraction)
+CAPTION_GENERATOR_VERSION = 1
+
+# Caption template families; multiple-choice distractors fall back through them in this order
+FAMILIES = ("relation", "ego", "count", "track", "other")
+FAMILY_PATTERNS = [
+    ("relation", re.compile(r" is (left of|right of|in front of|behind) the ego car\.$")),
+    ("ego", re.compile(r" is the ego car\.$")),
+    ("count", re.compile(r"^There are \d+ karts in the scene\.$")),
+    ("track", re.compile(r"^The track is .+\.$")),
+]
+
+
+def caption_family(caption: str) -> str:
+    for family, pattern in FAMILY_PATTERNS:
+        if pattern.search(caption):
+            return family
+    return "other"
+
+
+def generate_caption(
+    info: str | SequenceInfo, view_index: int, img_width: int = 150, img_height: int = 100
+) -> list:
     """
     Generate caption for a specific view.
     """
-    kart_objects = extract_kart_objects(info_path, view_index, img_width, img_height)
-    track_name = extract_track_info(info_path)
+    info = load_sequence_info(info)
+    kart_objects = extract_kart_objects(info, view_index, img_width, img_height)
+    track_name = extract_track_info(info)
 
     if not kart_objects:
         return [f"The track is {track_name}.", "There are 0 karts in the scene."]
@@ -29,42 +59,31 @@ def generate_caption(info_path: str, view_index: int, img_width: int = 150, img_
     captions.append(f"The track is {track_name}.")
 
     if center_kart and num_karts > 1:
-        center_x, center_y = center_kart["center"]
-        horizontal_threshold = max(2.0, img_width * 0.02)
-        vertical_threshold = max(2.0, img_height * 0.02)
-
-        for kart in kart_objects:
-            if kart["is_center_kart"]:
-                continue
+        relations = SceneRelations.from_karts(kart_objects)
+        horizontal, vertical = relations.ego_relations(*caption_thresholds(img_width, img_height))
 
-            kart_x, kart_y = kart["center"]
-
-            lr_phrase = None
-            if kart_x < center_x - horizontal_threshold:
-                lr_phrase = "left of"
-            elif kart_x > center_x + horizontal_threshold:
-                lr_phrase = "right of"
-
-            fb_phrase = None
-            if kart_y < center_y - vertical_threshold:
-                fb_phrase = "in front of"
-            elif kart_y > center_y + vertical_threshold:
-                fb_phrase = "behind"
+        for i in relations.others:
+            kart_name = relations.names[i]
+            lr_phrase = {LEFT: "left of", RIGHT: "right of"}.get(int(horizontal[i]))
+            fb_phrase = {FRONT: "in front of", BACK: "behind"}.get(int(vertical[i]))
 
             if lr_phrase:
-                captions.append(f"{kart['kart_name']} is {lr_phrase} the ego car.")
+                captions.append(f"{kart_name} is {lr_phrase} the ego car.")
             if fb_phrase:
-                captions.append(f"{kart['kart_name']} is {fb_phrase} the ego car.")
+                captions.append(f"{kart_name} is {fb_phrase} the ego car.")
             # if lr_phrase and fb_phrase:
-            #     captions.append(f"{kart['kart_name']} is {fb_phrase} and {lr_phrase} the ego car.")
+            #     captions.append(f"{kart_name} is {fb_phrase} and {lr_phrase} the ego car.")
             # if not lr_phrase and not fb_phrase:
-            #     captions.append(f"{kart['kart_name']} is near the ego car.")
+            #     captions.append(f"{kart_name} is near the ego car.")
 
     return captions
 
 
 def check_caption(info_file: str, view_index: int):
-    captions = generate_caption(info_file, view_index)
+    from matplotlib import pyplot as plt
+
+    info = load_sequence_info(info_file)
+    captions = generate_caption(info, view_index)
 
     print("\nCaption:")
     print("-" * 50)
@@ -72,11 +91,11 @@ def check_caption(info_file: str, view_index: int):
         print(f"{i + 1}. {caption}")
         print("-" * 50)
 
-    info_path = Path(info_file)
-    base_name = info_path.stem.replace("_info", "")
-    image_file = list(info_path.parent.glob(f"{base_name}_{view_index:02d}_im.jpg"))[0]
+    image_file = view_image_path(info_file, view_index)
+    if not image_file.exists():
+        raise FileNotFoundError(f"No image {image_file} for view {view_index}")
 
-    annotated_image = draw_detections(str(image_file), info_file)
+    annotated_image = draw_detections(str(image_file), info)
 
     plt.figure(figsize=(12, 8))
     plt.imshow(annotated_image)
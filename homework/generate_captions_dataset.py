@@ -1,10 +1,22 @@
-import json
+from functools import partial
 from pathlib import Path
 
 import fire
 from tqdm import tqdm
 
-from generate_captions import generate_caption
+from build_manifest import incremental_build
+from build_utils import (
+    list_info_files,
+    map_sequences,
+    merge_shard_outputs,
+    parse_shard,
+    sequence_views,
+    shard_output_path,
+)
+from dataset_stats import stats
+from generate_captions import CAPTION_GENERATOR_VERSION, generate_caption
+from generate_qa import load_sequence_info
+from records import RecordWriter
 
 DEFAULT_OUTPUTS = {
     "train": "train_captions.json",
@@ -12,55 +24,103 @@ DEFAULT_OUTPUTS = {
 }
 
 
-def build_dataset(root_dir="../data", split="train", output_name=None):
+def sequence_caption_entries(info_path: Path, split: str, views: list[int] | None = None) -> list[dict[str, str]]:
+    """
+    Generate the caption entries for all camera views of one sequence.
+
+    `views` lists the views that have an image; they are looked up on disk when not given.
+    """
+    split_dir = info_path.parent
+    base_name = info_path.stem.replace("_info", "")
+    info = load_sequence_info(info_path)  # parsed once, shared by all views
+    if views is None:
+        views = sequence_views(info_path)
+
+    entries: list[dict[str, str]] = []
+
+    for view_index in views:
+        image_path = split_dir / f"{base_name}_{view_index:02d}_im.jpg"
+
+        captions = generate_caption(info, view_index)
+        for caption in captions:
+            entries.append(
+                {
+                    "image_file": f"{split}/{image_path.name}",
+                    "caption": caption,
+                }
+            )
+
+    return entries
+
+
+def build_dataset(root_dir="../data", split="train", output_name=None, workers=1, shard=None, incremental=False):
     """
     Build caption dataset for a specific SuperTuxKart split.
 
     Args:
         root_dir: Base directory containing data splits.
         split: Split to process (e.g., 'train', 'valid').
-        output_name: Optional override for the output json filename.
+        output_name: Optional override for the output filename. A .jsonl, .jsonl.gz or .jsonl.zst
+            suffix writes one record per line instead of an indented JSON array, .npz writes a
+            columnar binary shard.
+        workers: Number of worker processes; the output order does not depend on it.
+        shard: Optional "i/n" to build only the i-th of n slices of the split (see `merge`).
+        incremental: Only regenerate added or changed sequences, tracked in a manifest next to the
+            output, and resume interrupted builds (requires a .jsonl output_name).
     """
     root = Path(root_dir)
     split_dir = root / split
+    shard = parse_shard(shard)
 
     if not split_dir.exists():
         raise FileNotFoundError(f"Split directory {split_dir} does not exist.")
 
     filename = output_name or DEFAULT_OUTPUTS.get(split, f"{split}_captions.json")
-    output_path = split_dir / filename
+    output_path = shard_output_path(split_dir / filename, shard)
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
-    entries: list[dict[str, str]] = []
-
-    info_files = sorted(split_dir.glob("*_info.json"))
+    info_files = list_info_files(split_dir, shard)
     print(f"Found {len(info_files)} {split} sequences.")
 
-    for info_path in tqdm(info_files):
-        base_name = info_path.stem.replace("_info", "")
+    if incremental:
+        count, regenerated = incremental_build(
+            output_path,
+            info_files,
+            partial(sequence_caption_entries, split=split),
+            generator=f"captions-v{CAPTION_GENERATOR_VERSION}",
+            workers=workers,
+            progress=tqdm,
+        )
+        print(f"\n✓ Saved {count} captions to {output_path} ({regenerated} sequences regenerated)")
+        return
+
+    results = map_sequences(partial(sequence_caption_entries, split=split), info_files, workers)
+    with RecordWriter(output_path) as writer:
+        for entries in tqdm(results, total=len(info_files)):
+            writer.write_all(entries)
 
-        for view_index in range(10):
-            image_path = split_dir / f"{base_name}_{view_index:02d}_im.jpg"
-            if not image_path.exists():
-                continue
+    print(f"\n✓ Saved {writer.count} captions to {output_path}")
 
-            captions = generate_caption(str(info_path), view_index)
-            for caption in captions:
-                entries.append(
-                    {
-                        "image_file": f"{split}/{image_path.name}",
-                        "caption": caption,
-                    }
-                )
 
-    with output_path.open("w") as f:
-        json.dump(entries, f, indent=2)
+def merge(root_dir="../data", split="train", output_name=None, remove_shards=False):
+    """
+    Merge the outputs of `build --shard i/n` runs into a single caption file.
+
+    Args:
+        root_dir: Base directory containing data splits.
+        split: Split the shards were built for.
+        output_name: Output name that was passed to the sharded builds.
+        remove_shards: Delete the shard files after a successful merge.
+    """
+    filename = output_name or DEFAULT_OUTPUTS.get(split, f"{split}_captions.json")
+    output_path = Path(root_dir) / split / filename
+    count = merge_shard_outputs(output_path, remove_shards)
 
-    print(f"\n✓ Saved {len(entries)} captions to {output_path}")
+    print(f"\n✓ Merged {count} captions into {output_path}")
 
 
 def main():
-    fire.Fire({"build": build_dataset})
+    fire.Fire({"build": build_dataset, "merge": merge, "stats": stats})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+from functools import partial
+from pathlib import Path
+
+import fire
+from tqdm import tqdm
+
+from build_utils import index_split, map_sequences, merge_shard_outputs, parse_shard, select_shard, shard_output_path
+from dataset_stats import stats
+from generate_balanced_dataset import sequence_qa_entries
+from generate_captions_dataset import DEFAULT_OUTPUTS as DEFAULT_CAPTION_OUTPUTS
+from generate_captions_dataset import sequence_caption_entries
+from generate_mc import DEFAULT_MC_OUTPUT, MultipleChoiceBuilder
+from records import RecordWriter
+
+ARTIFACTS = ("qa_pairs", "captions", "mc")
+DEFAULT_QA_OUTPUT = "balanced_qa_pairs.json"
+
+
+def sequence_artifacts(item: tuple[Path, list[int]], split: str) -> dict[str, list[dict[str, str]]]:
+    """
+    Generate the Q/A and caption entries of one sequence from a single parse of its info file.
+    """
+    info_path, views = item
+    return {
+        "qa_pairs": sequence_qa_entries(info_path, split, views),
+        "captions": sequence_caption_entries(info_path, split, views),
+    }
+
+
+def parse_artifacts(artifacts: str | tuple | list) -> list[str]:
+    if isinstance(artifacts, str):
+        artifacts = artifacts.split(",")
+    artifacts = [a.strip() for a in artifacts if a.strip()]
+
+    unknown = sorted(set(artifacts) - set(ARTIFACTS))
+    if unknown:
+        raise ValueError(f"Unknown artifacts {unknown}, choose from {ARTIFACTS}")
+    return artifacts
+
+
+def output_paths(split_dir: Path, split: str, qa_output: str, captions_output: str | None, mc_output: str) -> dict:
+    return {
+        "qa_pairs": split_dir / qa_output,
+        "captions": split_dir / (captions_output or DEFAULT_CAPTION_OUTPUTS.get(split, f"{split}_captions.json")),
+        "mc": split_dir / mc_output,
+    }
+
+
+def build(
+    root_dir="../data",
+    split="train",
+    artifacts=ARTIFACTS,
+    qa_output=DEFAULT_QA_OUTPUT,
+    captions_output=None,
+    mc_output=DEFAULT_MC_OUTPUT,
+    workers=1,
+    shard=None,
+    seed=0,
+):
+    """
+    Build the QA pairs, captions and multiple-choice sets of a split in a single pass.
+
+    The split directory is scanned once for images and every info file is parsed once; all
+    requested artifacts are produced from that parse.
+
+    Args:
+        root_dir: Base data directory
+        split: Dataset split to parse (e.g. 'train', 'valid')
+        artifacts: Comma separated subset of "qa_pairs,captions,mc" to write
+        qa_output: QA pairs file name (.json, .jsonl, .jsonl.gz, .jsonl.zst or .npz)
+        captions_output: Caption file name, defaults to the caption builder's name for the split
+        mc_output: Multiple-choice file name
+        workers: Number of worker processes; the output order does not depend on it
+        shard: Optional "i/n" to build only the i-th of n slices of the split (see `merge`)
+        seed: Seed for drawing multiple-choice candidates
+    """
+    split_dir = Path(root_dir) / split
+    if not split_dir.exists():
+        raise FileNotFoundError(f"Split directory {split_dir} does not exist.")
+
+    artifacts = parse_artifacts(artifacts)
+    shard = parse_shard(shard)
+    paths = output_paths(split_dir, split, qa_output, captions_output, mc_output)
+
+    sequences = select_shard(list(index_split(split_dir).items()), shard)
+    print(f"Found {len(sequences)} {split} sequences.")
+
+    writers = {
+        name: RecordWriter(shard_output_path(paths[name], shard))
+        for name in ("qa_pairs", "captions")
+        if name in artifacts
+    }
+    mc_builder = MultipleChoiceBuilder(seed=seed) if "mc" in artifacts else None
+
+    try:
+        results = map_sequences(partial(sequence_artifacts, split=split), sequences, workers)
+        for result in tqdm(results, total=len(sequences)):
+            for name, writer in writers.items():
+                writer.write_all(result[name])
+            if mc_builder is not None:
+                mc_builder.add(result["captions"])
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+
+    for name, writer in writers.items():
+        writer.close()
+        print(f"✓ Saved {writer.count} {name} records to {writer.path}")
+
+    if mc_builder is not None:
+        with RecordWriter(shard_output_path(paths["mc"], shard)) as writer:
+            writer.write_all(mc_builder.entries())
+        print(f"✓ Saved {writer.count} multiple-choice sets to {writer.path}")
+
+
+def merge(
+    root_dir="../data",
+    split="train",
+    artifacts=ARTIFACTS,
+    qa_output=DEFAULT_QA_OUTPUT,
+    captions_output=None,
+    mc_output=DEFAULT_MC_OUTPUT,
+    remove_shards=False,
+):
+    """
+    Merge the outputs of `build --shard i/n` runs, one file per artifact.
+    """
+    paths = output_paths(Path(root_dir) / split, split, qa_output, captions_output, mc_output)
+
+    for name in parse_artifacts(artifacts):
+        count = merge_shard_outputs(paths[name], remove_shards)
+        print(f"✓ Merged {count} {name} records into {paths[name]}")
+
+
+def main():
+    fire.Fire({"build": build, "merge": merge, "stats": stats})
+
+
+if __name__ == "__main__":
+    main()
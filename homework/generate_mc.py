@@ -0,0 +1,157 @@
+import random
+from collections.abc import Iterable, Iterator
+from functools import partial
+from pathlib import Path
+
+import fire
+from tqdm import tqdm
+
+from build_utils import index_split, map_sequences
+from columnar import StringTable
+from generate_captions import FAMILIES, caption_family
+from generate_captions_dataset import sequence_caption_entries
+from records import RecordWriter, iter_records
+
+DEFAULT_MC_OUTPUT = "all_mc_qas.json"
+
+
+class MultipleChoiceBuilder:
+    """
+    Builds multiple-choice caption sets (the all_mc_qas.json format) from the true captions of
+    every image.
+
+    Captions are interned and indexed by template family. A set pairs one true caption of an
+    image with hard distractors drawn from the same family (another track, another count,
+    another kart or direction), falling back to the other families when a family has too few
+    captions. Distractors are drawn by rejection sampling against the image's true captions,
+    so each draw is O(1) and a build is linear in the number of images.
+
+    Args:
+        num_candidates: Number of candidates per set, including the correct one
+        seed: Seed for drawing the sets
+        sets_per_image: Number of sets per image, each with a different correct caption
+    """
+
+    def __init__(self, num_candidates: int = 5, seed: int = 0, sets_per_image: int = 1):
+        self.num_candidates = num_candidates
+        self.seed = seed
+        self.sets_per_image = sets_per_image
+        self.captions = StringTable()
+        self.families: dict[str, list[int]] = {family: [] for family in FAMILIES}
+        self.family_of: list[str] = []
+        self.images: dict[str, list[int]] = {}
+
+    def add(self, caption_entries: Iterable[dict[str, str]]):
+        for entry in caption_entries:
+            caption_id = self.captions.intern(entry["caption"])
+            if caption_id == len(self.family_of):
+                family = caption_family(entry["caption"])
+                self.family_of.append(family)
+                self.families[family].append(caption_id)
+
+            true_ids = self.images.setdefault(entry["image_file"], [])
+            if caption_id not in true_ids:
+                true_ids.append(caption_id)
+
+    def draw_distractors(self, family: str, true_ids: list[int], count: int, rng: random.Random) -> list[int]:
+        """
+        Draw up to count distinct captions that are not true for the image, preferring family.
+        """
+        exclude = set(true_ids)
+        drawn: list[int] = []
+
+        for pool_family in (family, *(f for f in FAMILIES if f != family)):
+            pool = self.families[pool_family]
+            available = len(pool) - sum(1 for i in exclude if self.family_of[i] == pool_family)
+            wanted = min(count - len(drawn), available)
+
+            if wanted > 0 and available <= 2 * wanted:
+                # Nearly exhausted pool: sampling from the filtered pool beats rejecting most draws
+                drawn.extend(rng.sample([i for i in pool if i not in exclude], wanted))
+                exclude.update(drawn)
+            else:
+                while wanted > 0:
+                    caption_id = pool[rng.randrange(len(pool))]
+                    if caption_id not in exclude:
+                        drawn.append(caption_id)
+                        exclude.add(caption_id)
+                        wanted -= 1
+
+            if len(drawn) == count:
+                break
+
+        return drawn
+
+    def entries(self) -> Iterator[dict]:
+        rng = random.Random(self.seed)
+
+        for image_file, true_ids in self.images.items():
+            if len(self.captions) - len(true_ids) < self.num_candidates - 1:
+                continue
+
+            for correct_id in rng.sample(true_ids, min(self.sets_per_image, len(true_ids))):
+                candidates = self.draw_distractors(self.family_of[correct_id], true_ids, self.num_candidates - 1, rng)
+                correct_index = rng.randrange(self.num_candidates)
+                candidates.insert(correct_index, correct_id)
+
+                yield {
+                    "image_file": image_file,
+                    "candidates": [self.captions.strings[i] for i in candidates],
+                    "correct_index": correct_index,
+                }
+
+
+def _sequence_captions(item: tuple[Path, list[int]], split: str) -> list[dict[str, str]]:
+    info_path, views = item
+    return sequence_caption_entries(info_path, split, views)
+
+
+def build(
+    root_dir="../data",
+    split="valid",
+    output_name=DEFAULT_MC_OUTPUT,
+    captions_name=None,
+    num_candidates=5,
+    sets_per_image=1,
+    seed=0,
+    workers=1,
+):
+    """
+    Build a multiple-choice caption set (all_mc_qas.json format) for any split.
+
+    Args:
+        root_dir: Base data directory
+        split: Dataset split to build (e.g. 'train', 'valid')
+        output_name: File to create inside the split directory, in any record format
+        captions_name: Read the true captions from this caption file in the split directory
+            instead of generating them from the info files
+        num_candidates: Number of candidates per set, including the correct one
+        sets_per_image: Number of sets per image, each with a different correct caption
+        seed: Seed for drawing the sets
+        workers: Number of worker processes used to generate captions
+    """
+    split_dir = Path(root_dir) / split
+    if not split_dir.exists():
+        raise FileNotFoundError(f"Split directory {split_dir} does not exist.")
+
+    builder = MultipleChoiceBuilder(num_candidates, seed, sets_per_image)
+
+    if captions_name is not None:
+        builder.add(tqdm(iter_records(split_dir / captions_name)))
+    else:
+        sequences = list(index_split(split_dir).items())
+        print(f"Found {len(sequences)} {split} sequences.")
+
+        results = map_sequences(partial(_sequence_captions, split=split), sequences, workers)
+        for entries in tqdm(results, total=len(sequences)):
+            builder.add(entries)
+
+    output_path = split_dir / output_name
+    with RecordWriter(output_path) as writer:
+        writer.write_all(builder.entries())
+
+    print(f"\n✓ Saved {writer.count} multiple-choice sets for {len(builder.images)} images to {output_path}")
+
+
+if __name__ == "__main__":
+    fire.Fire({"build": build})
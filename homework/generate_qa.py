@@ -1,11 +1,16 @@
 import json
+import os
+from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
 from pathlib import Path
 
 import fire
-import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image, ImageDraw
 
+from relations import FRONT, LEFT, SceneRelations
+from sequence_index import SequenceIndex, load_index
+
 # -------------------------------
 # NORMALIZATION FUNCTION (NEW)
 # -------------------------------
@@ -80,10 +85,106 @@ COLORS = {
 ORIGINAL_WIDTH = 600
 ORIGINAL_HEIGHT = 400
 
+# Bump whenever the generated questions or answers change, so incremental builds regenerate
+QA_GENERATOR_VERSION = 1
+
+
+# -------------------------------
+# SEQUENCE INFO LOADING
+# -------------------------------
+INFO_CACHE_SIZE = 64
+
+
+@dataclass(frozen=True)
+class SequenceInfo:
+    """
+    Parsed contents of a single ``*_info.json`` file.
+
+    Parse the file once with ``load_sequence_info`` and hand the result to the
+    extraction functions for every view, instead of re-reading the file each time.
+    The lists are shared between callers and must not be modified.
+    """
+
+    path: str
+    track: str
+    karts: list[str]
+    detections: list[list[list[float]]]
+    kart_objects_cache: dict = field(default_factory=dict, compare=False, repr=False)
+
+    @classmethod
+    def from_dict(cls, info: dict, path: str = "") -> "SequenceInfo":
+        return cls(
+            path=path,
+            track=info.get("track", "Unknown Track"),
+            karts=info.get("karts", []),
+            detections=info.get("detections", []),
+        )
+
+    @classmethod
+    def from_index(cls, index: SequenceIndex, row: int, path: str = "") -> "SequenceInfo":
+        info = cls(path=path, track=index.track(row), karts=index.kart_names(row), detections=index.detections(row))
+        # Seed the cached property, the index already holds the detections as arrays
+        info.__dict__["detection_array"] = index.detection_array(row)
+        return info
+
+    @cached_property
+    def detection_array(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        All detections of all views as ``(view_ids, detections)``, where detections
+        is an (N, 6) float array of (class_id, track_id, x1, y1, x2, y2) rows sorted by view.
+        """
+        counts = [len(view) for view in self.detections]
+        rows = [detection for view in self.detections for detection in view]
+        view_ids = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+        detections = np.asarray(rows, dtype=np.float64).reshape(len(rows), 6)
+        return view_ids, detections
+
+
+@lru_cache(maxsize=INFO_CACHE_SIZE)
+def _load_sequence_info_cached(info_path: str, mtime_ns: int) -> SequenceInfo:
+    # mtime_ns is also part of the cache key, so an edited file is parsed again
+    index = load_index(os.path.dirname(info_path))
+    row = index.find(os.path.basename(info_path)) if index is not None else -1
+    if row >= 0 and index.mtime_ns[row] == mtime_ns:
+        return SequenceInfo.from_index(index, row, path=info_path)
+
+    with open(info_path) as f:
+        return SequenceInfo.from_dict(json.load(f), path=info_path)
+
+
+def load_sequence_info(info: str | Path | SequenceInfo) -> SequenceInfo:
+    """
+    Return the parsed sequence info for a path, or pass a SequenceInfo through.
+
+    Path lookups go through a bounded LRU cache keyed by (path, mtime). Sequences come from
+    the split's sequence index (see sequence_index.py) when it is current for the file, and
+    from the index alone when the info file no longer exists.
+    """
+    if isinstance(info, SequenceInfo):
+        return info
+    info_path = os.fspath(info)
+    try:
+        mtime_ns = os.stat(info_path).st_mtime_ns
+    except FileNotFoundError:
+        index = load_index(os.path.dirname(info_path))
+        row = index.find(os.path.basename(info_path)) if index is not None else -1
+        if row < 0:
+            raise
+        mtime_ns = int(index.mtime_ns[row])
+    return _load_sequence_info_cached(info_path, mtime_ns)
+
 
 # -------------------------------
 # FRAME INFO PARSING
 # -------------------------------
+def view_image_path(info_path: str | Path, view_index: int) -> Path:
+    """
+    Image of one camera view of the sequence described by an info file.
+    """
+    info_path = Path(info_path)
+    return info_path.parent / f"{info_path.stem.replace('_info', '')}_{view_index:02d}_im.jpg"
+
+
 def extract_frame_info(image_path: str) -> tuple[int, int]:
     filename = Path(image_path).name
     parts = filename.split("_")
@@ -97,7 +198,9 @@ def extract_frame_info(image_path: str) -> tuple[int, int]:
 # -------------------------------
 # DRAW DETECTIONS FOR DEBUGGING
 # -------------------------------
-def draw_detections(image_path: str, info_path: str, font_scale=0.5, thickness=1, min_box_size=5) -> np.ndarray:
+def draw_detections(
+    image_path: str, info: str | SequenceInfo, font_scale=0.5, thickness=1, min_box_size=5
+) -> np.ndarray:
 
     pil_image = Image.open(image_path)
     if pil_image is None:
@@ -106,13 +209,12 @@ def draw_detections(image_path: str, info_path: str, font_scale=0.5, thickness=1
     img_width, img_height = pil_image.size
     draw = ImageDraw.Draw(pil_image)
 
-    with open(info_path) as f:
-        info = json.load(f)
+    info = load_sequence_info(info)
 
     _, view_index = extract_frame_info(image_path)
 
-    if view_index < len(info["detections"]):
-        frame_detections = info["detections"][view_index]
+    if view_index < len(info.detections):
+        frame_detections = info.detections[view_index]
     else:
         return np.array(pil_image)
 
@@ -147,83 +249,91 @@ def draw_detections(image_path: str, info_path: str, font_scale=0.5, thickness=1
 # -------------------------------
 # KART EXTRACTION
 # -------------------------------
-def extract_kart_objects(info_path: str, view_index: int, img_width=150, img_height=100, min_box_size=5) -> list:
-
-    with open(info_path) as f:
-        info = json.load(f)
-
-    if view_index >= len(info["detections"]):
-        return []
-
-    frame_detections = info["detections"][view_index]
+def extract_all_kart_objects(info: str | SequenceInfo, img_width=150, img_height=100, min_box_size=5) -> list:
+    """
+    Extract the kart objects of every view of a sequence in one vectorized pass.
 
-    kart_objects = []
-    image_center = (img_width / 2, img_height / 2)
-    min_distance_to_center = float("inf")
-    center_kart_id = None
+    Returns one list of kart dicts per entry of ``info.detections``, identical to
+    calling ``extract_kart_objects`` for each view.
+    """
+    info = load_sequence_info(info)
+    view_ids, detections = info.detection_array
 
     scale_x = img_width / ORIGINAL_WIDTH
     scale_y = img_height / ORIGINAL_HEIGHT
 
-    for detection in frame_detections:
-        class_id, track_id, x1, y1, x2, y2 = detection
-        class_id = int(class_id)
-        track_id = int(track_id)
-
-        if class_id != 1:
-            continue
-
-        x1_scaled = int(x1 * scale_x)
-        y1_scaled = int(y1 * scale_y)
-        x2_scaled = int(x2 * scale_x)
-        y2_scaled = int(y2 * scale_y)
-
-        if (x2_scaled - x1_scaled < min_box_size) or (y2_scaled - y1_scaled < min_box_size):
-            continue
-
-        if x2_scaled < 0 or x1_scaled > img_width or y2_scaled < 0 or y1_scaled > img_height:
-            continue
-
-        # NOTE: keeping original behavior as requested (still uses scaled center)
-        center_x = (x1_scaled + x2_scaled) / 2
-        center_y = (y1_scaled + y2_scaled) / 2
-
-        dist = np.sqrt((center_x - image_center[0])**2 + (center_y - image_center[1])**2)
-        if dist < min_distance_to_center:
-            min_distance_to_center = dist
-            center_kart_id = track_id
-
-        karts = info["karts"]
-        kart_objects.append({
-            "instance_id": track_id,
-            "kart_name": karts[track_id],
-            "center": (center_x, center_y)
-        })
+    # int() truncates towards zero, so do the same here rather than flooring
+    class_ids = np.trunc(detections[:, 0]).astype(np.int64)
+    track_ids = np.trunc(detections[:, 1]).astype(np.int64)
+    x1 = np.trunc(detections[:, 2] * scale_x).astype(np.int64)
+    y1 = np.trunc(detections[:, 3] * scale_y).astype(np.int64)
+    x2 = np.trunc(detections[:, 4] * scale_x).astype(np.int64)
+    y2 = np.trunc(detections[:, 5] * scale_y).astype(np.int64)
+
+    keep = (class_ids == 1)
+    keep &= (x2 - x1 >= min_box_size) & (y2 - y1 >= min_box_size)
+    keep &= (x2 >= 0) & (x1 <= img_width) & (y2 >= 0) & (y1 <= img_height)
+
+    view_ids = view_ids[keep]
+    track_ids = track_ids[keep]
+    # NOTE: keeping original behavior as requested (still uses scaled center)
+    center_x = (x1[keep] + x2[keep]) / 2
+    center_y = (y1[keep] + y2[keep]) / 2
+    dist = np.sqrt((center_x - img_width / 2) ** 2 + (center_y - img_height / 2) ** 2)
+
+    # Closest kart per view; the stable sort keeps the first detection on ties
+    num_views = len(info.detections)
+    center_kart_ids = np.full(num_views, -1, dtype=np.int64)
+    has_center = np.zeros(num_views, dtype=bool)
+    order = np.lexsort((dist, view_ids))
+    first_views, first_index = np.unique(view_ids[order], return_index=True)
+    center_kart_ids[first_views] = track_ids[order[first_index]]
+    has_center[first_views] = True
+    is_center = has_center[view_ids] & (track_ids == center_kart_ids[view_ids])
+
+    view_bounds = np.searchsorted(view_ids, np.arange(num_views + 1))
+    rows = zip(track_ids.tolist(), center_x.tolist(), center_y.tolist(), is_center.tolist())
+    kart_objects = [
+        {"instance_id": track_id, "kart_name": info.karts[track_id], "center": (x, y), "is_center_kart": center}
+        for track_id, x, y, center in rows
+    ]
+    return [kart_objects[view_bounds[v] : view_bounds[v + 1]] for v in range(num_views)]
+
+
+def extract_kart_objects(
+    info: str | SequenceInfo, view_index: int, img_width=150, img_height=100, min_box_size=5
+) -> list:
+
+    info = load_sequence_info(info)
+
+    if view_index >= len(info.detections):
+        return []
 
-    for kart in kart_objects:
-        kart["is_center_kart"] = (kart["instance_id"] == center_kart_id)
+    # All views are extracted together once per sequence and memoized on the info object
+    key = (img_width, img_height, min_box_size)
+    if key not in info.kart_objects_cache:
+        info.kart_objects_cache[key] = extract_all_kart_objects(info, img_width, img_height, min_box_size)
 
-    return kart_objects
+    return [dict(kart) for kart in info.kart_objects_cache[key][view_index]]
 
 
 # -------------------------------
 # TRACK EXTRACTION
 # -------------------------------
-def extract_track_info(info_path: str) -> str:
-    with open(info_path) as f:
-        info = json.load(f)
-    return info.get("track", "Unknown Track")
+def extract_track_info(info: str | SequenceInfo) -> str:
+    return load_sequence_info(info).track
 
 
 # -------------------------------
 # QA PAIR GENERATION
 # -------------------------------
-def generate_qa_pairs(info_path: str, view_index: int, img_width=150, img_height=100):
+def generate_qa_pairs(info: str | SequenceInfo, view_index: int, img_width=150, img_height=100):
 
     qa_pairs = []
 
-    kart_objects = extract_kart_objects(info_path, view_index, img_width, img_height)
-    track_name = extract_track_info(info_path)
+    info = load_sequence_info(info)
+    kart_objects = extract_kart_objects(info, view_index, img_width, img_height)
+    track_name = extract_track_info(info)
 
     # Ego kart
     center_kart = next((k for k in kart_objects if k["is_center_kart"]), None)
@@ -246,16 +356,14 @@ def generate_qa_pairs(info_path: str, view_index: int, img_width=150, img_height
     })
 
     if center_kart:
-        center_x, center_y = center_kart["center"]
-
-        for kart in kart_objects:
-            if kart["is_center_kart"]:
-                continue
+        relations = SceneRelations.from_karts(kart_objects)
+        horizontal, vertical = relations.ego_relations()
 
-            kart_x, kart_y = kart["center"]
+        for i in relations.others:
+            kart_name = relations.names[i]
 
-            lr = "left" if kart_x < center_x else "right"
-            fb = "front" if kart_y < center_y else "back"
+            lr = "left" if horizontal[i] == LEFT else "right"
+            fb = "front" if vertical[i] == FRONT else "back"
 
             # Normalize all direction answers
             lr = normalize_direction(lr)
@@ -264,32 +372,29 @@ def generate_qa_pairs(info_path: str, view_index: int, img_width=150, img_height
 
             # Left/Right question
             qa_pairs.append({
-                "question": f"Is {kart['kart_name']} to the left or right of the ego car?",
+                "question": f"Is {kart_name} to the left or right of the ego car?",
                 "answer": lr
             })
 
             # Front/Behind
             qa_pairs.append({
-                "question": f"Is {kart['kart_name']} in front of or behind the ego car?",
+                "question": f"Is {kart_name} in front of or behind the ego car?",
                 "answer": fb
             })
 
             # Relative position
             qa_pairs.append({
-                "question": f"Where is {kart['kart_name']} relative to the ego car?",
+                "question": f"Where is {kart_name} relative to the ego car?",
                 "answer": combined
             })
 
         # Counting
-        left_count = sum(1 for k in kart_objects if not k["is_center_kart"] and k["center"][0] < center_x)
-        right_count = sum(1 for k in kart_objects if not k["is_center_kart"] and k["center"][0] >= center_x)
-        front_count = sum(1 for k in kart_objects if not k["is_center_kart"] and k["center"][1] < center_y)
-        back_count = sum(1 for k in kart_objects if not k["is_center_kart"] and k["center"][1] >= center_y)
+        counts = relations.ego_counts()
 
-        qa_pairs.append({"question": "How many karts are to the left of the ego car?", "answer": str(left_count)})
-        qa_pairs.append({"question": "How many karts are to the right of the ego car?", "answer": str(right_count)})
-        qa_pairs.append({"question": "How many karts are in front of the ego car?", "answer": str(front_count)})
-        qa_pairs.append({"question": "How many karts are behind the ego car?", "answer": str(back_count)})
+        qa_pairs.append({"question": "How many karts are to the left of the ego car?", "answer": str(counts["left"])})
+        qa_pairs.append({"question": "How many karts are to the right of the ego car?", "answer": str(counts["right"])})
+        qa_pairs.append({"question": "How many karts are in front of the ego car?", "answer": str(counts["front"])})
+        qa_pairs.append({"question": "How many karts are behind the ego car?", "answer": str(counts["back"])})
 
     return qa_pairs
 
@@ -298,12 +403,15 @@ def generate_qa_pairs(info_path: str, view_index: int, img_width=150, img_height
 # DEBUG VISUALIZER
 # -------------------------------
 def check_qa_pairs(info_file: str, view_index: int):
+    # Only the interactive viewer needs matplotlib; batch rendering (render_overlays.py) is PIL-only
+    import matplotlib.pyplot as plt
 
-    info_path = Path(info_file)
-    base_name = info_path.stem.replace("_info", "")
-    image_file = list(info_path.parent.glob(f"{base_name}_{view_index:02d}_im.jpg"))[0]
+    image_file = view_image_path(info_file, view_index)
+    if not image_file.exists():
+        raise FileNotFoundError(f"No image {image_file} for view {view_index}")
 
-    annotated_image = draw_detections(str(image_file), info_file)
+    info = load_sequence_info(info_file)
+    annotated_image = draw_detections(str(image_file), info)
 
     plt.figure(figsize=(12, 8))
     plt.imshow(annotated_image)
@@ -311,7 +419,7 @@ def check_qa_pairs(info_file: str, view_index: int):
     plt.title(f"Frame {extract_frame_info(str(image_file))[0]}, View {view_index}")
     plt.show()
 
-    qa_pairs = generate_qa_pairs(info_file, view_index)
+    qa_pairs = generate_qa_pairs(info, view_index)
 
     print("\nQuestion-Answer Pairs:")
     print("-" * 50)
@@ -0,0 +1,105 @@
+"""
+Decoded-image cache shared by all DataLoader workers.
+"""
+
+import multiprocessing as mp
+
+import torch
+
+from .image_io import load_image
+
+
+class SharedImageCache:
+    """
+    LRU cache of decoded RGB images in shared memory, with a byte budget.
+
+    The cache is a fixed array of equally sized slots in shared memory, allocated in the main
+    process. DataLoader workers inherit it, so an image decoded by any worker is reused by all
+    of them. Images are keyed by their dense dataset index (``image_index``); a lock guards the
+    slot tables and the least recently used slot is evicted when the cache is full. Images
+    larger than a slot are decoded every time. The lock comes from the default multiprocessing
+    context, which is what DataLoader uses unless given another multiprocessing_context.
+
+    Args:
+        num_images: Number of distinct images (keys are 0 .. num_images - 1)
+        budget_bytes: Total size of the slots
+        slot_bytes: Size of one slot, typically height * width * 3 of the dataset's images
+    """
+
+    def __init__(self, num_images: int, budget_bytes: int, slot_bytes: int):
+        num_slots = min(max(budget_bytes // max(slot_bytes, 1), 0), num_images)
+        self.slot_bytes = slot_bytes
+
+        self.pixels = torch.zeros((num_slots, slot_bytes), dtype=torch.uint8).share_memory_()
+        self.shapes = torch.zeros((num_slots, 3), dtype=torch.int32).share_memory_()
+        self.owners = torch.full((num_slots,), -1, dtype=torch.int64).share_memory_()
+        self.last_used = torch.zeros((num_slots,), dtype=torch.int64).share_memory_()
+        self.slots = torch.full((num_images,), -1, dtype=torch.int64).share_memory_()
+        # clock, hits, misses
+        self.counters = torch.zeros((3,), dtype=torch.int64).share_memory_()
+        self.lock = mp.Lock()
+
+    @classmethod
+    def for_dataset(cls, dataset, budget_mb: float) -> "SharedImageCache | None":
+        """
+        A cache sized for the images of a VQADataset or CaptionDataset, None for a zero budget.
+        """
+        if budget_mb <= 0 or len(dataset) == 0:
+            return None
+        height, width, channels = load_image(dataset[0]["image_path"]).shape
+        return cls(dataset.num_images, int(budget_mb * 2**20), height * width * channels)
+
+    def __len__(self) -> int:
+        return len(self.owners)
+
+    @property
+    def hits(self) -> int:
+        return int(self.counters[1])
+
+    @property
+    def misses(self) -> int:
+        return int(self.counters[2])
+
+    def load(self, image_index: int, path: str, backend: str = "pil") -> torch.Tensor:
+        """
+        The decoded uint8 (height, width, 3) RGB image, from the cache or decoded from path with
+        the given image_io backend (and then cached).
+        """
+        pixels, shapes, owners, last_used, slots, counters = (
+            t.numpy() for t in (self.pixels, self.shapes, self.owners, self.last_used, self.slots, self.counters)
+        )
+
+        with self.lock:
+            slot = slots[image_index]
+            if slot >= 0:
+                counters[0] += 1
+                counters[1] += 1
+                last_used[slot] = counters[0]
+                height, width, channels = shapes[slot]
+                array = pixels[slot, : height * width * channels].reshape(height, width, channels).copy()
+                return torch.from_numpy(array)
+
+        image = load_image(path, backend)
+        array = image.numpy()
+        if array.nbytes > self.slot_bytes or len(self) == 0:
+            return image
+
+        with self.lock:
+            if slots[image_index] >= 0:
+                # Another worker cached it while this one was decoding
+                return image
+
+            # Empty slots were never used, so they are picked first
+            slot = int(last_used.argmin())
+            if owners[slot] >= 0:
+                slots[owners[slot]] = -1
+
+            pixels[slot, : array.nbytes] = array.reshape(-1)
+            shapes[slot] = array.shape
+            owners[slot] = image_index
+            slots[image_index] = slot
+            counters[0] += 1
+            counters[2] += 1
+            last_used[slot] = counters[0]
+
+        return image
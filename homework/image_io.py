@@ -0,0 +1,219 @@
+"""
+Image loading shared by training, evaluation and the graders.
+
+Every image is returned as a uint8 tensor of shape (height, width, 3) in RGB order, decoded by
+one of the backends below. File bytes are read in bulk on a thread pool, then decoded:
+
+- ``pil``: Pillow, optionally with draft mode, so JPEGs are decoded at a reduced scale when only a
+  smaller size is needed (the default, matches ``Image.open(path).convert("RGB")`` exactly)
+- ``opencv``: ``cv2.imdecode``, needs opencv-python
+- ``torchvision``: ``torchvision.io.decode_jpeg`` on the whole batch of raw bytes, optionally on
+  the GPU
+
+Files are read from image packs instead of individual files once packs are registered with
+set_image_packs (see image_packs). Run ``python -m homework.image_io benchmark`` to compare the
+backends on a data split.
+"""
+
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .data import DATA_DIR
+
+BACKENDS = ("pil", "opencv", "torchvision")
+JPEG_MAGIC = b"\xff\xd8"
+
+# ImagePacks that read_bytes reads packed files from, see set_image_packs
+_image_packs = None
+_warned_unpacked = False
+
+
+def set_image_packs(packs):
+    """
+    Read the files held by an image_packs.ImagePacks from its shards instead of opening them one
+    by one (None reads individual files again). Forked DataLoader workers inherit the setting.
+    """
+    global _image_packs, _warned_unpacked
+    _image_packs = packs
+    _warned_unpacked = False
+
+
+def read_bytes(paths: list[str | Path], workers: int = 8) -> list[bytes]:
+    """
+    Contents of all files, from the registered image packs or read on a thread pool.
+    """
+    global _warned_unpacked
+    if _image_packs is not None:
+        rows = _image_packs.rows(paths)
+        if (rows >= 0).all():
+            return _image_packs.read_rows(rows)
+        if not _warned_unpacked:
+            _warned_unpacked = True
+            missing = paths[int((rows < 0).argmax())]
+            print(f"Warning: {missing} is not in the image packs {_image_packs.directory}, reading loose files")
+
+    if len(paths) <= 1 or workers <= 1:
+        return [Path(path).read_bytes() for path in paths]
+    with ThreadPoolExecutor(min(workers, len(paths))) as pool:
+        return list(pool.map(lambda path: Path(path).read_bytes(), paths))
+
+
+def _decode_pil(data: list[bytes], size: tuple[int, int] | None) -> list[torch.Tensor]:
+    images = []
+    for raw in data:
+        with Image.open(io.BytesIO(raw)) as image:
+            if size is not None:
+                # JPEG only: decode at the smallest 1/2, 1/4 or 1/8 scale still at least this large
+                image.draft("RGB", size)
+            images.append(torch.from_numpy(np.asarray(image.convert("RGB")).copy()))
+    return images
+
+
+def _decode_opencv(data: list[bytes]) -> list[torch.Tensor]:
+    try:
+        import cv2
+    except ImportError as e:
+        raise ImportError("The opencv image backend needs opencv-python (pip install opencv-python)") from e
+
+    images = []
+    for raw in data:
+        image = cv2.imdecode(np.frombuffer(raw, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("OpenCV could not decode the image")
+        images.append(torch.from_numpy(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)))
+    return images
+
+
+def _decode_torchvision(data: list[bytes], device: str = "cpu") -> list[torch.Tensor]:
+    from torchvision.io import ImageReadMode, decode_image, decode_jpeg
+
+    encoded = [torch.frombuffer(bytearray(raw), dtype=torch.uint8) for raw in data]
+    jpegs = [i for i, raw in enumerate(data) if raw[:2] == JPEG_MAGIC]
+
+    images = [None] * len(data)
+    if jpegs:
+        # One call decodes the whole batch (on the GPU with device="cuda")
+        decoded = decode_jpeg([encoded[i] for i in jpegs], mode=ImageReadMode.RGB, device=device)
+        for i, image in zip(jpegs, decoded):
+            images[i] = image
+    for i, image in enumerate(images):
+        if image is None:
+            images[i] = decode_image(encoded[i], mode=ImageReadMode.RGB)
+
+    # Channels last like the other backends, as a view of the decoded tensors
+    return [image.permute(1, 2, 0) for image in images]
+
+
+def decode_images(
+    data: list[bytes], backend: str = "pil", size: tuple[int, int] | None = None, device: str = "cpu"
+) -> list[torch.Tensor]:
+    """
+    Decode encoded images into uint8 (height, width, 3) RGB tensors.
+
+    Args:
+        data: Encoded image files
+        backend: One of BACKENDS
+        size: (width, height) the images are needed at; lets the pil backend decode JPEGs at a
+            reduced scale that is still at least this large. None decodes at full size.
+        device: Device the torchvision backend decodes on, other backends decode on the CPU
+    """
+    if backend == "pil":
+        return _decode_pil(data, size)
+    if backend == "opencv":
+        return _decode_opencv(data)
+    if backend == "torchvision":
+        return _decode_torchvision(data, device)
+    raise ValueError(f"Unknown image backend {backend!r}, choose from {BACKENDS}")
+
+
+def load_images(
+    paths: list[str | Path], backend: str = "pil", size: tuple[int, int] | None = None, device: str = "cpu"
+) -> list[torch.Tensor]:
+    """
+    Read and decode a batch of images, see decode_images.
+    """
+    return decode_images(read_bytes(paths), backend, size, device)
+
+
+def load_image(path: str | Path, backend: str = "pil", size: tuple[int, int] | None = None) -> torch.Tensor:
+    """
+    Read and decode one image into a uint8 (height, width, 3) RGB tensor.
+    """
+    return load_images([path], backend, size)[0]
+
+
+def to_pil(image: torch.Tensor) -> Image.Image:
+    """
+    A decoded image as a PIL image, for transforms that need one.
+    """
+    return Image.fromarray(image.cpu().numpy())
+
+
+def benchmark(
+    data_dir: str | None = None,
+    split: str = "valid",
+    num_images: int = 1024,
+    batch_size: int = 64,
+    backends: tuple[str, ...] = BACKENDS,
+    size: tuple[int, int] | None = None,
+    device: str = "cpu",
+):
+    """
+    Compare the decode throughput of the image backends on the frames of a data split.
+
+    The files are read into memory once up front, so only decoding is timed. Every backend's
+    output is compared with the pil backend at full size.
+
+    Args:
+        data_dir: Data directory, defaults to the repository's data directory
+        split: Split whose *_im.jpg frames are decoded
+        num_images: Number of frames to decode
+        batch_size: Number of frames per decode call
+        backends: Backends to compare
+        size: Optional reduced (width, height) passed to the backends
+        device: Device for the torchvision backend
+    """
+    paths = sorted((Path(data_dir or DATA_DIR) / split).glob("*_im.jpg"))[:num_images]
+    if not paths:
+        raise FileNotFoundError(f"No *_im.jpg frames in {Path(data_dir or DATA_DIR) / split}")
+
+    start = time.perf_counter()
+    data = read_bytes(paths)
+    read_time = time.perf_counter() - start
+    print(f"Read {len(data)} frames ({sum(map(len, data)) / 2**20:.1f} MB) in {read_time:.3f}s")
+
+    reference = decode_images(data, "pil")
+    for backend in backends:
+        try:
+            decode_images(data[:1], backend, size, device)  # warm up, and check the backend is available
+        except ImportError as e:
+            print(f"{backend:>12}: skipped ({e})")
+            continue
+
+        start = time.perf_counter()
+        images = []
+        for i in range(0, len(data), batch_size):
+            images.extend(decode_images(data[i : i + batch_size], backend, size, device))
+        if device != "cpu":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+
+        same_shape = all(a.shape == b.shape for a, b in zip(images, reference))
+        if same_shape:
+            max_diff = max(int((a.cpu().int() - b.int()).abs().max()) for a, b in zip(images, reference))
+            match = f"max abs diff vs pil {max_diff}"
+        else:
+            match = f"decoded at {tuple(images[0].shape[1::-1])}"
+        print(f"{backend:>12}: {len(images) / elapsed:8.0f} images/s  ({match})")
+
+
+if __name__ == "__main__":
+    from fire import Fire
+
+    Fire({"benchmark": benchmark})
@@ -0,0 +1,359 @@
+"""
+Tar shards of a split's frames and info files, read with few large reads instead of many small opens.
+
+A data split holds tens of thousands of small ``*_im.jpg`` and ``*_info.json`` files, and on a
+network filesystem opening each of them costs more than reading it. ``pack`` copies them once
+into a handful of large tar shards under ``<data_dir>/.image_packs/<split>``:
+
+- ``shard-00000.tar``, ...: plain uncompressed tar files (``tar -tf`` lists them), the members
+  in sorted name order, each shard about shard_mb large
+- ``index.npz``: name (path relative to the data directory, sorted), shard, data offset and
+  size of every member
+
+Readers then either look members up in the index and read them from the few shard files that
+stay open (``ImagePacks.read``, or any image_io load after ``image_io.set_image_packs``, which is
+what ``finetune.train(image_packs=True)`` does), or stream whole shards with one sequential read
+each, visiting the shards in random order (``ShardStream``). ShardStream is a separate API for
+training loops built on an IterableDataset; the Trainer based fine-tuning keeps its samplers and
+does not use it.
+
+Packs belong to the split directory holding the files. Datasets whose records reference the
+frames of another split (``valid_grader`` uses ``valid/...``) open the packs of that split with
+``ImagePacks.for_dataset``. Rerun ``python -m homework.image_packs pack <split>`` after
+regenerating a split; the packs are a snapshot of the files and are not checked for staleness.
+"""
+
+import os
+import shutil
+import tarfile
+from collections.abc import Iterator
+from pathlib import Path
+
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+from tqdm import tqdm
+
+from .data import DATA_DIR
+from .image_io import decode_images
+
+PACK_PATTERNS = ("*_im.jpg", "*_info.json")
+
+
+class ImagePacks:
+    """
+    Index and random access reads of the tar shards of one split, see the module docstring.
+    """
+
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+        self.data_dir = self.directory.parent.parent  # packs live in <data_dir>/.image_packs/<split>
+        with np.load(self.directory / "index.npz") as index:
+            self.names = index["names"]
+            self.shards = index["shards"]
+            self.offsets = index["offsets"]
+            self.sizes = index["sizes"]
+        self.num_shards = int(self.shards.max()) + 1 if len(self.shards) else 0
+        self._files = {}
+
+    @classmethod
+    def open(cls, split: str, data_dir: str | Path | None = None) -> "ImagePacks":
+        """
+        Open the packs of a split, built by pack().
+        """
+        directory = Path(data_dir or DATA_DIR) / ".image_packs" / split
+        if not (directory / "index.npz").exists():
+            raise FileNotFoundError(f"No image packs in {directory}, run `python -m homework.image_packs pack {split}`")
+        return cls(directory)
+
+    @classmethod
+    def for_dataset(cls, dataset) -> "ImagePacks":
+        """
+        Open the packs of the split directory a dataset's images live in, which need not be the
+        dataset's own split.
+        """
+        data_dir = Path(dataset.data_dir)
+        splits = {Path(os.path.relpath(path, data_dir)).parts[0] for path in dataset.records.image_paths()}
+        if len(splits) != 1:
+            raise ValueError(f"Images of the dataset come from {len(splits)} splits {sorted(splits)}, expected one")
+        return cls.open(splits.pop(), data_dir)
+
+    def __getstate__(self) -> dict:
+        # Open file descriptors do not survive pickling into spawned workers, they are reopened
+        return {**self.__dict__, "_files": {}}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def shard_path(self, shard: int) -> Path:
+        return self.directory / f"shard-{shard:05d}.tar"
+
+    def rows(self, paths: list[str | Path]) -> np.ndarray:
+        """
+        Index row of every file, looked up by its path (absolute, or relative to the working
+        directory), -1 for files that are not packed.
+        """
+        keys = np.array([Path(os.path.relpath(path, self.data_dir)).as_posix() for path in paths], dtype=str)
+        rows = np.searchsorted(self.names, keys)
+        found = rows < len(self.names)
+        found[found] = self.names[rows[found]] == keys[found]
+        return np.where(found, rows, -1)
+
+    def _fd(self, shard: int) -> int:
+        # pread does not move a shared file position, so forked workers can use inherited descriptors
+        fd = self._files.get(shard)
+        if fd is None:
+            fd = self._files[shard] = os.open(self.shard_path(shard), os.O_RDONLY)
+        return fd
+
+    def read_rows(self, rows: np.ndarray) -> list[bytes]:
+        """
+        Contents of the members at the given index rows, read in shard and offset order.
+        """
+        rows = np.asarray(rows)
+        data = [None] * len(rows)
+        for i in np.lexsort((self.offsets[rows], self.shards[rows])).tolist():
+            row = rows[i]
+            data[i] = os.pread(self._fd(int(self.shards[row])), int(self.sizes[row]), int(self.offsets[row]))
+        return data
+
+    def read(self, path: str | Path) -> bytes:
+        """
+        Contents of one packed file.
+        """
+        row = self.rows([path])[0]
+        if row < 0:
+            raise KeyError(f"{path} is not in the image packs {self.directory}")
+        return self.read_rows(np.array([row]))[0]
+
+    def read_shard(self, shard: int, rows: np.ndarray | None = None) -> dict[int, memoryview]:
+        """
+        Contents of the members of one shard (or only the given rows of it), keyed by row, from a
+        single sequential read of the shard file.
+        """
+        in_shard = np.flatnonzero(self.shards == shard)
+        if rows is not None:
+            in_shard = np.intersect1d(in_shard, rows)
+        if not len(in_shard):
+            return {}
+
+        # One read from the first to the last needed member
+        start = int(self.offsets[in_shard].min())
+        end = int((self.offsets[in_shard] + self.sizes[in_shard]).max())
+        with open(self.shard_path(shard), "rb", buffering=0) as f:
+            f.seek(start)
+            buffer = memoryview(f.read(end - start))
+        offsets, sizes = self.offsets[in_shard] - start, self.sizes[in_shard]
+        return {
+            row: buffer[offset : offset + size]
+            for row, offset, size in zip(in_shard.tolist(), offsets.tolist(), sizes.tolist())
+        }
+
+
+class ShardStream(IterableDataset):
+    """
+    Streams the records of a VQADataset, CaptionDataset or MultiChoiceQADataset from image packs.
+
+    Every epoch the shards are shuffled and dealt out to the DataLoader workers. A worker reads
+    each of its shards with one sequential read and yields the shard's records in random order,
+    each record with its decoded image under "image" (uint8 (height, width, 3)) and its dataset
+    index under "record_index". Records whose image is not packed are skipped with a warning.
+    Records are shuffled within a shard only, so use shards much larger than a batch.
+
+    Call set_epoch before iterating every epoch. DataLoader workers get a copy of the stream when
+    an epoch starts, so with persistent_workers they keep the order of their first epoch.
+
+    Args:
+        dataset: Dataset whose records are streamed
+        packs: Image packs holding the dataset's images
+        shuffle: Shuffle the shards and the records within each shard
+        seed: Base seed; the order of epoch e uses seed + e
+        image_backend: image_io backend that decodes the images
+    """
+
+    def __init__(self, dataset, packs: ImagePacks, shuffle: bool = True, seed: int = 0, image_backend: str = "pil"):
+        self.dataset = dataset
+        self.packs = packs
+        self.shuffle = shuffle
+        self.seed = seed
+        self.image_backend = image_backend
+        self.epoch = 0
+
+        # Pack row of every image, and the shard of every record
+        table = dataset.records
+        self.image_rows = packs.rows(table.image_paths())
+        record_rows = self.image_rows[table.columns["image_index"]]
+        packed = record_rows >= 0
+        if not packed.all():
+            print(f"Warning: {int((~packed).sum())} records have no image in {packs.directory}, skipping them")
+        self.records = np.flatnonzero(packed)
+        self.record_shards = packs.shards[record_rows[packed]]
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __iter__(self) -> Iterator[dict]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        shards = np.unique(self.record_shards)
+        if self.shuffle:
+            shards = rng.permutation(shards)
+
+        worker = get_worker_info()
+        if worker is not None:
+            shards = shards[worker.id :: worker.num_workers]
+
+        table = self.dataset.records
+        for shard in shards.tolist():
+            records = self.records[self.record_shards == shard]
+            if self.shuffle:
+                records = rng.permutation(records)
+            image_indices = table.columns["image_index"][records]
+            contents = self.packs.read_shard(shard, self.image_rows[np.unique(image_indices)])
+            for idx, image_index in zip(records.tolist(), image_indices.tolist()):
+                image = decode_images([contents[int(self.image_rows[image_index])]], self.image_backend)[0]
+                yield {**self.dataset[idx], "image": image, "record_index": idx}
+
+
+def pack(
+    split: str, data_dir: str | None = None, shard_mb: float = 256, patterns: tuple[str, ...] = PACK_PATTERNS
+):
+    """
+    Pack the frames and info files of a split into tar shards with an offset index.
+
+    Args:
+        split: Split whose files are packed
+        data_dir: Data directory, defaults to the repository's; the packs are written to
+            <data_dir>/.image_packs/<split>, replacing earlier packs of the split
+        shard_mb: Size after which a new shard is started
+        patterns: Glob patterns of the files to pack
+    """
+    data_dir = Path(data_dir or DATA_DIR)
+    files = sorted({path for pattern in patterns for path in (data_dir / split).glob(pattern)})
+    if not files:
+        raise FileNotFoundError(
+            f"No {', '.join(patterns)} files in {data_dir / split}, pack the split holding the frames its records use"
+        )
+
+    directory = data_dir / ".image_packs" / split
+    tmp_directory = directory.with_name(f"{directory.name}.tmp-{os.getpid()}")
+    tmp_directory.mkdir(parents=True, exist_ok=True)
+
+    names, shards, offsets, sizes = [], [], [], []
+    shard, tar = -1, None
+    for path in tqdm(files, desc=f"Packing {split}"):
+        if tar is None or tar.offset >= shard_mb * 2**20:
+            if tar is not None:
+                tar.close()
+            shard += 1
+            tar = tarfile.open(tmp_directory / f"shard-{shard:05d}.tar", "w", format=tarfile.GNU_FORMAT)
+
+        name = path.relative_to(data_dir).as_posix()
+        info = tar.gettarinfo(path, arcname=name)
+        with open(path, "rb") as f:
+            tar.addfile(info, f)
+        # The member's data ends the archive so far, padded to whole 512-byte blocks
+        names.append(name)
+        shards.append(shard)
+        offsets.append(tar.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE)
+        sizes.append(info.size)
+    tar.close()
+
+    np.savez(
+        tmp_directory / "index.npz",
+        names=np.array(names),
+        shards=np.array(shards, dtype=np.int32),
+        offsets=np.array(offsets, dtype=np.int64),
+        sizes=np.array(sizes, dtype=np.int64),
+    )
+
+    # Swap the finished packs into place, so readers never see partial ones
+    if directory.exists():
+        old_directory = directory.with_name(f"{directory.name}.old-{os.getpid()}")
+        os.replace(directory, old_directory)
+        os.replace(tmp_directory, directory)
+        shutil.rmtree(old_directory, ignore_errors=True)
+    else:
+        os.replace(tmp_directory, directory)
+
+    total_mb = sum(sizes) / 2**20
+    print(f"\n✓ Packed {len(names)} files ({total_mb:.1f} MB) of {split} into {shard + 1} shards in {directory}")
+
+
+def check(split: str, data_dir: str | None = None, num_files: int = 256):
+    """
+    Compare packed files with the originals and time both ways of reading them.
+
+    Args:
+        split: Split whose packs are checked
+        data_dir: Data directory, defaults to the repository's
+        num_files: Number of randomly chosen files to compare
+    """
+    import time
+
+    packs = ImagePacks.open(split, data_dir)
+    rows = np.sort(np.random.default_rng(0).choice(len(packs), min(num_files, len(packs)), replace=False))
+    paths = [packs.data_dir / name for name in packs.names[rows].tolist()]
+
+    start = time.perf_counter()
+    originals = [path.read_bytes() for path in paths]
+    files_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    packed = packs.read_rows(rows)
+    packs_time = time.perf_counter() - start
+
+    mismatches = sum(a != b for a, b in zip(originals, packed))
+    print(f"{len(paths)} files: {files_time:.3f}s from files, {packs_time:.3f}s from packs, {mismatches} mismatches")
+    if mismatches:
+        raise ValueError(f"{mismatches} packed files differ from the originals, rerun pack")
+
+
+def check_stream(split: str, records: str = "qa", data_dir: str | None = None, num_workers: int = 4, epochs: int = 2):
+    """
+    Check that ShardStream yields every packed record of a dataset exactly once per epoch, with
+    the records dealt out to several DataLoader workers.
+
+    Args:
+        split: Split whose records are streamed, its images must be packed
+        records: "qa", "captions" or "mc", the dataset whose records are streamed
+        data_dir: Data directory, defaults to the repository's
+        num_workers: Number of DataLoader workers
+        epochs: Number of epochs to stream
+    """
+    from torch.utils.data import DataLoader
+
+    from .pixel_store import DATASETS
+
+    if records not in DATASETS:
+        raise ValueError(f"Unknown records {records!r}, choose from {tuple(DATASETS)}")
+    dataset = DATASETS[records](split, data_dir)
+    stream = ShardStream(dataset, ImagePacks.for_dataset(dataset))
+
+    orders = []
+    for epoch in range(epochs):
+        stream.set_epoch(epoch)
+        loader = DataLoader(stream, batch_size=None, num_workers=num_workers)
+        counts = np.zeros(len(dataset), dtype=np.int64)
+        order = []
+        for item in tqdm(loader, desc=f"Epoch {epoch}", total=len(stream)):
+            counts[item["record_index"]] += 1
+            order.append(item["record_index"])
+
+        missing = int((counts[stream.records] == 0).sum())
+        repeated = int((counts > 1).sum())
+        unpacked = int(counts.sum() - counts[stream.records].sum())
+        print(f"Epoch {epoch}: {len(order)} records, {missing} missing, {repeated} repeated, {unpacked} unpacked")
+        if missing or repeated or unpacked:
+            raise ValueError(f"ShardStream did not yield every packed record exactly once in epoch {epoch}")
+        orders.append(order)
+
+    if epochs > 1 and stream.shuffle and all(order == orders[0] for order in orders[1:]):
+        print("Warning: every epoch streamed the records in the same order")
+
+
+if __name__ == "__main__":
+    from fire import Fire
+
+    Fire({"pack": pack, "check": check, "check_stream": check_stream})
@@ -0,0 +1,252 @@
+"""
+Resized uint8 pixels of every image of a dataset, in one memory-mapped array.
+
+Decoding and resizing the same few thousand small frames again in every epoch and evaluation
+run dominates the input pipeline. A pixel store does it once per set of images and profile:
+
+- ``smolvlm``: the frames resized like the SmolVLM image processor does with image splitting
+  disabled, (3, longest_edge, longest_edge) per frame. Rescaling and normalization happen on the
+  fly in pixel_values.
+- ``clip``: the frames after the ``Resize(192)`` of the CLIP pipelines, (3, height, width) per
+  frame. The crops and the normalization of the CLIP transforms still run on the fly.
+
+Files:
+
+- ``pixels.npy`` (uint8): (num_frames, 3, height, width), row i holds frame paths[i]
+- ``paths.npy`` (str): path of every frame relative to the data directory, sorted
+- ``meta.json``: profile and normalization constants
+
+The frames are the images the dataset's records reference, which need not live in the split's
+own directory (``valid_grader`` uses the frames of ``valid``). The store directory is named
+after a hash of the profile settings (including the image processor settings) and the frame
+paths, so any change to them builds a new store.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import torch
+import torchvision as tv
+from tqdm import tqdm
+
+from .data import CaptionDataset, MultiChoiceQADataset, VQADataset
+from .image_io import load_images, to_pil
+
+PROFILES = ("smolvlm", "clip")
+DATASETS = {"qa": VQADataset, "captions": CaptionDataset, "mc": MultiChoiceQADataset}
+CLIP_RESIZE = 192
+STORE_VERSION = 1
+
+
+def profile_settings(profile: str, processor=None) -> dict:
+    """
+    Everything that determines the stored pixels and their normalization for a profile.
+    """
+    if profile == "smolvlm":
+        if processor is None:
+            raise ValueError("The smolvlm profile needs the processor")
+        image_processor = processor.image_processor
+        if image_processor.do_image_splitting:
+            raise ValueError("The smolvlm pixel store requires do_image_splitting=False")
+        return {
+            "profile": profile,
+            "image_processor": json.loads(image_processor.to_json_string()),
+            "rescale_factor": image_processor.rescale_factor,
+            "image_mean": list(image_processor.image_mean),
+            "image_std": list(image_processor.image_std),
+        }
+    if profile == "clip":
+        return {"profile": profile, "resize": CLIP_RESIZE}
+    raise ValueError(f"Unknown pixel store profile {profile!r}, choose from {PROFILES}")
+
+
+def expand_image_tokens(processor, prompts: list[str]) -> list[str]:
+    """
+    Prompts with every <image> token expanded the way the processor does for a single image
+    without image splitting, so they can be tokenized without running the image processor.
+    """
+    from transformers.models.idefics3.processing_idefics3 import get_image_prompt_string
+
+    image_prompt = get_image_prompt_string(
+        0,
+        0,
+        processor.image_seq_len,
+        fake_token_around_image=processor.fake_image_token,
+        image_token=processor.image_token,
+        global_img_token=processor.global_image_tag,
+    )
+    return [prompt.replace(processor.image_token, image_prompt) for prompt in prompts]
+
+
+class PixelStore:
+    """
+    Memory-mapped resized frames of one split, see the module docstring.
+    """
+
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+        self.data_dir = self.directory.parent.parent  # stores live in <data_dir>/.pixel_store
+        self.pixels = np.load(self.directory / "pixels.npy", mmap_mode="r")
+        self.paths = np.load(self.directory / "paths.npy", mmap_mode="r")
+        self.meta = json.loads((self.directory / "meta.json").read_text())
+
+        if self.meta["profile"] == "smolvlm":
+            self.rescale_factor = self.meta["rescale_factor"]
+            self.mean = torch.tensor(self.meta["image_mean"], dtype=torch.float32).view(3, 1, 1)
+            self.std = torch.tensor(self.meta["image_std"], dtype=torch.float32).view(3, 1, 1)
+
+    @classmethod
+    def load_or_build(cls, dataset, profile: str, processor=None, image_backend: str = "pil") -> "PixelStore":
+        """
+        Open the store of a dataset's images, building it first if needed.
+
+        Args:
+            dataset: VQADataset, CaptionDataset or MultiChoiceQADataset whose images are stored;
+                the store is kept under <dataset.data_dir>/.pixel_store
+            profile: One of PROFILES
+            processor: SmolVLM processor, required by the smolvlm profile
+            image_backend: image_io backend that decodes the frames while building
+        """
+        data_dir = Path(dataset.data_dir)
+        settings = profile_settings(profile, processor)
+        image_paths = dataset.records.image_paths()
+        paths = sorted({Path(os.path.relpath(path, data_dir)).as_posix() for path in image_paths})
+
+        h = hashlib.sha256(f"v{STORE_VERSION}".encode())
+        h.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+        for path in paths:
+            h.update(path.encode("utf-8"))
+            h.update(b"\0")
+        directory = data_dir / ".pixel_store" / f"{profile}-{h.hexdigest()[:16]}"
+
+        if not (directory / "meta.json").exists():
+            cls.build(data_dir, paths, settings, processor, directory, image_backend)
+        return cls(directory)
+
+    @staticmethod
+    def build(
+        data_dir: Path,
+        paths: list[str],
+        settings: dict,
+        processor,
+        directory: Path,
+        image_backend: str = "pil",
+        batch_size: int = 64,
+    ):
+        if not paths:
+            raise FileNotFoundError(f"No frames to store for {directory.name}")
+
+        if settings["profile"] == "smolvlm":
+
+            def resize(image: torch.Tensor) -> np.ndarray:
+                # The processor's own resizing, with rescaling and normalization left for later
+                pixel_values = processor.image_processor(
+                    [[image.numpy()]], do_rescale=False, do_normalize=False, return_tensors="np"
+                )["pixel_values"]
+                return np.rint(pixel_values[0, 0]).astype(np.uint8)
+
+        else:
+            clip_resize = tv.transforms.Resize(CLIP_RESIZE)
+
+            def resize(image: torch.Tensor) -> np.ndarray:
+                return np.asarray(clip_resize(to_pil(image))).transpose(2, 0, 1)
+
+        tmp_directory = directory.with_name(f"{directory.name}.tmp-{os.getpid()}")
+        tmp_directory.mkdir(parents=True, exist_ok=True)
+
+        pixels = None
+        for start in tqdm(range(0, len(paths), batch_size), desc=f"Storing {directory.name}"):
+            batch = [data_dir / path for path in paths[start : start + batch_size]]
+            for i, image in enumerate(load_images(batch, image_backend)):
+                row = resize(image)
+                if pixels is None:
+                    # Every frame of a split has the same size, so the first one fixes the shape
+                    pixels = np.lib.format.open_memmap(
+                        tmp_directory / "pixels.npy", mode="w+", dtype=np.uint8, shape=(len(paths), *row.shape)
+                    )
+                if row.shape != pixels.shape[1:]:
+                    raise ValueError(f"{batch[i]} resizes to {row.shape}, other frames to {pixels.shape[1:]}")
+                pixels[start + i] = row
+
+        pixels.flush()
+        del pixels
+        np.save(tmp_directory / "paths.npy", np.array(paths))
+        (tmp_directory / "meta.json").write_text(json.dumps(settings))
+
+        # Rename the finished store into place, so readers never see a partial one
+        try:
+            os.replace(tmp_directory, directory)
+        except OSError:
+            # Another process finished the same store first
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+
+        print(f"Stored {len(paths)} frames into {directory}")
+
+    def __len__(self) -> int:
+        return len(self.pixels)
+
+    def rows(self, image_paths: list[str | Path]) -> np.ndarray:
+        """
+        Row of every image, looked up by its path (absolute, or relative to the working directory).
+        """
+        keys = np.array([Path(os.path.relpath(path, self.data_dir)).as_posix() for path in image_paths], dtype=str)
+        rows = np.searchsorted(self.paths, keys)
+        found = rows < len(self.paths)
+        found[found] = self.paths[rows[found]] == keys[found]
+        if not found.all():
+            missing = keys[~found][0]
+            raise KeyError(f"{missing} is not in the pixel store {self.directory}, images of another dataset?")
+        return rows
+
+    def __getitem__(self, row: int) -> torch.Tensor:
+        """
+        Stored uint8 pixels of one frame, (3, height, width).
+        """
+        return torch.from_numpy(np.array(self.pixels[row]))
+
+    def pixel_values(self, row: int) -> torch.Tensor:
+        """
+        SmolVLM pixel_values of one frame, (1, 3, height, width), as the processor would produce them.
+        """
+        pixels = self[row].to(torch.float32) * self.rescale_factor
+        return ((pixels - self.mean) / self.std).unsqueeze(0)
+
+
+def build(
+    split: str,
+    profile: str = "smolvlm",
+    records: str = "qa",
+    data_dir: str | None = None,
+    image_backend: str = "pil",
+):
+    """
+    Build the pixel store of a dataset's images ahead of training or evaluation.
+
+    Args:
+        split: Split whose records reference the stored frames
+        profile: "smolvlm" (processor resolution) or "clip" (CLIP Resize(192))
+        records: Records of the split, "qa" (fine-tuning and test), "captions" (CLIP training)
+            or "mc" (CLIP test)
+        data_dir: Data directory, defaults to the repository's
+        image_backend: image_io backend that decodes the frames
+    """
+    if records not in DATASETS:
+        raise ValueError(f"Unknown records {records!r}, choose from {tuple(DATASETS)}")
+    processor = None
+    if profile == "smolvlm":
+        from .base_vlm import load_processor
+
+        processor = load_processor()
+    dataset = DATASETS[records](split, data_dir)
+    store = PixelStore.load_or_build(dataset, profile, processor, image_backend)
+    print(f"\n✓ {len(store)} frames of {split} {records} in {store.directory}")
+
+
+if __name__ == "__main__":
+    from fire import Fire
+
+    Fire({"build": build})
@@ -0,0 +1,178 @@
+"""
+Reading and writing dataset record files.
+
+A record file holds a list of flat dicts (QA pairs, captions, ...) in one of these formats,
+picked by file suffix:
+
+- ``.json``: a JSON array, as produced by ``json.dump(records, f, indent=2)``
+- ``.jsonl``: one JSON object per line
+- ``.jsonl.gz`` / ``.jsonl.zst``: compressed JSONL (zstd needs the ``zstandard`` package)
+- ``.npz``: a columnar binary shard with a deduplicated string table (see ``columnar.py``)
+
+Writers stream JSON and JSONL records to disk as they are produced, so memory stays constant
+regardless of the dataset size; columnar shards keep only int32 ids and the unique strings in
+memory until they are closed. Outputs only appear under their final name once closed
+successfully.
+"""
+
+import gzip
+import io
+import json
+import os
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import Any
+
+try:
+    from .columnar import ColumnarBuilder, ColumnarRecords
+except ImportError:  # imported as a top-level module by the generator scripts
+    from columnar import ColumnarBuilder, ColumnarRecords
+
+RECORD_SUFFIXES = (".jsonl.gz", ".jsonl.zst", ".jsonl", ".json", ".npz")
+
+
+def split_record_suffix(path: str | Path) -> tuple[str, str]:
+    """
+    Split a record file name into (base name, record suffix), e.g. ("train_qa_pairs", ".jsonl.gz").
+    """
+    name = Path(path).name
+    for suffix in RECORD_SUFFIXES:
+        if name.endswith(suffix):
+            return name[: -len(suffix)], suffix
+    raise ValueError(f"{name} is not a record file, expected one of {RECORD_SUFFIXES}")
+
+
+def find_record_files(directory: Path, pattern: str) -> list[Path]:
+    """
+    Sorted record files in directory whose base name matches pattern (e.g. "*_qa_pairs").
+    """
+    files = set()
+    for suffix in RECORD_SUFFIXES:
+        files.update(Path(directory).glob(f"{pattern}{suffix}"))
+    return sorted(files)
+
+
+def _open_text(path: Path, mode: str, suffix: str | None = None) -> io.TextIOBase:
+    suffix = suffix or split_record_suffix(path)[1]
+
+    if suffix.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+
+    if suffix.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError(f"Reading or writing {path.name} requires `pip install zstandard`") from e
+        return zstandard.open(path, mode + "t", encoding="utf-8")
+
+    return open(path, mode, encoding="utf-8")
+
+
+def iter_records(path: str | Path) -> Iterator[dict[str, Any]]:
+    """
+    Iterate over the records of a record file.
+
+    JSONL files are streamed line by line; JSON arrays and columnar shards are loaded in one go.
+    """
+    path = Path(path)
+    suffix = split_record_suffix(path)[1]
+    if suffix == ".npz":
+        yield from ColumnarRecords.load(path)
+        return
+
+    is_array = suffix == ".json"
+
+    with _open_text(path, "r") as f:
+        if is_array:
+            yield from json.load(f)
+            return
+
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_records(path: str | Path) -> list[dict[str, Any]]:
+    return list(iter_records(path))
+
+
+class RecordWriter:
+    """
+    Streaming writer for record files.
+
+    Records are written as soon as they are passed to ``write`` (columnar shards are written on
+    ``close``). ``.json`` output is rendered
+    exactly like ``json.dump(records, f, indent=2)``. The file is written to a temporary name
+    and renamed on a clean ``close``, so readers never see a partially written dataset.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.suffix = split_record_suffix(self.path)[1]
+        self.is_array = self.suffix == ".json"
+        self.tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self.count = 0
+        if self.suffix == ".npz":
+            self._columns = ColumnarBuilder()
+            self._file = open(self.tmp_path, "wb")
+        else:
+            self._columns = None
+            self._file = _open_text(self.tmp_path, "w", self.suffix)
+
+    def write(self, record: dict[str, Any]):
+        if self._columns is not None:
+            self._columns.append(record)
+        elif self.is_array:
+            prefix = "[\n  " if self.count == 0 else ",\n  "
+            self._file.write(prefix + json.dumps(record, indent=2).replace("\n", "\n  "))
+        else:
+            self._file.write(json.dumps(record) + "\n")
+        self.count += 1
+
+    def write_all(self, records: Iterable[dict[str, Any]]):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._columns is not None:
+            self._columns.save(self._file)
+        elif self.is_array:
+            self._file.write("\n]" if self.count else "[]")
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Discard the partially written output.
+        """
+        self._file.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self) -> "RecordWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def convert(src: str, dst: str):
+    """
+    Convert a record file to another format, e.g. balanced_qa_pairs.json -> balanced_qa_pairs.npz.
+
+    Remove or move the source afterwards if it lives in a split directory, otherwise the
+    dataset loaders pick up both files.
+    """
+    with RecordWriter(dst) as writer:
+        writer.write_all(iter_records(src))
+    print(f"✓ Converted {writer.count} records from {src} to {dst}")
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire({"convert": convert})
@@ -0,0 +1,94 @@
+"""
+Pairwise spatial relations between the karts of one view, shared by the QA and caption generators.
+"""
+
+from dataclasses import dataclass
+from functools import cached_property
+
+import numpy as np
+
+# Relation codes of a kart relative to a reference kart
+LEFT, RIGHT = -1, 1
+FRONT, BACK = -1, 1
+NEAR = 0  # within the threshold band
+
+
+def caption_thresholds(img_width: int, img_height: int) -> tuple[float, float]:
+    """
+    Horizontal and vertical dead bands used by the captions; karts inside them count as level.
+    """
+    return max(2.0, img_width * 0.02), max(2.0, img_height * 0.02)
+
+
+def _relation(coords: np.ndarray, threshold: float | None) -> np.ndarray:
+    # relation[i, j]: where kart j is relative to kart i along one axis
+    other = coords[None, :]
+    reference = coords[:, None]
+
+    if threshold is None:
+        # Binary split, ties go to the "right" / "back" side
+        return np.where(other < reference, -1, 1).astype(np.int8)
+
+    relation = np.zeros((len(coords), len(coords)), dtype=np.int8)
+    relation[other < reference - threshold] = -1
+    relation[other > reference + threshold] = 1
+    return relation
+
+
+@dataclass
+class SceneRelations:
+    """
+    All kart-to-kart relations of one view, computed with NumPy.
+
+    ``horizontal()[i, j]`` is LEFT/RIGHT (or NEAR inside a threshold band) for kart j as seen
+    from kart i, ``vertical()[i, j]`` is FRONT/BACK; smaller image y means further in front.
+    """
+
+    names: list[str]
+    centers: np.ndarray  # (K, 2) image coordinates
+    is_center: np.ndarray  # (K,) bool, karts sharing the ego's instance id
+    ego: int | None  # index of the ego kart
+
+    @classmethod
+    def from_karts(cls, kart_objects: list[dict]) -> "SceneRelations":
+        centers = np.array([kart["center"] for kart in kart_objects], dtype=np.float64).reshape(-1, 2)
+        is_center = np.array([bool(kart["is_center_kart"]) for kart in kart_objects], dtype=bool)
+        ego = int(np.argmax(is_center)) if is_center.any() else None
+        return cls([kart["kart_name"] for kart in kart_objects], centers, is_center, ego)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @cached_property
+    def others(self) -> np.ndarray:
+        """
+        Indices of the karts that are not the ego kart.
+        """
+        return np.flatnonzero(~self.is_center)
+
+    def horizontal(self, threshold: float | None = None) -> np.ndarray:
+        return _relation(self.centers[:, 0], threshold)
+
+    def vertical(self, threshold: float | None = None) -> np.ndarray:
+        return _relation(self.centers[:, 1], threshold)
+
+    def ego_relations(self, horizontal_threshold=None, vertical_threshold=None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        (horizontal, vertical) relation of every kart relative to the ego kart.
+        """
+        if self.ego is None:
+            raise ValueError("The view has no ego kart")
+        return self.horizontal(horizontal_threshold)[self.ego], self.vertical(vertical_threshold)[self.ego]
+
+    def ego_counts(self) -> dict[str, int]:
+        """
+        Number of non-ego karts left, right, in front of and behind the ego kart.
+        """
+        horizontal, vertical = self.ego_relations()
+        horizontal, vertical = horizontal[self.others], vertical[self.others]
+        return {
+            "left": int(np.count_nonzero(horizontal == LEFT)),
+            "right": int(np.count_nonzero(horizontal == RIGHT)),
+            "front": int(np.count_nonzero(vertical == FRONT)),
+            "back": int(np.count_nonzero(vertical == BACK)),
+        }
@@ -0,0 +1,166 @@
+import textwrap
+from functools import partial
+from pathlib import Path
+
+import fire
+from PIL import Image, ImageDraw, ImageFont
+from tqdm import tqdm
+
+from build_utils import index_split, map_sequences
+from generate_captions import generate_caption
+from generate_qa import draw_detections, extract_frame_info, extract_kart_objects, generate_qa_pairs, load_sequence_info
+
+MODES = ("qa", "captions")
+BACKGROUND = (24, 24, 24)
+TEXT_COLOR = (235, 235, 235)
+EGO_COLOR = (255, 200, 0)
+PADDING = 6
+
+
+def view_lines(info, view_index: int, mode: str) -> list[str]:
+    if mode == "qa":
+        return [f"Q: {qa['question']}  A: {qa['answer']}" for qa in generate_qa_pairs(info, view_index)]
+    return generate_caption(info, view_index)
+
+
+def render_view(image_path: Path, info, mode: str = "qa", scale: int = 4) -> Image.Image:
+    """
+    Render one view with its detection boxes, kart names and QA pairs or captions underneath.
+
+    Args:
+        image_path: Path of the view's image
+        info: Info file path or parsed SequenceInfo of the sequence
+        mode: "qa" or "captions"
+        scale: Upscaling factor of the (small) image
+    """
+    info = load_sequence_info(info)
+    _, view_index = extract_frame_info(str(image_path))
+
+    overlay = Image.fromarray(draw_detections(str(image_path), info))
+    img_width, img_height = overlay.size
+    overlay = overlay.convert("RGB").resize((img_width * scale, img_height * scale), Image.NEAREST)
+    draw = ImageDraw.Draw(overlay)
+    font = ImageFont.load_default()
+
+    for kart in extract_kart_objects(info, view_index, img_width, img_height):
+        x, y = kart["center"][0] * scale, kart["center"][1] * scale
+        color = EGO_COLOR if kart["is_center_kart"] else TEXT_COLOR
+        draw.ellipse([(x - 3, y - 3), (x + 3, y + 3)], fill=color)
+        draw.text((x + 5, y - 6), kart["kart_name"], fill=color, font=font)
+
+    # Wrap the text to the width of the image
+    chars_per_line = max(10, int((overlay.width - 2 * PADDING) // max(font.getlength("M"), 1)))
+    title = f"{Path(image_path).name}  frame {extract_frame_info(str(image_path))[0]}, view {view_index}"
+    lines = [title]
+    for line in view_lines(info, view_index, mode):
+        lines.extend(textwrap.wrap(line, chars_per_line, subsequent_indent="   "))
+
+    ascent, descent = font.getmetrics()
+    line_height = ascent + descent + 2
+    canvas = Image.new("RGB", (overlay.width, overlay.height + len(lines) * line_height + 2 * PADDING), BACKGROUND)
+    canvas.paste(overlay, (0, 0))
+
+    draw = ImageDraw.Draw(canvas)
+    for i, line in enumerate(lines):
+        draw.text((PADDING, overlay.height + PADDING + i * line_height), line, fill=TEXT_COLOR, font=font)
+
+    return canvas
+
+
+def contact_sheet(tiles: list[Image.Image], columns: int) -> Image.Image:
+    """
+    Tile rendered views into one image, row by row, in cells as large as the largest tile.
+    """
+    cell_width = max(tile.width for tile in tiles)
+    cell_height = max(tile.height for tile in tiles)
+    rows = (len(tiles) + columns - 1) // columns
+
+    sheet = Image.new("RGB", (columns * cell_width, rows * cell_height), BACKGROUND)
+    for i, tile in enumerate(tiles):
+        sheet.paste(tile, ((i % columns) * cell_width, (i // columns) * cell_height))
+    return sheet
+
+
+def _render_sequence(item: tuple[Path, list[int]], output_dir: Path, mode: str, scale: int) -> int:
+    info_path, views = item
+    info = load_sequence_info(info_path)  # parsed once for all views of the sequence
+    base_name = info_path.stem.replace("_info", "")
+
+    for view_index in views:
+        image_path = info_path.parent / f"{base_name}_{view_index:02d}_im.jpg"
+        render_view(image_path, info, mode, scale).save(output_dir / f"{base_name}_{view_index:02d}_{mode}.png")
+    return len(views)
+
+
+def _render_sheet(item: tuple[int, list[tuple[Path, int]]], output_dir: Path, mode: str, scale: int, columns: int) -> int:
+    sheet_index, views = item
+    tiles = []
+    for info_path, view_index in views:
+        # Views of a sequence are adjacent, so the cached loader parses each info file once
+        image_path = info_path.parent / f"{info_path.stem.replace('_info', '')}_{view_index:02d}_im.jpg"
+        tiles.append(render_view(image_path, info_path, mode, scale))
+
+    contact_sheet(tiles, columns).save(output_dir / f"{mode}_sheet_{sheet_index:05d}.png")
+    return len(views)
+
+
+def render(
+    root_dir="../data",
+    split="valid",
+    output_dir=None,
+    mode="qa",
+    sheet=None,
+    scale=4,
+    max_views=None,
+    workers=1,
+):
+    """
+    Render detection overlays with their QA pairs or captions for a whole split, headless.
+
+    Args:
+        root_dir: Base data directory
+        split: Dataset split to render
+        output_dir: Directory for the PNG files, defaults to <root_dir>/overlays/<split>
+        mode: Text drawn under each view, "qa" or "captions"
+        sheet: Optional "COLUMNSxROWS" (e.g. "4x4") to tile the views into contact sheets
+            instead of writing one file per view
+        scale: Upscaling factor of the images
+        max_views: Only render the first max_views views of the split
+        workers: Number of worker processes
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode!r}, choose from {MODES}")
+
+    split_dir = Path(root_dir) / split
+    if not split_dir.exists():
+        raise FileNotFoundError(f"Split directory {split_dir} does not exist.")
+    output_dir = Path(output_dir) if output_dir is not None else Path(root_dir) / "overlays" / split
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    sequences = list(index_split(split_dir).items())
+    if max_views is not None:
+        limited, remaining = [], max_views
+        for info_path, views in sequences:
+            if remaining <= 0:
+                break
+            limited.append((info_path, views[:remaining]))
+            remaining -= len(limited[-1][1])
+        sequences = limited
+
+    if sheet is None:
+        tasks = sequences
+        fn = partial(_render_sequence, output_dir=output_dir, mode=mode, scale=scale)
+    else:
+        columns, rows = (int(n) for n in str(sheet).lower().split("x"))
+        views = [(info_path, view_index) for info_path, view_list in sequences for view_index in view_list]
+        per_sheet = columns * rows
+        tasks = [(i, views[start : start + per_sheet]) for i, start in enumerate(range(0, len(views), per_sheet))]
+        fn = partial(_render_sheet, output_dir=output_dir, mode=mode, scale=scale, columns=columns)
+
+    rendered = sum(tqdm(map_sequences(fn, tasks, workers), total=len(tasks)))
+
+    print(f"\n✓ Rendered {rendered} views into {len(tasks) if sheet else rendered} files in {output_dir}")
+
+
+if __name__ == "__main__":
+    fire.Fire(render)
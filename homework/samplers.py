@@ -0,0 +1,152 @@
+"""
+Training samplers that control how records are grouped into batches.
+"""
+
+from collections.abc import Iterator
+
+import numpy as np
+from torch.utils.data import Sampler
+from transformers import Trainer
+
+
+def image_groups(
+    image_indices: np.ndarray, group_size: int, order: np.ndarray | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sort records by image and cut the records of every image into groups of at most group_size.
+
+    Args:
+        image_indices: Image index of every record
+        group_size: Maximum number of records per group
+        order: Order of the records within an image, defaults to the record order
+
+    Returns:
+        The records sorted by image, and the group id (0, 1, ...) of each of them
+    """
+    n = len(image_indices)
+    order = np.arange(n) if order is None else np.asarray(order)
+    order = order[np.argsort(image_indices[order], kind="stable")]
+
+    # Rank of every record within its image, then cut each image into groups
+    images = image_indices[order]
+    image_starts = np.flatnonzero(np.r_[True, images[1:] != images[:-1]]) if n else np.empty(0, dtype=int)
+    rank = np.arange(n) - np.repeat(image_starts, np.diff(np.r_[image_starts, n]))
+    group_ids = np.cumsum(rank % group_size == 0) - 1
+    return order, group_ids
+
+
+class ImageGroupedSampler(Sampler[int]):
+    """
+    Shuffles records so that up to `group_size` records of the same image are adjacent.
+
+    Every epoch the records of each image are shuffled and split into groups of at most
+    group_size, and the groups of all images are shuffled together. Consecutive indices, and
+    therefore the batches the DataLoader cuts from them, hold several questions about one
+    image, which lets decoded-image caches and per-batch vision reuse kick in, while the images
+    themselves are still visited in random order. Choose group_size as a divisor of the batch
+    size so groups do not straddle batches.
+
+    Args:
+        image_indices: Image index of every record (e.g. the "image_index" column of a dataset)
+        group_size: Maximum number of records of one image that are kept together
+        seed: Base seed; the order of epoch e uses seed + e
+    """
+
+    def __init__(self, image_indices: np.ndarray, group_size: int, seed: int = 0):
+        if group_size < 1:
+            raise ValueError(f"group_size must be at least 1, got {group_size}")
+        self.image_indices = np.asarray(image_indices)
+        self.group_size = group_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return len(self.image_indices)
+
+    def order(self, epoch: int) -> np.ndarray:
+        rng = np.random.default_rng(self.seed + epoch)
+        n = len(self.image_indices)
+
+        # Group the records by image, in random order within each image
+        order, group_ids = image_groups(self.image_indices, self.group_size, rng.permutation(n))
+
+        # Shuffle the groups and keep the records of a group together
+        group_position = rng.permutation(group_ids[-1] + 1 if n else 0)
+        return order[np.argsort(group_position[group_ids], kind="stable")]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.order(self.epoch).tolist())
+
+
+class LengthBucketedSampler(Sampler[int]):
+    """
+    Shuffles records so that every batch holds records of similar sequence length.
+
+    Every epoch the records are shuffled and cut into buckets of `bucket_batches` batches. Each
+    bucket is sorted by length and split into batches, and the batches of all buckets are
+    shuffled together. Padding to the longest sequence of a batch then wastes few tokens, while
+    the records of a batch are still drawn at random from a large part of the dataset. The batch
+    size must match the DataLoader's so batch boundaries line up.
+
+    Args:
+        lengths: Sequence length of every record
+        batch_size: Number of records per batch
+        bucket_batches: Number of batches per bucket, more gives tighter length groups but
+            less random batches
+        seed: Base seed; the order of epoch e uses seed + e
+    """
+
+    def __init__(self, lengths: np.ndarray, batch_size: int, bucket_batches: int = 64, seed: int = 0):
+        if batch_size < 1 or bucket_batches < 1:
+            raise ValueError(f"batch_size and bucket_batches must be at least 1, got {batch_size}, {bucket_batches}")
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def order(self, epoch: int) -> np.ndarray:
+        rng = np.random.default_rng(self.seed + epoch)
+        n = len(self.lengths)
+
+        # Sort every bucket of the shuffled records by length, longest first
+        shuffled = rng.permutation(n)
+        buckets = np.arange(n) // self.bucket_size
+        order = shuffled[np.lexsort((-self.lengths[shuffled], buckets))]
+
+        # Shuffle whole batches. The last, possibly partial, batch stays last so it does not
+        # leave a partial batch in the middle of the epoch.
+        num_batches = (n + self.batch_size - 1) // self.batch_size
+        batch_ids = np.arange(n) // self.batch_size
+        batch_position = np.r_[rng.permutation(num_batches - 1), num_batches - 1] if n else np.empty(0, dtype=int)
+        return order[np.argsort(batch_position[batch_ids], kind="stable")]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.order(self.epoch).tolist())
+
+
+class SamplerTrainer(Trainer):
+    """
+    Trainer that draws the training set with a given sampler instead of uniform random sampling.
+
+    Args:
+        train_sampler: Sampler for the training set, None for the Trainer's default
+    """
+
+    def __init__(self, *args, train_sampler: Sampler | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_sampler = train_sampler
+
+    def _get_train_sampler(self, *args, **kwargs) -> Sampler | None:
+        if self.train_sampler is not None:
+            return self.train_sampler
+        return super()._get_train_sampler(*args, **kwargs)
@@ -0,0 +1,223 @@
+"""
+Consolidated sequence-info index of a split, replacing the per-sequence ``*_info.json`` reads.
+
+``python sequence_index.py convert --split train`` parses every info file of a split once and
+writes ``<split_dir>/sequence_index.npz``:
+
+- ``strings_data`` / ``strings_offsets``: deduplicated UTF-8 string table (info file names,
+  track and kart names)
+- ``names``, ``tracks``: string ids of every sequence's info file name (sorted) and track
+- ``mtime_ns``: modification time of every info file when it was converted
+- ``karts`` / ``kart_offsets``: string ids of the karts of sequence i at
+  ``karts[kart_offsets[i] : kart_offsets[i + 1]]``
+- ``view_offsets`` / ``detection_offsets``: the views of sequence i are
+  ``view_offsets[i] : view_offsets[i + 1]``, the detections of view v are
+  ``detection_offsets[v] : detection_offsets[v + 1]``
+- ``classes``, ``track_ids`` (int32) and ``boxes`` (float64, x1 y1 x2 y2): one row per detection
+
+``generate_qa.load_sequence_info`` reads a sequence from the index of its directory when the
+index holds it with the info file's current mtime (or when the info file is gone), so the
+generators, renderers and check commands use it without changes to their callers. Info files
+edited after the conversion are parsed from JSON until the split is converted again.
+"""
+
+import hashlib
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import fire
+import numpy as np
+
+try:
+    from .columnar import StringTable
+except ImportError:  # imported as a top-level module by the generator scripts
+    from columnar import StringTable
+
+INDEX_NAME = "sequence_index.npz"
+INDEX_VERSION = 1
+
+
+class SequenceIndex:
+    """
+    Read-only view of a split's sequence index, see the module docstring.
+    """
+
+    def __init__(self, arrays: dict[str, np.ndarray]):
+        self.strings = StringTable.from_arrays(arrays["strings_data"], arrays["strings_offsets"]).strings
+        self.names = arrays["names"]
+        self.tracks = arrays["tracks"]
+        self.mtime_ns = arrays["mtime_ns"]
+        self.karts = arrays["karts"]
+        self.kart_offsets = arrays["kart_offsets"]
+        self.view_offsets = arrays["view_offsets"]
+        self.detection_offsets = arrays["detection_offsets"]
+        self.classes = arrays["classes"]
+        self.track_ids = arrays["track_ids"]
+        self.boxes = arrays["boxes"]
+        self.rows = {self.strings[name]: row for row, name in enumerate(self.names.tolist())}
+
+    @classmethod
+    def load(cls, path: str | Path) -> "SequenceIndex":
+        with np.load(path, allow_pickle=False) as index:
+            if int(index["index_version"]) != INDEX_VERSION:
+                raise ValueError(f"Unsupported sequence index version {int(index['index_version'])} in {path}")
+            return cls({name: index[name] for name in index.files})
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def find(self, name: str) -> int:
+        """
+        Row of the sequence with the given info file name (e.g. "00000_info.json"), -1 if absent.
+        """
+        return self.rows.get(name, -1)
+
+    def info_files(self) -> list[str]:
+        return [self.strings[name] for name in self.names.tolist()]
+
+    def track(self, row: int) -> str:
+        return self.strings[self.tracks[row]]
+
+    def kart_names(self, row: int) -> list[str]:
+        start, end = self.kart_offsets[row], self.kart_offsets[row + 1]
+        return [self.strings[kart] for kart in self.karts[start:end].tolist()]
+
+    def num_views(self, row: int) -> int:
+        return int(self.view_offsets[row + 1] - self.view_offsets[row])
+
+    def detection_array(self, row: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        All detections of a sequence as ``(view_ids, detections)``, where detections is an (N, 6)
+        float array of (class_id, track_id, x1, y1, x2, y2) rows sorted by view.
+        """
+        first_view, last_view = self.view_offsets[row], self.view_offsets[row + 1]
+        bounds = self.detection_offsets[first_view : last_view + 1]
+        start, end = bounds[0], bounds[-1]
+
+        view_ids = np.repeat(np.arange(len(bounds) - 1, dtype=np.int64), np.diff(bounds))
+        detections = np.empty((end - start, 6), dtype=np.float64)
+        detections[:, 0] = self.classes[start:end]
+        detections[:, 1] = self.track_ids[start:end]
+        detections[:, 2:] = self.boxes[start:end]
+        return view_ids, detections
+
+    def row_hash(self, row: int) -> str:
+        """
+        Hash of everything the index holds about a sequence, standing in for the content hash of
+        an info file that only the index keeps.
+        """
+        view_ids, detections = self.detection_array(row)
+        h = hashlib.sha256()
+        h.update(json.dumps([self.strings[self.names[row]], self.track(row), self.kart_names(row)]).encode("utf-8"))
+        h.update(np.int64(self.num_views(row)).tobytes())
+        h.update(np.ascontiguousarray(view_ids).tobytes())
+        h.update(np.ascontiguousarray(detections).tobytes())
+        return h.hexdigest()
+
+    def detections(self, row: int) -> list[list[list[float]]]:
+        """
+        Detections of every view of a sequence, in the nested list layout of the info files.
+        """
+        view_ids, detections = self.detection_array(row)
+        bounds = np.searchsorted(view_ids, np.arange(self.num_views(row) + 1))
+        rows = detections.tolist()
+        return [rows[bounds[v] : bounds[v + 1]] for v in range(len(bounds) - 1)]
+
+
+@lru_cache(maxsize=8)
+def _load_index_cached(path: str, mtime_ns: int) -> SequenceIndex:
+    # mtime_ns is only part of the cache key, so a rebuilt index is loaded again
+    return SequenceIndex.load(path)
+
+
+def load_index(split_dir: str | Path) -> SequenceIndex | None:
+    """
+    The sequence index of a split directory, or None if it has not been converted.
+    """
+    path = os.path.join(split_dir, INDEX_NAME)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return _load_index_cached(path, mtime_ns)
+
+
+def build_index(info_files: list[Path]) -> dict[str, np.ndarray]:
+    """
+    Index arrays of the given info files, which must have distinct, sorted names.
+    """
+    strings = StringTable()
+    names, tracks, mtime_ns, karts, kart_counts, view_counts, detection_counts = [], [], [], [], [], [], []
+    classes, track_ids, boxes = [], [], []
+
+    for info_path in info_files:
+        stat = info_path.stat()
+        with open(info_path) as f:
+            info = json.load(f)
+
+        names.append(strings.intern(info_path.name))
+        tracks.append(strings.intern(info.get("track", "Unknown Track")))
+        mtime_ns.append(stat.st_mtime_ns)
+        kart_names = info.get("karts", [])
+        karts.extend(strings.intern(kart) for kart in kart_names)
+        kart_counts.append(len(kart_names))
+
+        views = info.get("detections", [])
+        view_counts.append(len(views))
+        for view in views:
+            detection_counts.append(len(view))
+            for class_id, track_id, x1, y1, x2, y2 in view:
+                classes.append(int(class_id))
+                track_ids.append(int(track_id))
+                boxes.append((x1, y1, x2, y2))
+
+    def offsets(counts: list[int]) -> np.ndarray:
+        return np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]).astype(np.int64)
+
+    strings_data, strings_offsets = strings.to_arrays()
+    return {
+        "index_version": np.array(INDEX_VERSION, dtype=np.int32),
+        "strings_data": strings_data,
+        "strings_offsets": strings_offsets,
+        "names": np.array(names, dtype=np.int32),
+        "tracks": np.array(tracks, dtype=np.int32),
+        "mtime_ns": np.array(mtime_ns, dtype=np.int64),
+        "karts": np.array(karts, dtype=np.int32),
+        "kart_offsets": offsets(kart_counts),
+        "view_offsets": offsets(view_counts),
+        "detection_offsets": offsets(detection_counts),
+        "classes": np.array(classes, dtype=np.int32),
+        "track_ids": np.array(track_ids, dtype=np.int32),
+        "boxes": np.array(boxes, dtype=np.float64).reshape(len(boxes), 4),
+    }
+
+
+def convert(root_dir="../data", split="train"):
+    """
+    Convert the *_info.json files of a split into one sequence index next to them.
+
+    Args:
+        root_dir: Base data directory
+        split: Dataset split to convert (e.g. 'train', 'valid')
+    """
+    split_dir = Path(root_dir) / split
+    info_files = sorted(split_dir.glob("*_info.json"))
+    if not info_files:
+        raise FileNotFoundError(f"No *_info.json files in {split_dir}")
+
+    arrays = build_index(info_files)
+
+    # Write under a temporary name so readers never see a partial index
+    path = split_dir / INDEX_NAME
+    tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+    print(f"✓ Indexed {len(info_files)} sequences ({len(arrays['classes'])} detections) into {path}")
+
+
+if __name__ == "__main__":
+    fire.Fire({"convert": convert})
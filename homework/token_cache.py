@@ -0,0 +1,236 @@
+"""
+Pre-tokenized (question, answer) pairs for VQA fine-tuning.
+
+Tokenizing a training example means rendering the chat template, running the processor on the
+prompt and running it again on the answer to find the label mask. None of that depends on the
+image pixels (with image splitting disabled every image expands to the same tokens), so it is
+done once per distinct (question, answer) pair and stored as flat memory-mapped arrays:
+
+- ``input_ids.npy`` / ``labels.npy`` (int32) and ``attention_mask.npy`` (uint8): all token
+  sequences back to back
+- ``offsets.npy`` (int64): start of every sequence, plus the total length
+- ``entries.npy`` (int32): the sequence of every dataset record
+
+The cache directory is named after a hash of the tokenizer, the chat template, the processor
+settings and the QA records, so any change to them builds a new cache.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .data import VQADataset
+
+CACHE_VERSION = 1
+ARRAYS = ("input_ids", "labels", "attention_mask", "offsets", "entries")
+
+
+def tokenize_qa(
+    processor, image: Image.Image | np.ndarray, question: str, answer: str
+) -> dict[str, torch.Tensor]:
+    """
+    Tokenize one (image, question, answer) training example, with the loss on the answer only.
+    """
+    # Prepare input text in chat format
+    input_message = [{"role": "user", "content": [{"type": "image"}, {"type": "text", "text": question}]}]
+    prompt = processor.apply_chat_template(input_message, add_generation_prompt=True)
+    full_text = prompt + answer  # append the answer to the prompt
+
+    inputs = processor(
+        images=image,
+        text=full_text,
+        return_tensors="pt",
+        padding=True,
+        truncation=True,
+        padding_side="left",
+    )
+
+    input_ids = inputs["input_ids"].squeeze(0)
+    attention_mask = inputs["attention_mask"].squeeze(0)
+
+    # Get answer length
+    answer_ids = processor(images=None, text=answer, return_tensors="pt", truncation=True).input_ids.squeeze(0)
+    answer_len = len(answer_ids)
+
+    # Prepare labels: mask everything except the answer tokens
+    labels = input_ids.clone()
+    labels[:-answer_len] = -100  # only keep loss on answer
+
+    # Ensure EOS token is at the end of the sequence
+    if input_ids[-1] != processor.tokenizer.eos_token_id:
+        input_ids = torch.cat([input_ids, torch.tensor([processor.tokenizer.eos_token_id])])
+        attention_mask = torch.cat([attention_mask, torch.tensor([1])])
+        labels = torch.cat([labels, torch.tensor([processor.tokenizer.eos_token_id])])
+
+    return {
+        "input_ids": input_ids.long(),
+        "attention_mask": attention_mask.long(),
+        "pixel_values": inputs["pixel_values"].squeeze(0),
+        "labels": labels.long(),
+    }
+
+
+def follow_up_prompt(processor, question: str) -> str:
+    """
+    Chat text that asks another question after an answer and its end-of-utterance token.
+    """
+    first = [{"role": "user", "content": [{"type": "text", "text": ""}]}]
+    follow_up = first + [{"role": "user", "content": [{"type": "text", "text": question}]}]
+    history = processor.apply_chat_template(first)
+
+    # The template puts a separator (a newline) after every end of utterance
+    eos_token = processor.tokenizer.eos_token
+    separator = history[history.rindex(eos_token) + len(eos_token) :] if eos_token in history else ""
+    return separator + processor.apply_chat_template(follow_up, add_generation_prompt=True)[len(history) :]
+
+
+def tokenize_follow_up(processor, question: str, answer: str) -> dict[str, torch.Tensor]:
+    """
+    Tokenize one more (question, answer) turn of a multi-turn example, with the loss on the answer only.
+
+    The turn continues a sequence from tokenize_qa (which ends with the end-of-utterance token)
+    and is formatted like its first turn: the answer directly follows the generation prompt.
+    """
+    tokenizer = processor.tokenizer
+    prompt_ids = tokenizer(follow_up_prompt(processor, question), add_special_tokens=False)["input_ids"]
+    answer_ids = tokenizer(answer, add_special_tokens=False)["input_ids"] + [tokenizer.eos_token_id]
+
+    return {
+        "input_ids": torch.tensor(prompt_ids + answer_ids, dtype=torch.long),
+        "labels": torch.tensor([-100] * len(prompt_ids) + answer_ids, dtype=torch.long),
+    }
+
+
+def processor_fingerprint(processor) -> str:
+    """
+    Hash of everything in the processor that affects the token ids of a training example.
+    """
+    tokenizer = processor.tokenizer
+    if tokenizer.is_fast:
+        # Encoding calls leave their truncation / padding settings on the backend, skip those
+        backend = json.loads(tokenizer.backend_tokenizer.to_str())
+        backend.pop("truncation", None)
+        backend.pop("padding", None)
+        state = json.dumps(backend, sort_keys=True)
+    else:
+        state = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+
+    h = hashlib.sha256()
+    for part in (
+        f"v{CACHE_VERSION}",
+        state,
+        json.dumps(tokenizer.special_tokens_map, sort_keys=True),
+        str(tokenizer.model_max_length),
+        str(processor.chat_template),
+        str(getattr(processor, "image_seq_len", None)),
+    ):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def dataset_fingerprint(dataset: VQADataset) -> str:
+    table = dataset.qa_pairs
+    h = hashlib.sha256()
+    for array in (table.strings_data, table.strings_offsets, table.columns["question"], table.columns["answer"]):
+        h.update(np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()
+
+
+class TokenCache:
+    """
+    Memory-mapped token ids of every record of a VQADataset, see the module docstring.
+    """
+
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+        arrays = {name: np.load(self.directory / f"{name}.npy", mmap_mode="r") for name in ARRAYS}
+        self.input_ids = arrays["input_ids"]
+        self.labels = arrays["labels"]
+        self.attention_mask = arrays["attention_mask"]
+        self.offsets = arrays["offsets"]
+        self.entries = arrays["entries"]
+
+    @classmethod
+    def load_or_build(cls, dataset: VQADataset, processor, cache_root: str | Path | None = None) -> "TokenCache":
+        """
+        Open the cache matching the dataset and processor, building it first if needed.
+
+        Args:
+            dataset: QA pairs to tokenize
+            processor: Processor used for training (with image splitting disabled)
+            cache_root: Directory holding the caches, defaults to <data_dir>/.token_cache
+        """
+        if getattr(processor.image_processor, "do_image_splitting", False):
+            raise ValueError("Token caching requires do_image_splitting=False, the image tokens depend on the image")
+
+        cache_root = Path(cache_root) if cache_root is not None else Path(dataset.data_dir) / ".token_cache"
+        key = hashlib.sha256((processor_fingerprint(processor) + dataset_fingerprint(dataset)).encode()).hexdigest()
+        directory = cache_root / key[:16]
+
+        if not (directory / "entries.npy").exists():
+            cls.build(dataset, processor, directory)
+        return cls(directory)
+
+    @staticmethod
+    def build(dataset: VQADataset, processor, directory: Path):
+        table = dataset.qa_pairs
+        pairs = np.stack([table.columns["question"], table.columns["answer"]], axis=1).reshape(-1, 2)
+        unique_pairs, entries = np.unique(pairs, axis=0, return_inverse=True)
+
+        # The pixels do not affect the token ids, so one blank image stands in for all of them
+        image = Image.new("RGB", (150, 100))
+
+        input_ids, labels, attention_mask = [], [], []
+        offsets = np.zeros(len(unique_pairs) + 1, dtype=np.int64)
+        for i, (question_id, answer_id) in enumerate(unique_pairs.tolist()):
+            tokens = tokenize_qa(processor, image, table.string(question_id), table.string(answer_id))
+            input_ids.append(tokens["input_ids"].numpy().astype(np.int32))
+            labels.append(tokens["labels"].numpy().astype(np.int32))
+            attention_mask.append(tokens["attention_mask"].numpy().astype(np.uint8))
+            offsets[i + 1] = offsets[i] + len(input_ids[-1])
+
+        arrays = {
+            "input_ids": np.concatenate(input_ids) if input_ids else np.empty(0, dtype=np.int32),
+            "labels": np.concatenate(labels) if labels else np.empty(0, dtype=np.int32),
+            "attention_mask": np.concatenate(attention_mask) if attention_mask else np.empty(0, dtype=np.uint8),
+            "offsets": offsets,
+            "entries": entries.reshape(-1).astype(np.int32),
+        }
+
+        # Build next to the final directory and rename it into place, so readers never see a partial cache
+        tmp_directory = directory.with_name(f"{directory.name}.tmp-{os.getpid()}")
+        tmp_directory.mkdir(parents=True, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(tmp_directory / f"{name}.npy", array)
+        try:
+            os.replace(tmp_directory, directory)
+        except OSError:
+            # Another process finished the same cache first
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+
+        print(f"Tokenized {len(unique_pairs)} distinct QA pairs for {len(entries)} records into {directory}")
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def lengths(self) -> np.ndarray:
+        """
+        Sequence length of every record.
+        """
+        return np.diff(self.offsets)[self.entries]
+
+    def __getitem__(self, idx: int) -> dict[str, torch.Tensor]:
+        entry = self.entries[idx]
+        start, end = self.offsets[entry], self.offsets[entry + 1]
+        return {
+            "input_ids": torch.from_numpy(self.input_ids[start:end].astype(np.int64)),
+            "attention_mask": torch.from_numpy(self.attention_mask[start:end].astype(np.int64)),
+            "labels": torch.from_numpy(self.labels[start:end].astype(np.int64)),
+        }
@@ -0,0 +1,138 @@
+"""
+Precomputed image-token embeddings for VQA fine-tuning with a frozen vision tower.
+
+When the vision encoder and the connector are frozen, the embeddings they produce for an image
+never change during training. They are computed once per image and stored in a single
+memory-mapped array, and training feeds them to the text model as ``image_hidden_states``
+instead of running the vision tower on ``pixel_values``:
+
+- ``embeddings.npy`` (uint16): bfloat16 bit patterns, shape (num_images, image_seq_len, hidden_size),
+  row i holds the image with dense index ``image_index`` i
+
+The cache directory is named after a hash of the vision tower and connector weights, the image
+processor settings and the image paths, so any change to them builds a new cache.
+"""
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from .data import VQADataset
+from .image_io import load_images
+
+CACHE_VERSION = 1
+
+
+def vision_fingerprint(model, processor) -> str:
+    """
+    Hash of everything that affects the image-token embeddings: the vision tower and connector
+    weights and the image processor settings.
+    """
+    h = hashlib.sha256()
+    h.update(f"v{CACHE_VERSION}".encode())
+    h.update(processor.image_processor.to_json_string().encode("utf-8"))
+    for module in (model.model.vision_model, model.model.connector):
+        for name, tensor in module.state_dict().items():
+            h.update(name.encode("utf-8"))
+            h.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+class VisionEmbeddingCache:
+    """
+    Memory-mapped image-token embeddings of every image of a VQADataset, see the module docstring.
+    """
+
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+        self.embeddings = np.load(self.directory / "embeddings.npy", mmap_mode="r")
+
+    @classmethod
+    def load_or_build(
+        cls,
+        dataset: VQADataset,
+        model,
+        processor,
+        cache_root: str | Path | None = None,
+        batch_size: int = 64,
+        image_backend: str = "pil",
+    ) -> "VisionEmbeddingCache":
+        """
+        Open the cache matching the dataset, model and processor, building it first if needed.
+
+        Args:
+            dataset: QA pairs whose images are embedded
+            model: Idefics3 / SmolVLM model whose vision tower and connector are frozen
+            processor: Processor used for training (with image splitting disabled)
+            cache_root: Directory holding the caches, defaults to <data_dir>/.vision_cache
+            batch_size: Number of images per vision forward pass while building
+            image_backend: image_io backend that decodes the images while building
+        """
+        if getattr(processor.image_processor, "do_image_splitting", False):
+            raise ValueError("Vision caching requires do_image_splitting=False, one embedding block per image")
+
+        paths = dataset.qa_pairs.image_paths()
+        # Backends may decode slightly different pixels, so the backend is part of the key
+        h = hashlib.sha256((vision_fingerprint(model, processor) + image_backend).encode())
+        for path in paths:
+            h.update(path.encode("utf-8"))
+            h.update(b"\0")
+
+        cache_root = Path(cache_root) if cache_root is not None else Path(dataset.data_dir) / ".vision_cache"
+        directory = cache_root / h.hexdigest()[:16]
+
+        if not (directory / "embeddings.npy").exists():
+            cls.build(paths, model, processor, directory, batch_size, image_backend)
+        return cls(directory)
+
+    @staticmethod
+    @torch.no_grad()
+    def build(paths: list[str], model, processor, directory: Path, batch_size: int = 64, image_backend: str = "pil"):
+        device = next(model.parameters()).device
+        tmp_directory = directory.with_name(f"{directory.name}.tmp-{os.getpid()}")
+        tmp_directory.mkdir(parents=True, exist_ok=True)
+
+        embeddings = None
+        for start in tqdm(range(0, len(paths), batch_size), desc="Embedding images"):
+            images = [[image.numpy()] for image in load_images(paths[start : start + batch_size], image_backend)]
+            pixel_values = processor.image_processor(images, return_tensors="pt")["pixel_values"].to(device)
+            features = model.model.get_image_features(pixel_values).to(torch.bfloat16)
+            features = features.view(len(images), -1, features.shape[-1])
+
+            if embeddings is None:
+                # The shape is only known after the first batch
+                shape = (len(paths), *features.shape[1:])
+                embeddings = np.lib.format.open_memmap(
+                    tmp_directory / "embeddings.npy", mode="w+", dtype=np.uint16, shape=shape
+                )
+            embeddings[start : start + len(images)] = features.cpu().view(torch.int16).numpy().view(np.uint16)
+
+        if embeddings is None:
+            np.save(tmp_directory / "embeddings.npy", np.empty((0, 0, 0), dtype=np.uint16))
+        else:
+            embeddings.flush()
+            del embeddings
+
+        # Rename the finished cache into place, so readers never see a partial one
+        try:
+            os.replace(tmp_directory, directory)
+        except OSError:
+            # Another process finished the same cache first
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+
+        print(f"Embedded {len(paths)} images into {directory}")
+
+    def __len__(self) -> int:
+        return len(self.embeddings)
+
+    def __getitem__(self, image_index: int) -> torch.Tensor:
+        """
+        Image-token embeddings of one image, bfloat16 of shape (image_seq_len, hidden_size).
+        """
+        bits = np.array(self.embeddings[image_index]).view(np.int16)
+        return torch.from_numpy(bits).view(torch.bfloat16)